@@ -1,18 +1,49 @@
-from flask import jsonify, abort, session, request
+from flask import jsonify, abort, session, request, make_response, Response
 import base64
+import hmac
 import uuid
 import json
 import logging
+import time
 import requests
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import unquote_etag
+from app import metrics
 from app import settings
 from app.oauth import get_client
 from app.session import session as server_session
 from app.session_utils import get_session_data_or_abort
+from app.oauth.refresh import TokenRefresher, get_session_lifetime
 from app.oauth.utils import get_session_data_or_none
-from app.proxy_routes import proxy_routes
-from app.errors import AppError, ERROR_DELETE_USER
+from app.coalescing import is_shareable
+from app.headers import join_repeated_headers
+from app.proxy_routes import proxy_router
+from app.rate_limits import get_retry_after
+from app.response_cache import CachedResponse
+from app.streaming import (
+    get_request_body,
+    iter_response_body,
+    parse_content_length,
+)
+from app.errors import (
+    AppError,
+    ERROR_DELETE_USER,
+    ERROR_METRICS_TOKEN,
+    ERROR_RATE_LIMITED,
+    ERROR_UPSTREAM_CONNECTION,
+    ERROR_UPSTREAM_TIMEOUT,
+    ERROR_UPSTREAM_UNAVAILABLE,
+)
 
 DEFAULT_EXPIRATION_SECONDS = 24 * 3600
+# Server-side session fields holding the headers injected in proxied requests,
+# computed once when the session is created.
+AUTHORIZATION_HEADER_FIELD = "authorization_header"
+USERINFO_HEADER_FIELD = "userinfo_header"
+USERINFO_EXPIRES_AT_FIELD = "userinfo_expires_at"
+# Subject of the id token, the user the requests are proxied for
+SUBJECT_FIELD = "subject"
 _logger = logging.getLogger(__name__)
 
 
@@ -31,12 +62,11 @@ def callback():
         session_uuid = uuid.uuid4().hex
         # Put uuid in client session
         session[settings.SESSION_ID] = session_uuid
-        session.permanent = True
-        # Save tokens in server-side session
+        # Save tokens in server-side session, along with the derived headers
         server_session.create_session(
             session_uuid,
-            tokens,
-            expire_seconds=tokens.get("expires_in", DEFAULT_EXPIRATION_SECONDS),
+            build_session_payload(tokens),
+            expire_seconds=get_session_lifetime(tokens, DEFAULT_EXPIRATION_SECONDS),
         )
         _logger.debug(f"Creating session {session_uuid}")
         return get_client().callback()
@@ -66,16 +96,16 @@ def me():
 
 
 def logout():
+    session_id = session.get(settings.SESSION_ID)
     # Clear client-side session
     session.clear()
-    try:
-        # Clear server-side session
-        session_id = session[settings.SESSION_ID]
-        session[session_id] = ""
-        server_session.destroy_session(session_id)
-        _logger.debug(f"Cleared session {session_id}")
-    except Exception:
-        pass
+    if session_id:
+        try:
+            # Clear server-side session, in every worker
+            server_session.destroy_session(session_id)
+            _logger.debug(f"Cleared session {session_id}")
+        except Exception as exc:
+            _logger.warning(f"Could not destroy session {session_id}: {exc}")
     return get_client().logout()
 
 
@@ -98,88 +128,389 @@ def proxy(path):
     Special route used to proxy requests defined in the routes.yaml configuration file.
     """
     _logger.debug(f"Proxying {path}")
-    route = proxy_routes.get(request.endpoint)
+    route, _ = proxy_router.match(request.path, request.method, request.host)
     if not route:
-        _logger.error(f"No route configuration could be found for path {path}")
-        return jsonify({}), 500
+        _logger.debug(f"No route configuration could be found for path {path}")
+        abort(404)
     _logger.debug(f"Using proxy route {route.name} to {route.upstream}")
 
-    headers = dict(request.headers.to_wsgi_list())
-    sanitize_headers(headers)
-    headers.update(get_session_data_headers())
+    tracker = metrics.RequestTracker(route.name, request.method)
+    try:
+        response = make_response(proxy_route(route))
+    except Exception as exc:
+        tracker.finish(get_error_status(exc))
+        raise
+    # Streamed responses are finished once their body is sent
+    response.call_on_close(lambda: tracker.finish(response.status_code))
+    return response
+
+
+def proxy_route(route):
+    with metrics.proxy_phase_duration.time(route.name, "session"):
+        session_fields = get_session_data_fields()
+    session_headers = get_session_headers(session_fields)
+    subject = get_subject(session_fields)
 
     # Allows CORS, will still be wrapped by flask_cors
     if request.method in ["OPTIONS", "HEAD"]:
         return "", 200
 
-    def get_file_data():
-        file_data = b""
-        chunk_size = 4096
-        while True:
-            chunk = request.stream.read(chunk_size)
-            if len(chunk) == 0:
-                break
-            file_data += chunk
-        return file_data
-
-    # TODO: handle larger file upload with chuncking/streaming ?
-    # use requests data or file ?
-    # def exhaust(stream):
-    #    while True:
-    #        out = stream.read(1024 * 1024)
-    #        if not out:
-    #            break
-    #        yield out
-
-    data = None
-    if request.headers.get("Content-Type", None) and request.headers.get(
-        "Content-Type"
-    ).startswith("multipart/form-data"):
-        data = get_file_data()
-    else:
-        data = request.data
-
-    full_path = request.full_path[request.full_path.find(path) :]
-    response = requests.request(
-        request.method.lower(),
-        f"{route.upstream}/{full_path}",
-        headers=headers,
-        data=data,
+    if route.rate_limiter:
+        check_rate_limit(route, subject)
+
+    headers = route.header_pipeline.request_headers(
+        request.headers,
+        session_headers,
+        request.remote_addr,
+        request.scheme,
+        request.host,
     )
+    # Quoted path and query string after the path of the route
+    full_path = request.full_path[len(route.prefix) + 1 :]
+    if route.cache and route.cache.accepts(request.method, request.headers):
+        return proxy_cached(route, full_path, headers, subject)
+    if route.coalescer and request.method == "GET":
+        return to_response(
+            route,
+            coalesce(
+                route,
+                full_path,
+                subject,
+                lambda: fetch(route, full_path, headers),
+            ),
+            # Not a cached response
+            age=False,
+        )
+    deadline = route.pool.get_deadline()
+    response, release = send_upstream(route, full_path, headers, deadline)
+    return stream_response(route, response, release, deadline)
+
+
+def get_error_status(exc):
+    if isinstance(exc, AppError):
+        return exc.status
+    if isinstance(exc, HTTPException):
+        return exc.code
+    return 500
+
+
+def metrics_view():
+    if settings.METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(),
+        f"Bearer {settings.METRICS_TOKEN}".encode(),
+    ):
+        raise AppError(ERROR_METRICS_TOKEN)
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
-    return (response.content, response.status_code, response.headers.items())
+
+def check_rate_limit(route, subject):
+    retry_after = route.rate_limiter.check(subject, request.remote_addr)
+    if retry_after:
+        _logger.info(f"Rate limit of {route.name} exceeded")
+        raise AppError(
+            ERROR_RATE_LIMITED, headers={"Retry-After": get_retry_after(retry_after)}
+        )
 
 
-def sanitize_headers(headers):
+def send_upstream(route, full_path, headers, deadline=None):
     """
-    Authorization and X-Userinfo headers are added based on the server-side session.
-    Be sure to remove them from the original request if present.
+    Send the request to an upstream of the route, picked by its balancer, retrying
+    it according to the retry policy of the route until the deadline if any.
+    Return the upstream response, whose body is not read yet, and the function to call
+    once it is closed.
     """
-    auth_header = headers.pop("Authorization", None)
-    if auth_header:
-        _logger.warning(
-            f"Possible fraud: Authorization header was set to {auth_header}"
-        )
-    userinfo_header = headers.pop("X-Userinfo", None)
-    if userinfo_header:
-        _logger.warning(
-            f"Possible fraud: X-Userinfo header was set to {userinfo_header}"
-        )
+    retry = route.retry
+    data = get_request_body(request, route.chunk_size)
+    retryable = retry.is_retryable(request.method, data is not None)
+    session_id = session.get(settings.SESSION_ID)
+    retry.budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            response, release = send_attempt(
+                route, full_path, headers, data, session_id, deadline
+            )
+        except requests.RequestException as exc:
+            if not (retryable and retry.should_retry(attempt, deadline)):
+                raise_upstream_error(exc)
+        else:
+            if not (
+                retryable
+                and response.status_code in retry.statuses
+                and retry.should_retry(attempt, deadline)
+            ):
+                return response, release
+            response.close()
+            release()
+        _logger.info(f"Retrying the request to {route.name}, attempt {attempt + 1}")
+        time.sleep(retry.get_backoff(attempt, deadline))
+        attempt += 1
 
 
-def get_session_data_headers():
-    headers = {}
-    session_data = get_session_data_or_none()
-    if session_data:
-        access_token = session_data.get("access_token")
-        headers["Authorization"] = f"Bearer {access_token}"
+def send_attempt(route, full_path, headers, data, session_id, deadline):
+    balancer = route.balancer
+    upstream = balancer.select(session_id)
+    if upstream is None:
+        raise AppError(ERROR_UPSTREAM_UNAVAILABLE)
+    if data is not None and not len(data):
+        # requests writes the Host of the url itself when sending a chunked body
+        headers = [(name, value) for name, value in headers if name.lower() != "host"]
+    balancer.acquire(upstream)
+    try:
+        with metrics.proxy_phase_duration.time(route.name, "upstream"):
+            response = route.pool.request(
+                request.method.lower(),
+                f"{upstream.url}/{full_path}",
+                headers=join_repeated_headers(headers),
+                data=data,
+                stream=True,
+                timeout=route.pool.get_timeout(deadline),
+            )
+    except requests.RequestException:
+        balancer.release(upstream)
+        raise
+    return response, lambda: balancer.release(upstream, response.status_code)
+
+
+def raise_upstream_error(exc):
+    _logger.warning(f"Upstream request failed: {exc}")
+    if isinstance(exc, requests.Timeout):
+        raise AppError(ERROR_UPSTREAM_TIMEOUT) from exc
+    raise AppError(ERROR_UPSTREAM_CONNECTION) from exc
+
+
+def stream_response(route, response, release, deadline=None):
+    headers = route.header_pipeline.response_headers(response.headers.items())
+    body = iter_response_body(response, route.chunk_size, deadline)
+    encoding = get_compression(route, response.status_code, response.headers)
+    if encoding:
+        headers = route.compressor.get_headers(headers, encoding)
+        body = route.compressor.compress(body, encoding)
+    proxy_response = Response(body, status=response.status_code, headers=headers)
+    # Called once the body is sent, or the client went away
+    proxy_response.call_on_close(release)
+    return proxy_response
+
+
+def read_body(response, release):
+    try:
+        return response.raw.read(decode_content=False)
+    finally:
+        response.close()
+        release()
+
+
+def fetch(route, full_path, headers):
+    """
+    Get the upstream response to share with the coalesced requests, buffered as a
+    CachedResponse with all its headers if it is small enough and shareable, or
+    streamed.
+    Return it along with whether it can be shared.
+    """
+    deadline = route.pool.get_deadline()
+    response, release = send_upstream(route, full_path, headers, deadline)
+    content_length = parse_content_length(response.headers.get("Content-Length"))
+    if (
+        content_length is None
+        or content_length > route.coalescer.max_body_size
+        or not is_shareable(response.headers)
+    ):
+        return stream_response(route, response, release, deadline), False
+    body = read_body(response, release)
+    cached = CachedResponse(
+        response.status_code, list(response.headers.items()), body, time.time(), 0
+    )
+    return cached, True
+
+
+def coalesce(route, full_path, subject, fetch):
+    """
+    Call fetch once for the identical concurrent requests, if the route coalesces
+    them. Return its result: a CachedResponse, or a streamed flask response.
+    """
+    if not route.coalescer:
+        return fetch()[0]
+    key = route.coalescer.key(full_path, request.headers, subject)
+    return route.coalescer.run(key, fetch)
+
+
+def proxy_cached(route, full_path, headers, subject):
+    """
+    Answer a GET request from the response cache of the route when possible,
+    and store the upstream response otherwise.
+    """
+    cache = route.cache
+    key = cache.key(full_path, request.headers, subject)
+    cached = cache.get(key)
+    if cached and cached.is_fresh():
+        return cached_response(route, cached)
+    return to_response(
+        route,
+        coalesce(
+            route,
+            full_path,
+            subject,
+            lambda: fetch_cached(route, full_path, headers, key, cached),
+        ),
+    )
+
+
+def fetch_cached(route, full_path, headers, key, cached):
+    """
+    Get the upstream response and store it in the cache of the route, revalidating
+    the stale cached response if any.
+    Return the CachedResponse, or the streamed response if it can not be cached, along
+    with whether it can be shared with the coalesced requests.
+    """
+    cache = route.cache
+    if cached and cached.etag:
+        headers = [
+            (name, value) for name, value in headers if name.lower() != "if-none-match"
+        ]
+        headers.append(("If-None-Match", cached.etag))
+    deadline = route.pool.get_deadline()
+    response, release = send_upstream(route, full_path, headers, deadline)
+    if response.status_code == 304 and cached:
+        response.close()
+        release()
+        return cache.revalidate(key, cached, response.headers), True
+    ttl = cache.get_ttl(response.status_code, response.headers)
+    if ttl is None:
+        return stream_response(route, response, release, deadline), False
+    body = read_body(response, release)
+    return cache.set(key, response.status_code, response.headers, body, ttl), True
+
+
+def to_response(route, result, age=True):
+    if isinstance(result, CachedResponse):
+        return cached_response(route, result, age)
+    return result
 
-        id_token = session_data.get("id_token")
-        id_token_data = get_client().token_decoder.decode_token(
-            id_token, audience=settings.OAUTH_CLIENT_ID
+
+def cached_response(route, cached, age=True):
+    """
+    Response to the client from a cached upstream response, or 304 Not Modified if
+    the client already has it. With `age`, the Age header tells how long it was cached.
+    """
+    headers = route.header_pipeline.response_headers(cached.headers)
+    if age:
+        headers.append(("Age", str(cached.get_age())))
+    body = cached.body
+    encoding = get_compression(route, cached.status, Headers(cached.headers))
+    if encoding:
+        headers = route.compressor.get_headers(headers, encoding)
+        body = b"".join(route.compressor.compress([body], encoding))
+    etag = cached.etag
+    if etag and request.if_none_match.contains_weak(unquote_etag(etag)[0]):
+        return Response(status=304, headers=headers)
+    return Response(body, status=cached.status, headers=headers)
+
+
+def get_compression(route, status, headers):
+    """
+    Encoding to compress the upstream response with, or None.
+    """
+    compressor = route.compressor
+    if not compressor:
+        return None
+    encoding = compressor.get_encoding(request.headers.get("Accept-Encoding"))
+    if encoding and compressor.accepts(status, headers):
+        return encoding
+    return None
+
+
+def get_subject(session_fields):
+    """
+    Subject of the user the request is proxied for, stored in the session fields when
+    the session is created, or None for anonymous requests.
+    """
+    return session_fields.get(SUBJECT_FIELD) or None
+
+
+def build_session_payload(tokens):
+    """
+    Server-side session of the tokens, along with the headers derived from them.
+    """
+    payload = dict(tokens)
+    payload.update(build_session_headers_fields(tokens))
+    return payload
+
+
+token_refresher = TokenRefresher(build_session_payload)
+
+
+def build_session_headers_fields(session_data):
+    """
+    Compute the Authorization and X-Userinfo headers from the session tokens,
+    returned as the server-side session fields they are stored in.
+    """
+    id_token_data = get_client().token_decoder.decode_token(
+        session_data.get("id_token"), audience=settings.OAUTH_CLIENT_ID
+    )
+    return session_headers_fields(session_data, id_token_data)
+
+
+def session_headers_fields(session_data, id_token_data):
+    access_token = session_data.get("access_token")
+    userinfo = base64.b64encode(json.dumps(id_token_data).encode()).decode()
+    return {
+        AUTHORIZATION_HEADER_FIELD: f"Bearer {access_token}",
+        USERINFO_HEADER_FIELD: userinfo,
+        USERINFO_EXPIRES_AT_FIELD: id_token_data.get("exp", 0),
+        SUBJECT_FIELD: id_token_data.get("sub", ""),
+    }
+
+
+def has_session_headers(session_data):
+    """
+    Whether the session holds derived headers that are still valid.
+    Sessions created without them (or without the subject), or whose id token
+    expired, have to go through the token decoding again (which fails for expired
+    tokens).
+    """
+    expires_at = float(session_data.get(USERINFO_EXPIRES_AT_FIELD) or 0)
+    return expires_at > time.time() and SUBJECT_FIELD in session_data
+
+
+def get_session_fields(session_data):
+    """
+    Session fields of the derived headers and subject, computed again when the
+    session does not hold valid ones.
+    """
+    if has_session_headers(session_data):
+        return session_data
+    return build_session_headers_fields(session_data)
+
+
+def get_session_headers(session_fields):
+    if not session_fields:
+        return {}
+    return {
+        "Authorization": session_fields[AUTHORIZATION_HEADER_FIELD],
+        "X-Userinfo": session_fields[USERINFO_HEADER_FIELD],
+    }
+
+
+def get_session_data():
+    """
+    Server-side session data of the request or None, its access token being
+    refreshed when it is about to expire.
+    """
+    session_data = get_session_data_or_none()
+    if token_refresher.needs_refresh(session_data):
+        session_data = token_refresher.refresh(
+            session[settings.SESSION_ID], session_data
         )
-        headers["X-Userinfo"] = base64.b64encode(json.dumps(id_token_data).encode())
-        _logger.debug("Added Authorization header")
-    else:
+    return session_data
+
+
+def get_session_data_fields():
+    """
+    Session fields of the headers and subject of the request, empty without session.
+    """
+    session_data = get_session_data()
+    if not session_data:
         _logger.debug("No session_data found.")
-    return headers
+        return {}
+    _logger.debug("Added Authorization header")
+    return get_session_fields(session_data)
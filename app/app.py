@@ -8,6 +8,8 @@ from app import oauth
 from app import routes
 from app import settings
 from app import errors
+from app import metrics
+from app.session_cookies import SessionIdInterface
 
 _logger = logging.getLogger(__package__)
 
@@ -35,6 +37,10 @@ def create_app(logger_override=None):
     configure_logging(logger_override)
 
     app.secret_key = settings.SECRET_KEY
+    app.session_interface = SessionIdInterface(
+        settings.SESSION_COOKIE_KEYS,
+        int(app.permanent_session_lifetime.total_seconds()),
+    )
     if settings.DEBUG:
         app.debug = True
 
@@ -47,6 +53,7 @@ def create_app(logger_override=None):
     oauth.init_app(app)
     routes.init_app(app)
     errors.init_app(app)
+    metrics.registry.start()
 
     return app
 
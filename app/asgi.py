@@ -0,0 +1,435 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+import zlib
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_cookie
+
+from app import api
+from app import metrics
+from app import settings
+from app.app import create_app
+from app.errors import (
+    AppError,
+    ERROR_RATE_LIMITED,
+    ERROR_UPSTREAM_CONNECTION,
+    ERROR_UPSTREAM_TIMEOUT,
+    ERROR_UPSTREAM_UNAVAILABLE,
+)
+from app.oauth import get_client
+from app.proxy_routes import proxy_router
+from app.rate_limits import get_retry_after
+from app.session import session as server_session
+from app.streaming import parse_content_length
+
+_logger = logging.getLogger(__name__)
+
+# OPTIONS and HEAD are answered by the flask application, as in api.proxy
+ASYNC_METHODS = {"GET", "POST", "PUT", "DELETE", "PATCH"}
+# Response headers set by the ASGI server (uvicorn), not taken from the upstream
+SERVER_HEADERS = {"server", "date"}
+
+
+class AsyncProxyApp:
+    """
+    ASGI application proxying the routes of routes.yaml without holding a thread for
+    the duration of the upstream calls.
+
+    Every other request (/login, /callback, /me, /logout, /delete, as well as OPTIONS
+    and HEAD requests on proxied routes, and the requests of the routes with a
+    response cache or coalescing) is handed over to the flask application, and keeps
+    its behavior.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi_app = WsgiToAsgi(flask_app)
+        self.session_interface = flask_app.session_interface
+        self.clients = {}
+        self.in_flight = collections.Counter()
+        # Routes the clients were checked against, changed by a reload of the routes
+        self.clients_routes = proxy_router.routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        route, path = None, None
+        if scope["type"] == "http" and scope["method"] in ASYNC_METHODS:
+            route, path = self.match(scope)
+        if not route or route.cache or route.coalescer:
+            return await self.wsgi_app(scope, receive, send)
+        self.in_flight[route] += 1
+        tracker = metrics.RequestTracker(route.name, scope["method"])
+        status = 500
+
+        async def send_tracked(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.proxy(route, path, scope, receive, send_tracked)
+        finally:
+            tracker.finish(status)
+            self.in_flight[route] -= 1
+            if self.clients_routes is not proxy_router.routes:
+                await self.close_stale_clients()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
+    def match(self, scope):
+        """
+        Return the proxy route matching the request and the path to forward,
+        using the same proxy router as the flask application.
+        """
+        host = None
+        for name, value in scope["headers"]:
+            if name == b"host":
+                host = value.decode("latin-1")
+                break
+        return proxy_router.match(scope["path"], scope["method"], host)
+
+    def get_client(self, route):
+        """
+        Return the client of the route, created on its first request.
+        Clients are kept per route object, a reloaded route gets a new client.
+        """
+        client = self.clients.get(route)
+        if client is None:
+            pool = route.pool
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=(
+                        pool.max_connections if settings.PROXY_POOL_BLOCK else None
+                    ),
+                    max_keepalive_connections=pool.max_connections,
+                    keepalive_expiry=pool.idle_timeout,
+                ),
+                timeout=httpx.Timeout(pool.read_timeout, connect=pool.connect_timeout),
+            )
+            # Only the headers of the client request are sent, as in the WSGI proxy
+            client.headers.clear()
+            self.clients[route] = client
+        return client
+
+    async def close_stale_clients(self):
+        """
+        Close the clients of the routes replaced by a reload of routes.yaml, once
+        they have no more requests in flight.
+        """
+        routes = proxy_router.routes
+        stale = False
+        for route in list(self.clients):
+            if routes.get(route.name) is route:
+                continue
+            if self.in_flight[route]:
+                stale = True
+                continue
+            _logger.info(f"Closing the client of the previous route {route}")
+            del self.in_flight[route]
+            await self.clients.pop(route).aclose()
+        if not stale:
+            self.clients_routes = routes
+
+    def get_session_id(self, cookie_header):
+        """
+        Read the session id from the session cookie.
+        """
+        if not cookie_header:
+            return None
+        cookie = parse_cookie(cookie_header).get(self.flask_app.session_cookie_name)
+        if not cookie:
+            return None
+        session_id, _ = self.session_interface.load_session_id(self.flask_app, cookie)
+        return session_id
+
+    async def get_session_fields(self, session_id):
+        """
+        Session fields of the headers and subject of the request, empty without
+        session.
+        """
+        session_data = session_id and await server_session.get_async(session_id)
+        if api.token_refresher.needs_refresh(session_data):
+            session_data = await api.token_refresher.refresh_async(
+                session_id, session_data
+            )
+        if not session_data:
+            _logger.debug("No session_data found.")
+            return {}
+
+        _logger.debug("Added Authorization header")
+        if api.has_session_headers(session_data):
+            return session_data
+        id_token_data = await get_client().token_decoder.decode_token_async(
+            session_data.get("id_token"), audience=settings.OAUTH_CLIENT_ID
+        )
+        return api.session_headers_fields(session_data, id_token_data)
+
+    def get_cors_headers(self, origin):
+        """
+        Headers added by flask_cors on the responses of the flask application.
+        """
+        if not origin or not settings.CORS_ORIGIN:
+            return []
+        if origin not in settings.CORS_ORIGIN.split(","):
+            return []
+        return [
+            (b"access-control-allow-origin", origin.encode("latin-1")),
+            (b"access-control-allow-credentials", b"true"),
+            (b"vary", b"Origin"),
+        ]
+
+    async def proxy(self, route, path, scope, receive, send):
+        _logger.debug(f"Using proxy route {route.name} to {route.upstream}")
+        headers = get_request_headers(scope)
+        cors_headers = self.get_cors_headers(headers.get("Origin"))
+        session_id = self.get_session_id("; ".join(headers.getlist("Cookie")))
+        try:
+            with metrics.proxy_phase_duration.time(route.name, "session"):
+                session_fields = await self.get_session_fields(session_id)
+        except AppError as exc:
+            return await send_error(send, exc, cors_headers)
+        session_headers = api.get_session_headers(session_fields)
+
+        client_address = scope.get("client")
+        remote_addr = client_address[0] if client_address else None
+        if route.rate_limiter:
+            retry_after = await route.rate_limiter.check_async(
+                api.get_subject(session_fields), remote_addr
+            )
+            if retry_after:
+                retry_headers = [
+                    (b"retry-after", get_retry_after(retry_after).encode())
+                ]
+                return await send_error(
+                    send, AppError(ERROR_RATE_LIMITED), retry_headers + cors_headers
+                )
+
+        upstream_headers = route.header_pipeline.request_headers(
+            headers.items(),
+            session_headers,
+            remote_addr,
+            scope.get("scheme", "http"),
+            headers.get("Host"),
+        )
+        query = scope.get("query_string", b"").decode("latin-1")
+        deadline = route.pool.get_deadline()
+        try:
+            response, upstream = await self.send_upstream(
+                route,
+                scope["method"],
+                f"{path}?{query}",
+                upstream_headers,
+                get_request_body(headers, receive),
+                session_id,
+                deadline,
+            )
+        except AppError as exc:
+            return await send_error(send, exc, cors_headers)
+
+        response_headers = route.header_pipeline.response_headers(
+            (name, value)
+            for name, value in response.headers.multi_items()
+            if name.lower() not in SERVER_HEADERS
+        )
+        encoding = get_compression(route, headers.get("Accept-Encoding"), response)
+        if encoding:
+            response_headers = route.compressor.get_headers(response_headers, encoding)
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": response.status_code,
+                    "headers": [
+                        (name.encode("latin-1"), value.encode("latin-1"))
+                        for name, value in response_headers
+                    ]
+                    + cors_headers,
+                }
+            )
+            async for chunk in iter_response_body(route, response, encoding, deadline):
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await response.aclose()
+            route.balancer.release(upstream, response.status_code)
+
+    async def send_upstream(
+        self, route, method, full_path, headers, content, session_id, deadline
+    ):
+        """
+        Send the request to an upstream of the route, retrying it according to the
+        retry policy of the route, as in api.send_upstream.
+        Return the upstream response, whose body is not read yet, and its upstream.
+        """
+        retry = route.retry
+        retryable = retry.is_retryable(method, content is not None)
+        retry.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                response, upstream = await self.send_attempt(
+                    route, method, full_path, headers, content, session_id, deadline
+                )
+            except httpx.HTTPError as exc:
+                if not (retryable and retry.should_retry(attempt, deadline)):
+                    raise get_upstream_error(exc) from exc
+            else:
+                if not (
+                    retryable
+                    and response.status_code in retry.statuses
+                    and retry.should_retry(attempt, deadline)
+                ):
+                    return response, upstream
+                await response.aclose()
+                route.balancer.release(upstream, response.status_code)
+            _logger.info(f"Retrying the request to {route.name}, attempt {attempt + 1}")
+            await asyncio.sleep(retry.get_backoff(attempt, deadline))
+            attempt += 1
+
+    async def send_attempt(
+        self, route, method, full_path, headers, content, session_id, deadline
+    ):
+        balancer = route.balancer
+        upstream = balancer.select(session_id)
+        if upstream is None:
+            raise AppError(ERROR_UPSTREAM_UNAVAILABLE)
+        client = self.get_client(route)
+        kwargs = {}
+        if deadline is not None:
+            connect_timeout, read_timeout = route.pool.get_timeout(deadline)
+            kwargs["timeout"] = httpx.Timeout(read_timeout, connect=connect_timeout)
+        upstream_request = client.build_request(
+            method,
+            f"{upstream.url}/{full_path}",
+            headers=headers,
+            content=content,
+            **kwargs,
+        )
+        balancer.acquire(upstream)
+        try:
+            with metrics.proxy_phase_duration.time(route.name, "upstream"):
+                response = await client.send(upstream_request, stream=True)
+        except httpx.HTTPError:
+            balancer.release(upstream)
+            raise
+        return response, upstream
+
+
+def get_upstream_error(exc):
+    _logger.warning(f"Upstream request failed: {exc!r}")
+    if isinstance(exc, httpx.TimeoutException):
+        return AppError(ERROR_UPSTREAM_TIMEOUT)
+    return AppError(ERROR_UPSTREAM_CONNECTION)
+
+
+def get_request_headers(scope):
+    """
+    Headers of the ASGI request, with the same names as in the WSGI environ.
+    Repeated headers are all kept, in their order.
+    """
+    return Headers(
+        [
+            (name.decode("latin-1").title(), value.decode("latin-1"))
+            for name, value in scope["headers"]
+        ]
+    )
+
+
+def get_compression(route, accept_encoding, response):
+    """
+    Encoding to compress the upstream response with, or None, as in api.
+    """
+    compressor = route.compressor
+    if not compressor:
+        return None
+    encoding = compressor.get_encoding(accept_encoding)
+    if encoding and compressor.accepts(response.status_code, response.headers):
+        return encoding
+    return None
+
+
+async def iter_response_body(route, response, encoding=None, deadline=None):
+    """
+    Raw body of the upstream response, compressed chunk by chunk with `encoding`,
+    and cut short when the deadline of the request passes.
+    """
+    compressor = encoding and route.compressor.create_compressor(encoding)
+    async for chunk in response.aiter_raw(route.chunk_size):
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if chunk:
+            yield chunk
+        if deadline is not None and time.monotonic() >= deadline:
+            _logger.warning("Total timeout reached, cutting the response body")
+            break
+    if compressor:
+        yield compressor.flush()
+
+
+def get_request_body(headers, receive):
+    """
+    Return the body of the ASGI request as an async iterator to give to httpx,
+    or None if the request has no body.
+    """
+    chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+    if not parse_content_length(headers.get("Content-Length")) and not chunked:
+        return None
+
+    async def iter_body():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("Client disconnected while sending the body")
+            if message.get("body"):
+                yield message["body"]
+            if not message.get("more_body"):
+                break
+
+    return iter_body()
+
+
+async def send_error(send, exc, headers=None):
+    body = json.dumps({"error": exc.to_dict()}).encode()
+    await send_response(send, exc.status, body, headers)
+
+
+async def send_response(send, status, body, headers=None):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ]
+            + (headers or []),
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app(logger_override=None):
+    return AsyncProxyApp(create_app(logger_override))
@@ -0,0 +1,283 @@
+import hashlib
+import itertools
+import logging
+import math
+import os
+import random
+import threading
+import time
+import zlib
+
+import requests
+
+from app import settings
+from app.circuit_breakers import CircuitBreaker
+
+_logger = logging.getLogger(__name__)
+
+ROUND_ROBIN = "round_robin"
+LEAST_OUTSTANDING = "least_outstanding"
+CONSISTENT_HASH = "consistent_hash"
+BALANCINGS = (ROUND_ROBIN, LEAST_OUTSTANDING, CONSISTENT_HASH)
+
+# Size of the consistent hashing lookup table, a prime much larger than the number of
+# upstreams of a route
+HASH_TABLE_SIZE = 4099
+
+
+class Upstream:
+    def __init__(self, url, breaker=None):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0
+        self.healthy = True
+        # Optional CircuitBreaker
+        self.breaker = breaker
+
+    def is_available(self, now):
+        return self.healthy and self.ejected_until <= now
+
+    def __repr__(self):
+        return f"<Upstream url={self.url} outstanding={self.outstanding}>"
+
+
+class UpstreamBalancer:
+    """
+    Spread the requests of a proxy route over the replicas of its upstream.
+
+    Balancings:
+    - round_robin: each available upstream in turn.
+    - least_outstanding: the upstream with the fewest requests in flight among two
+      picked at random (power of two choices), instead of scanning all of them.
+    - consistent_hash: the upstream is picked from the session id with a Maglev
+      lookup table, so that a session keeps its upstream, and the ejection of an
+      upstream barely moves the sessions of the others. Requests without session are
+      balanced in round robin.
+
+    Selection is O(1): the list of available upstreams (and the lookup table) is only
+    rebuilt when an upstream is ejected, restored, or changes health.
+
+    Passive outlier ejection: an upstream failing `max_failures` consecutive requests
+    (connection error or 5xx) is left out for `ejection_time` seconds.
+    Active health checks are optional: `health_check` is a dict with the `path` to
+    probe, its `interval` and `timeout` in seconds. They run in a background thread.
+    If no upstream is available, all of them are used rather than failing every
+    request.
+
+    Each upstream has a circuit breaker (see CircuitBreaker) unless `circuit_breaker`
+    is false: an upstream whose circuit is open is skipped, and no upstream is
+    selected when all of them are.
+    """
+
+    def __init__(
+        self,
+        urls,
+        balancing=None,
+        max_failures=None,
+        ejection_time=None,
+        health_check=None,
+        circuit_breaker=None,
+    ):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.upstreams = [
+            Upstream(url, CircuitBreaker.from_dict(circuit_breaker)) for url in urls
+        ]
+        self.balancing = balancing or ROUND_ROBIN
+        if self.balancing not in BALANCINGS:
+            raise ValueError(f"Unknown balancing {self.balancing}")
+        self.max_failures = max_failures or settings.UPSTREAM_MAX_FAILURES
+        self.ejection_time = (
+            settings.UPSTREAM_EJECTION_TIME if ejection_time is None else ejection_time
+        )
+        self.health_check = health_check
+        self.available = self.upstreams
+        self.table = None
+        self._counter = itertools.count()
+        self._next_update = math.inf
+        self._lock = threading.Lock()
+        self._checker_pid = None
+        self._closed = False
+        self.update()
+
+    @staticmethod
+    def from_dict(
+        upstream, balancing=None, outlier=None, health_check=None, circuit_breaker=None
+    ):
+        """
+        Build the balancer from the `upstream`, `balancing`, `outlier`,
+        `health_check` and `circuit_breaker` keys of a route in routes.yaml.
+        """
+        outlier = outlier or {}
+        return UpstreamBalancer(
+            upstream,
+            balancing=balancing,
+            max_failures=outlier.get("max_failures"),
+            ejection_time=outlier.get("ejection_time"),
+            health_check=health_check,
+            circuit_breaker=circuit_breaker,
+        )
+
+    def select(self, key=None):
+        """
+        Return the upstream for the next request, `key` being the session id used
+        by the consistent_hash balancing, or None if the circuits of all the
+        upstreams are open.
+        """
+        upstream = self.pick(key)
+        if upstream.breaker is None or upstream.breaker.allow():
+            return upstream
+        for _ in range(len(self.upstreams) - 1):
+            # The session upstream is down, fall back to the others in turn
+            upstream = self.pick()
+            if upstream.breaker.allow():
+                return upstream
+        return None
+
+    def pick(self, key=None):
+        if self.health_check:
+            self.start_health_checks()
+        if time.monotonic() >= self._next_update:
+            self.update()
+        available = self.available
+        if len(available) == 1:
+            return available[0]
+        if self.balancing == CONSISTENT_HASH and key:
+            table = self.table
+            return table[zlib.crc32(key.encode()) % len(table)]
+        if self.balancing == LEAST_OUTSTANDING:
+            first, second = random.sample(available, 2)
+            return first if first.outstanding <= second.outstanding else second
+        return available[next(self._counter) % len(available)]
+
+    def acquire(self, upstream):
+        with self._lock:
+            upstream.outstanding += 1
+
+    def release(self, upstream, status=None):
+        """
+        Record the end of a request sent to the upstream, with the status of its
+        response, or None if it could not be reached.
+        """
+        failed = status is None or status >= 500
+        if upstream.breaker is not None:
+            upstream.breaker.record(failed)
+        with self._lock:
+            upstream.outstanding -= 1
+            if not failed:
+                upstream.failures = 0
+                return
+            upstream.failures += 1
+            if upstream.failures < self.max_failures or not self.ejection_time:
+                return
+            upstream.failures = 0
+            upstream.ejected_until = time.monotonic() + self.ejection_time
+        _logger.warning(
+            f"Ejecting upstream {upstream.url} for {self.ejection_time} seconds"
+        )
+        self.update()
+
+    def update(self):
+        """
+        Rebuild the list of the available upstreams and the lookup table.
+        """
+        with self._lock:
+            now = time.monotonic()
+            available = [
+                upstream for upstream in self.upstreams if upstream.is_available(now)
+            ]
+            if not available:
+                _logger.error("No available upstream, using all of them")
+                available = self.upstreams
+            if self.balancing == CONSISTENT_HASH:
+                self.table = build_lookup_table(available)
+            self.available = available
+            self._next_update = min(
+                (
+                    upstream.ejected_until
+                    for upstream in self.upstreams
+                    if upstream.ejected_until > now
+                ),
+                default=math.inf,
+            )
+
+    def start_health_checks(self):
+        """
+        Start the background health checks, once per process.
+        """
+        if self._checker_pid == os.getpid() or self._closed:
+            return
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            threading.Thread(target=self._check_forever, daemon=True).start()
+            self._checker_pid = os.getpid()
+
+    def _check_forever(self):
+        session = requests.Session()
+        interval = self.health_check.get("interval", 10)
+        while not self._closed:
+            self.check_health(session)
+            time.sleep(interval)
+        session.close()
+
+    def check_health(self, session=requests):
+        changed = False
+        for upstream in self.upstreams:
+            try:
+                response = session.get(
+                    f"{upstream.url}{self.health_check.get('path', '/')}",
+                    timeout=self.health_check.get("timeout", 2),
+                )
+                healthy = response.ok
+            except requests.RequestException:
+                healthy = False
+            if healthy != upstream.healthy:
+                _logger.warning(
+                    f"Upstream {upstream.url} is now "
+                    f"{'healthy' if healthy else 'unhealthy'}"
+                )
+                upstream.healthy = healthy
+                changed = True
+        if changed:
+            self.update()
+        return changed
+
+    def close(self):
+        self._closed = True
+
+    def __repr__(self):
+        return (
+            f"<UpstreamBalancer balancing={self.balancing} "
+            f"upstreams={[upstream.url for upstream in self.upstreams]}>"
+        )
+
+
+def build_lookup_table(upstreams, size=HASH_TABLE_SIZE):
+    """
+    Maglev lookup table: each upstream fills the free slots in the order of its own
+    permutation of the table, derived from its url only. Removing an upstream thus
+    only reassigns its own slots (or very few others).
+    """
+    permutations = []
+    for upstream in upstreams:
+        digest = int.from_bytes(hashlib.md5(upstream.url.encode()).digest(), "big")
+        offset = digest % size
+        skip = (digest >> 64) % (size - 1) + 1
+        permutations.append((offset, skip))
+
+    table = [None] * size
+    positions = [0] * len(upstreams)
+    filled = 0
+    while True:
+        for index, (offset, skip) in enumerate(permutations):
+            slot = (offset + positions[index] * skip) % size
+            while table[slot] is not None:
+                positions[index] += 1
+                slot = (offset + positions[index] * skip) % size
+            table[slot] = upstreams[index]
+            positions[index] += 1
+            filled += 1
+            if filled == size:
+                return table
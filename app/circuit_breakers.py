@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+from app import settings
+
+_logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of an upstream: after `max_failures` consecutive failed requests
+    (connection error, timeout or 5xx), the circuit opens and the requests to the
+    upstream fail fast for `open_time` seconds, instead of holding a worker until
+    they time out.
+    Then a single probe request is let through (half-open): its success closes the
+    circuit, its failure opens it again.
+    """
+
+    def __init__(self, max_failures=None, open_time=None):
+        self.max_failures = max_failures or settings.CIRCUIT_BREAKER_MAX_FAILURES
+        self.open_time = (
+            settings.CIRCUIT_BREAKER_OPEN_TIME if open_time is None else open_time
+        )
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_dict(circuit_breaker):
+        """
+        Build a breaker from the `circuit_breaker` key of a route in routes.yaml,
+        true (the default) or a section with its settings, or return None if the
+        route has no circuit breaker.
+        """
+        if circuit_breaker is False:
+            return None
+        if not isinstance(circuit_breaker, dict):
+            circuit_breaker = {}
+        return CircuitBreaker(
+            max_failures=circuit_breaker.get("max_failures"),
+            open_time=circuit_breaker.get("open_time"),
+        )
+
+    def allow(self):
+        """
+        Whether a request can be sent to the upstream.
+        """
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if (
+                self.state == OPEN
+                and time.monotonic() >= self.opened_at + self.open_time
+            ):
+                # Let this request through as the probe
+                self.state = HALF_OPEN
+                return True
+            return self.state == CLOSED
+
+    def record(self, failed):
+        """
+        Record the outcome of a request sent to the upstream.
+        """
+        if not failed and self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            if not failed:
+                self.failures = 0
+                if self.state != CLOSED:
+                    _logger.info("Closing circuit breaker")
+                    self.state = CLOSED
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.max_failures:
+                if self.state != OPEN:
+                    _logger.warning(
+                        f"Opening circuit breaker for {self.open_time} seconds"
+                    )
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.failures = 0
+
+    def __repr__(self):
+        return f"<CircuitBreaker state={self.state} failures={self.failures}>"
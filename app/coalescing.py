@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import threading
+
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import parse_cache_control_header
+
+from app import settings
+
+_logger = logging.getLogger(__name__)
+
+# Request headers changing the response of the upstream, always part of the key.
+# Cookie is forwarded to the upstream, which may answer differently per cookie even
+# for anonymous requests.
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since", "range", "cookie")
+
+
+class Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def is_shareable(headers):
+    """
+    Whether the upstream response, `headers` being its case-insensitive headers, can
+    be given to other requests than the one it answers: not if it sets a cookie, or if
+    the upstream forbids storing it or sharing it between users.
+    """
+    if "Set-Cookie" in headers:
+        return False
+    cache_control = parse_cache_control_header(
+        headers.get("Cache-Control"), cls=ResponseCacheControl
+    )
+    return not (cache_control.no_store or cache_control.private)
+
+
+class RequestCoalescer:
+    """
+    Single-flight of the identical GET requests of a proxy route: while a request is
+    in flight to the upstream, the identical ones wait for its response instead of
+    sending their own.
+
+    Requests are identical when they have the same path and query, the same values of
+    the conditional headers, cookies and request headers listed in `vary`, and are
+    made for the same user.
+    Only buffered responses can be shared: when the response of the first request is
+    streamed (larger than `max_body_size`, or without Content-Length) or not shareable
+    (see is_shareable), the waiting requests are sent to the upstream on their own.
+    So are they after waiting `timeout` seconds. An error of the first request is
+    raised for all of them.
+
+    Requests are coalesced among the threads of a worker.
+    """
+
+    def __init__(self, name, vary=None, timeout=None, max_body_size=None):
+        self.name = name
+        self.vary = [header.lower() for header in vary or []]
+        self.timeout = timeout or settings.COALESCING_TIMEOUT
+        self.max_body_size = max_body_size or settings.COALESCING_MAX_BODY_SIZE
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_dict(name, coalesce):
+        """
+        Build the coalescer of a route from its `coalesce` key in routes.yaml, true or
+        a section with its settings, or return None if the route is not coalesced.
+        """
+        if not coalesce:
+            return None
+        if not isinstance(coalesce, dict):
+            coalesce = {}
+        return RequestCoalescer(
+            name,
+            vary=coalesce.get("vary"),
+            timeout=coalesce.get("timeout"),
+            max_body_size=coalesce.get("max_body_size"),
+        )
+
+    def key(self, path, headers, subject=None):
+        """
+        Key of the request, `headers` being the (case-insensitive) request headers.
+        """
+        parts = [self.name, path, subject or ""]
+        parts.extend(headers.get(header, "") for header in CONDITIONAL_HEADERS)
+        parts.extend(headers.get(header, "") for header in self.vary)
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def run(self, key, fetch):
+        """
+        Return the result of `fetch`, called once for all the concurrent calls with
+        the same key. `fetch` returns its result and whether it can be shared with
+        the waiting calls.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            return self.wait(flight, fetch)
+
+        try:
+            result, shared = fetch()
+            if shared:
+                flight.result = result
+            return result
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def wait(self, flight, fetch):
+        if not flight.done.wait(self.timeout):
+            _logger.warning("Coalesced request timed out, sending it on its own")
+        elif flight.error is not None:
+            raise flight.error
+        elif flight.result is not None:
+            with self._lock:
+                self.coalesced += 1
+            return flight.result
+        result, _ = fetch()
+        return result
+
+    @property
+    def in_flight(self):
+        return len(self._flights)
@@ -0,0 +1,202 @@
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+from app import settings
+from app.streaming import parse_content_length
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings in order of preference when the client accepts several of them with the
+# same quality, and their default levels
+DEFAULT_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+DEFAULT_CONTENT_TYPES = [
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/problem+json",
+    "image/svg+xml",
+]
+# Statuses without a body to compress
+BODYLESS_STATUSES = {204, 304}
+
+
+def is_available(encoding):
+    if encoding == "br":
+        return brotli is not None
+    if encoding == "zstd":
+        return zstandard is not None
+    return encoding == "gzip"
+
+
+class ResponseCompressor:
+    """
+    Compress the responses of a proxy route, with the best encoding accepted by the
+    client (Accept-Encoding) among zstd, br and gzip, chunk by chunk as they are
+    streamed.
+
+    Only responses with one of `content_types`, of at least `min_size` bytes (or of
+    unknown size), are compressed. Responses already encoded by the upstream pass
+    through as they are, as do the ones with Cache-Control no-transform.
+    `level` is the compression level of all the encodings, or a dict of the level
+    per encoding.
+    brotli and zstd need the brotli and zstandard packages.
+    """
+
+    def __init__(self, level=None, min_size=None, content_types=None, encodings=None):
+        self.levels = dict(DEFAULT_LEVELS)
+        if isinstance(level, dict):
+            self.levels.update(level)
+        elif level is not None:
+            self.levels = {encoding: level for encoding in self.levels}
+        self.min_size = settings.COMPRESSION_MIN_SIZE if min_size is None else min_size
+        self.content_types = tuple(content_types or DEFAULT_CONTENT_TYPES)
+        self.encodings = [
+            encoding
+            for encoding in encodings or DEFAULT_LEVELS
+            if encoding in DEFAULT_LEVELS and is_available(encoding)
+        ]
+
+    @staticmethod
+    def from_dict(compress):
+        """
+        Build the compressor of a route from its `compress` key in routes.yaml, true or
+        a section with its settings, or return None if the route is not compressed.
+        """
+        if not compress:
+            return None
+        if not isinstance(compress, dict):
+            compress = {}
+        return ResponseCompressor(
+            level=compress.get("level"),
+            min_size=compress.get("min_size"),
+            content_types=compress.get("content_types"),
+            encodings=compress.get("encodings"),
+        )
+
+    def get_encoding(self, accept_encoding):
+        """
+        Best encoding accepted by the client, or None.
+        """
+        if not accept_encoding:
+            return None
+        accepted = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accepted[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def accepts(self, status, headers):
+        """
+        Whether the upstream response should be compressed, `headers` being its
+        case-insensitive headers.
+        """
+        if status in BODYLESS_STATUSES or status < 200:
+            return False
+        content_encoding = headers.get("Content-Encoding")
+        if content_encoding and content_encoding.lower() != "identity":
+            return False
+        if headers.get("Content-Range"):
+            return False
+        content_type = (headers.get("Content-Type") or "").lower()
+        if not content_type.startswith(self.content_types):
+            return False
+        if "no-transform" in (headers.get("Cache-Control") or "").lower():
+            return False
+        content_length = parse_content_length(headers.get("Content-Length"))
+        return content_length is None or content_length >= self.min_size
+
+    def get_headers(self, headers, encoding):
+        """
+        Headers of the compressed response, from the (name, value) pairs of the
+        upstream response.
+        """
+        compressed_headers = []
+        vary = None
+        for name, value in headers:
+            lower_name = name.lower()
+            if lower_name in ("content-length", "content-encoding"):
+                continue
+            if lower_name == "vary":
+                vary = value
+                continue
+            if lower_name == "etag" and not value.startswith("W/"):
+                # The compressed body is not byte for byte the upstream one
+                value = f"W/{value}"
+            compressed_headers.append((name, value))
+        compressed_headers.append(("Content-Encoding", encoding))
+        compressed_headers.append(
+            ("Vary", f"{vary}, Accept-Encoding" if vary else "Accept-Encoding")
+        )
+        return compressed_headers
+
+    def compress(self, chunks, encoding):
+        """
+        Compress the chunks of the body as they come. Each chunk is flushed, so that
+        the client receives the data as soon as the upstream sends it.
+        """
+        compressor = self.create_compressor(encoding)
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            # Release the upstream response if the client goes away
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+    def create_compressor(self, encoding):
+        level = self.levels[encoding]
+        if encoding == "gzip":
+            return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if encoding == "br":
+            return BrotliCompressor(level)
+        return ZstdCompressor(level)
+
+
+class BrotliCompressor:
+    """
+    brotli.Compressor with the interface of the zlib compressors.
+    """
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        if mode == zlib.Z_FINISH:
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+class ZstdCompressor:
+    """
+    zstandard compressobj with the interface of the zlib compressors.
+    """
+
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        if mode == zlib.Z_FINISH:
+            return self.compressor.flush()
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
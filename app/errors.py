@@ -27,15 +27,35 @@ ERROR_JWKS_KEY_NOT_FOUND = {
 
 ERROR_DELETE_USER = {"status": 500, "code": 5, "title": "Could not delete user"}
 
+ERROR_UPSTREAM_UNAVAILABLE = {
+    "status": 503,
+    "code": 6,
+    "title": "The upstream is unavailable.",
+}
+
+ERROR_UPSTREAM_TIMEOUT = {"status": 504, "code": 7, "title": "The upstream timed out."}
+
+ERROR_UPSTREAM_CONNECTION = {
+    "status": 502,
+    "code": 8,
+    "title": "Could not connect to the upstream.",
+}
+
+ERROR_RATE_LIMITED = {"status": 429, "code": 9, "title": "Too many requests."}
+
+ERROR_METRICS_TOKEN = {"status": 401, "code": 10, "title": "Invalid metrics token."}
+
 
 def init_app(app):
     app.register_error_handler(AppError, AppError.handle)
 
 
 class AppError(HTTPException):
-    def __init__(self, error=ERROR_UNKNOWN, description=None):
+    def __init__(self, error=ERROR_UNKNOWN, description=None, headers=None):
         self.error = error
         self.error["description"] = description
+        # Headers of the error response, like Retry-After
+        self.headers = headers or {}
 
     @property
     def code(self):
@@ -67,7 +87,11 @@ class AppError(HTTPException):
         This method is called by flask when an AppError is encountered,
         via `register_error_handler`.
         """
-        return jsonify({"error": exception.to_dict()}), exception.status
+        return (
+            jsonify({"error": exception.to_dict()}),
+            exception.status,
+            exception.headers,
+        )
 
 
 class AuthError(Exception):
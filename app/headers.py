@@ -0,0 +1,197 @@
+import logging
+import re
+
+_logger = logging.getLogger(__name__)
+
+# Hop-by-hop headers (RFC 7230, section 6.1), only meaningful for a single connection
+HOP_BY_HOP_HEADERS = frozenset(
+    {
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "proxy-connection",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    }
+)
+# Headers injected from the server-side session, never taken from the client
+SESSION_HEADERS = frozenset({"authorization", "x-userinfo"})
+FORWARDED_HEADERS = frozenset(
+    {"forwarded", "x-forwarded-for", "x-forwarded-host", "x-forwarded-proto"}
+)
+_TOKEN = re.compile(r"^[!#$%&'*+\-.^_`|~0-9A-Za-z]+$")
+
+
+class HeaderPipeline:
+    """
+    Headers forwarded by a proxy route, from the client to the upstream and back.
+
+    Request headers are filtered by the optional `allow` list, then by the `deny` list,
+    to which the hop-by-hop headers, the ones listed in Connection, and the session
+    headers (Authorization, X-Userinfo) always belong. Response headers are filtered
+    the same way with `response_deny`.
+    With `forwarded`, the client address is appended to the X-Forwarded-For and
+    Forwarded headers, and X-Forwarded-Proto and X-Forwarded-Host are set unless a
+    proxy in front already did.
+
+    The sets are built once per route, and the outgoing headers are built in a single
+    pass as a list of (name, value) pairs. requests only takes a mapping of request
+    headers, see join_repeated_headers for the repeated ones.
+    """
+
+    def __init__(self, allow=None, deny=None, response_deny=None, forwarded=True):
+        self.allow = frozenset(header.lower() for header in allow) if allow else None
+        self.deny = (
+            HOP_BY_HOP_HEADERS
+            | SESSION_HEADERS
+            | {header.lower() for header in deny or []}
+        )
+        self.response_deny = HOP_BY_HOP_HEADERS | {
+            header.lower() for header in response_deny or []
+        }
+        self.forwarded = forwarded
+
+    @staticmethod
+    def from_dict(dictionary=None):
+        """
+        Build the pipeline of a route from its `headers` section in routes.yaml.
+        """
+        dictionary = dictionary or {}
+        return HeaderPipeline(
+            allow=dictionary.get("allow"),
+            deny=dictionary.get("deny"),
+            response_deny=dictionary.get("response_deny"),
+            forwarded=dictionary.get("forwarded", True),
+        )
+
+    def request_headers(
+        self, headers, session_headers=None, remote_addr=None, scheme=None, host=None
+    ):
+        """
+        Headers to send to the upstream, from the (name, value) pairs of the client
+        request and the headers of the session.
+        `remote_addr`, `scheme` and `host` describe the client request, for the
+        forwarded headers.
+        """
+        forwarded_headers = []
+        connection = None
+        upstream_headers = []
+        allow, deny = self.allow, self.deny
+        for name, value in headers:
+            lower_name = name.lower()
+            if lower_name in deny:
+                if lower_name == "connection":
+                    connection = value
+                elif lower_name in SESSION_HEADERS:
+                    _logger.warning(f"Possible fraud: {name} header was set to {value}")
+                continue
+            if self.forwarded and lower_name in FORWARDED_HEADERS:
+                forwarded_headers.append((lower_name, name, value))
+            elif allow is None or lower_name in allow:
+                upstream_headers.append((name, value))
+        if connection:
+            upstream_headers = strip_connection_headers(upstream_headers, connection)
+        if self.forwarded:
+            upstream_headers.extend(
+                get_forwarded_headers(forwarded_headers, remote_addr, scheme, host)
+            )
+        if session_headers:
+            upstream_headers.extend(session_headers.items())
+        return upstream_headers
+
+    def response_headers(self, headers):
+        """
+        Headers to send back to the client, from the (name, value) pairs of the
+        upstream response.
+        """
+        connection = None
+        client_headers = []
+        deny = self.response_deny
+        for name, value in headers:
+            lower_name = name.lower()
+            if lower_name in deny:
+                if lower_name == "connection":
+                    connection = value
+                continue
+            client_headers.append((name, value))
+        if connection:
+            client_headers = strip_connection_headers(client_headers, connection)
+        return client_headers
+
+
+def strip_connection_headers(headers, connection):
+    """
+    Remove the headers listed in the Connection header, hop-by-hop as well.
+    """
+    listed = {token.strip().lower() for token in connection.split(",")}
+    return [(name, value) for name, value in headers if name.lower() not in listed]
+
+
+def join_repeated_headers(headers):
+    """
+    Mapping of the (name, value) pairs, as requests takes them. The values of a
+    repeated header (compared case-insensitively) are joined into one, with commas
+    (RFC 7230, section 3.2.2), or semicolons for Cookie.
+    """
+    names = {}
+    values = {}
+    for name, value in headers:
+        lower_name = name.lower()
+        if lower_name in values:
+            separator = "; " if lower_name == "cookie" else ", "
+            values[lower_name] = f"{values[lower_name]}{separator}{value}"
+        else:
+            names[lower_name] = name
+            values[lower_name] = value
+    return {names[lower_name]: value for lower_name, value in values.items()}
+
+
+def get_forwarded_headers(incoming, remote_addr, scheme, host):
+    """
+    Forwarded headers of the upstream request, from the ones of the client request
+    given as (lower name, name, value).
+    """
+    headers = []
+    forwarded_for = forwarded = None
+    for lower_name, name, value in incoming:
+        if lower_name == "x-forwarded-for":
+            forwarded_for = join_values(forwarded_for, value)
+        elif lower_name == "forwarded":
+            forwarded = join_values(forwarded, value)
+        else:
+            headers.append((name, value))
+    element = get_forwarded_element(remote_addr, scheme, host)
+    if forwarded_for or remote_addr:
+        headers.append(("X-Forwarded-For", join_values(forwarded_for, remote_addr)))
+    if forwarded or element:
+        headers.append(("Forwarded", join_values(forwarded, element)))
+    present = {lower_name for lower_name, _, _ in incoming}
+    if scheme and "x-forwarded-proto" not in present:
+        headers.append(("X-Forwarded-Proto", scheme))
+    if host and "x-forwarded-host" not in present:
+        headers.append(("X-Forwarded-Host", host))
+    return headers
+
+
+def get_forwarded_element(remote_addr, scheme, host):
+    """
+    Forwarded element (RFC 7239) of the client request.
+    """
+    pairs = []
+    if remote_addr:
+        pairs.append(("for", f"[{remote_addr}]" if ":" in remote_addr else remote_addr))
+    if host:
+        pairs.append(("host", host))
+    if scheme:
+        pairs.append(("proto", scheme))
+    return ";".join(
+        f"{key}={value}" if _TOKEN.match(value) else f'{key}="{value}"'
+        for key, value in pairs
+    )
+
+
+def join_values(*values):
+    return ", ".join(value for value in values if value)
@@ -0,0 +1,379 @@
+import atexit
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from pathlib import Path
+
+from app import settings
+
+_logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+REDIS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+class Metric:
+    """
+    Series of a metric, one per combination of label values.
+    Recording a value costs a lock and a dict update.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                [list(labels), self._copy(value)]
+                for labels, value in self._values.items()
+            ]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def merge(total, value):
+        return total + value
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge summed over the processes, the ones that exited excluded.
+    """
+
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Histogram of the values in `buckets` (upper bounds), stored per series as the
+    count of each bucket (not cumulative) followed by the sum of the values.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, labels, value):
+        count = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), value):
+            count += bucket_count
+            le = "+Inf" if bound == math.inf else format_value(bound)
+            yield f"{self.name}_bucket", labels + [("le", le)], count
+        yield f"{self.name}_sum", labels, value[-1]
+        yield f"{self.name}_count", labels, count
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class MetricsRegistry:
+    """
+    Metrics of the application, exposed in the Prometheus text format.
+
+    With several worker processes (gunicorn), each process writes a snapshot of its
+    metrics to `directory` every `flush_interval` seconds and when it exits, and the
+    exposition sums the snapshots of all the processes, so that any worker can answer
+    a scrape. The gauges of the processes that exited are left out. The directory is
+    expected to be emptied when the server starts.
+    """
+
+    def __init__(self, directory=None, flush_interval=None):
+        self.directory = directory
+        self.flush_interval = flush_interval or settings.METRICS_FLUSH_INTERVAL
+        self.metrics = {}
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def start(self):
+        """
+        Flush the metrics in the background, once per process: the thread does not
+        survive the fork of the gunicorn workers.
+        """
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            if self._flusher_pid is None:
+                atexit.register(self.flush)
+                os.register_at_fork(after_in_child=self._after_fork)
+            Path(self.directory).mkdir(parents=True, exist_ok=True)
+            threading.Thread(target=self._flush_forever, daemon=True).start()
+            self._flusher_pid = os.getpid()
+
+    def _after_fork(self):
+        # The values recorded by the parent are its own
+        self._lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric._lock = threading.Lock()
+            metric.clear()
+        if self._flusher_pid is not None:
+            self.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                _logger.warning(f"Could not write the metrics: {exc}")
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def get_path(self, pid=None):
+        return Path(self.directory) / f"metrics-{pid or os.getpid()}.json"
+
+    def flush(self):
+        if not self.directory:
+            return
+        path = self.get_path()
+        temporary_path = path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(self.snapshot()))
+        os.replace(temporary_path, path)
+
+    def read_snapshots(self):
+        """
+        Snapshots of the other processes, and whether they are still running.
+        """
+        own_path = self.get_path()
+        for path in Path(self.directory).glob("metrics-*.json"):
+            if path == own_path:
+                continue
+            try:
+                snapshot = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            yield snapshot, is_running(int(path.stem.split("-", 1)[1]))
+
+    def collect(self):
+        """
+        Values of the series of each metric, summed over the processes.
+        """
+        snapshots = [(self.snapshot(), True)]
+        if self.directory:
+            snapshots.extend(self.read_snapshots())
+        values = {name: {} for name in self.metrics}
+        for snapshot, running in snapshots:
+            for name, series in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.type == "gauge" and not running):
+                    continue
+                for labels, value in series:
+                    labels = tuple(labels)
+                    total = values[name].get(labels)
+                    values[name][labels] = (
+                        value if total is None else metric.merge(total, value)
+                    )
+        return values
+
+    def render(self):
+        lines = []
+        for name, series in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(series.items()):
+                pairs = list(zip(metric.labels, labels))
+                for sample_name, sample_labels, sample_value in metric.samples(
+                    pairs, value
+                ):
+                    lines.append(
+                        f"{sample_name}{format_labels(sample_labels)} "
+                        f"{format_value(sample_value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    labels = ",".join(f'{name}="{escape(str(value))}"' for name, value in pairs)
+    return "{" + labels + "}"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def get_status_class(status):
+    return f"{status // 100}xx"
+
+
+class RequestTracker:
+    """
+    Count a proxied request in flight until it is finished, then count it and record
+    its duration by status class.
+    """
+
+    __slots__ = ("route", "method", "start", "finished")
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.start = time.perf_counter()
+        self.finished = False
+        proxy_requests_in_flight.inc(route)
+
+    def finish(self, status):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self.start
+        status_class = get_status_class(status)
+        proxy_requests_in_flight.dec(self.route)
+        proxy_requests.inc(self.route, self.method, status_class)
+        proxy_request_duration.observe(duration, self.route, self.method, status_class)
+
+
+registry = MetricsRegistry(settings.METRICS_DIR)
+proxy_requests = registry.counter(
+    "pyopenid_proxy_requests_total",
+    "Proxied requests.",
+    ("route", "method", "status"),
+)
+proxy_requests_in_flight = registry.gauge(
+    "pyopenid_proxy_requests_in_flight", "Proxied requests in flight.", ("route",)
+)
+proxy_request_duration = registry.histogram(
+    "pyopenid_proxy_request_duration_seconds",
+    "Duration of the proxied requests, until their response is sent.",
+    ("route", "method", "status"),
+)
+proxy_phase_duration = registry.histogram(
+    "pyopenid_proxy_phase_duration_seconds",
+    "Duration of the phases of the proxied requests: session (lookup, token "
+    "decoding and refresh) and upstream (until the response headers).",
+    ("route", "phase"),
+)
+redis_session_lookup_duration = registry.histogram(
+    "pyopenid_proxy_redis_session_lookup_duration_seconds",
+    "Duration of the session lookups in redis.",
+    buckets=REDIS_BUCKETS,
+)
+token_cache_hits = registry.counter(
+    "pyopenid_proxy_token_cache_hits_total", "Tokens found in the token cache."
+)
+token_cache_misses = registry.counter(
+    "pyopenid_proxy_token_cache_misses_total", "Tokens not found in the token cache."
+)
+jwks_fetches = registry.counter(
+    "pyopenid_proxy_jwks_fetches_total", "JWKS fetched from the identity provider."
+)
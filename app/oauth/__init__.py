@@ -30,7 +30,7 @@ def init_app(app):
             api_base_url=settings.OAUTH_BASE_URL,
             access_token_url=settings.OAUTH_BASE_URL + "/oauth/token",
             authorize_url=settings.OAUTH_BASE_URL + "/authorize",
-            client_kwargs={"scope": "openid profile"},
+            client_kwargs={"scope": settings.OAUTH_SCOPE},
             client_cls=Auth0Client,
         )
 
@@ -20,6 +20,12 @@ from .token_decoders import SimpleTokenDecoder, JWKSTokenDecoder
 _logger = logging.getLogger(__name__)
 
 
+class InvalidRefreshToken(Exception):
+    """
+    The refresh token was rejected by the provider (revoked or expired).
+    """
+
+
 class BaseClient(abc.ABC, OAuthClient):
     token_decoder = None
 
@@ -50,6 +56,14 @@ class BaseClient(abc.ABC, OAuthClient):
     def delete_user(self):
         pass
 
+    @abc.abstractmethod
+    def refresh_access_token(self, refresh_token):
+        """
+        Exchange the refresh token for new tokens.
+        Raise InvalidRefreshToken if the provider rejects it.
+        """
+        pass
+
 
 class MockClient(BaseClient):
     token_decoder = SimpleTokenDecoder(RS256_PUBLIC)
@@ -85,12 +99,18 @@ class MockClient(BaseClient):
             "expires_at": math.floor(time.time()) + expiration_seconds,
             "expires_in": expiration_seconds,
             "id_token": ID_TOKEN,
-            "scope": "openid profile",
+            "refresh_token": uuid.uuid4().hex,
+            "scope": "openid profile offline_access",
             "token_type": "Bearer",
         }
         _logger.debug("authorize_access_token, values %s", token)
         return token
 
+    def refresh_access_token(self, refresh_token):
+        token = self.authorize_access_token()
+        _logger.debug("refresh_access_token, values %s", token)
+        return token
+
 
 class Auth0Client(BaseClient, RemoteApp):
     token_decoder = JWKSTokenDecoder(settings.OAUTH_JWKS_URL)
@@ -130,6 +150,28 @@ class Auth0Client(BaseClient, RemoteApp):
         json_response = res.json()
         return json_response
 
+    def refresh_access_token(self, refresh_token):
+        res = requests.post(
+            self.access_token_url,
+            data={
+                "grant_type": "refresh_token",
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "refresh_token": refresh_token,
+            },
+            timeout=settings.TOKEN_REFRESH_TIMEOUT,
+        )
+        if res.status_code in (400, 401, 403):
+            raise InvalidRefreshToken(f"Refresh token rejected: {res.status_code}")
+        if res.status_code != 200:
+            raise Exception(f"Could not refresh the access token: {res.status_code}")
+
+        token = res.json()
+        # The refresh token is only returned when it is rotated
+        token.setdefault("refresh_token", refresh_token)
+        token["expires_at"] = math.floor(time.time()) + token.get("expires_in", 0)
+        return token
+
     def logout(self):
         redirect_url = request.args.get("redirect_url")
         if not redirect_url:
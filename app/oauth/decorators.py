@@ -4,8 +4,8 @@ from functools import wraps
 from flask import redirect
 
 from app.oauth import get_client
+from app import api
 from app import settings
-from .utils import get_session_data_or_none
 
 _logger = logging.getLogger(__name__)
 
@@ -13,17 +13,17 @@ _logger = logging.getLogger(__name__)
 def requires_auth(f):
     """
     Decorator that verifies the request can go through.
-    Check the session_id (client-side) and get the access_token from it (server-side).
+    Check the session_id (client-side) and get the access_token from it (server-side),
+    refreshed when it is about to expire.
     Verify that the access token is valid.
     """
 
     @wraps(f)
     def decorated(*args, **kwargs):
-        session_data = get_session_data_or_none()
+        session_data = api.get_session_data()
         if not session_data:
             return redirect(settings.REDIRECT_LOGIN_URL)
         access_token = session_data.get("access_token")
-        # TODO: handle token expiration/refresh ?
         decoded = get_client().token_decoder.decode_token(
             access_token, audience=settings.OAUTH_AUDIENCE
         )
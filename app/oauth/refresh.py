@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+
+from app import settings
+from app.coalescing import Flight
+from app.oauth import get_client
+from app.oauth.clients import InvalidRefreshToken
+from app.redis_clients import create_redis, is_redis_enabled
+from app.session import session as server_session
+
+_logger = logging.getLogger(__name__)
+
+# Release the refresh lock only if it still holds the token of the worker that took
+# it: once expired, it may have been taken by another worker in the meantime.
+UNLOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def get_session_lifetime(tokens, default=None):
+    """
+    Seconds the server-side session of `tokens` is kept: as long as its refresh
+    token if any, otherwise until the access token expires.
+    """
+    if tokens.get("refresh_token"):
+        return settings.REFRESH_SESSION_LIFETIME
+    return tokens.get("expires_in", default)
+
+
+class TokenRefresher:
+    """
+    Refresh the access token of the sessions holding a refresh token, `window`
+    seconds before it expires, instead of letting the user go through /login again.
+
+    Refreshes are single-flight per session: the concurrent requests of a worker
+    wait for the refresh in progress, and with redis a lock keeps the other workers
+    from refreshing the same session in the meantime (they keep using the current
+    access token, still valid for a little while). The lock expires on its own, and is
+    only released by the worker that took it.
+    The new tokens replace the session as a whole, along with the headers derived
+    from them by `build_payload`. A session whose refresh token is rejected is
+    destroyed.
+    """
+
+    def __init__(self, build_payload, window=None, timeout=None, redis=None):
+        self.build_payload = build_payload
+        self.window = settings.TOKEN_REFRESH_WINDOW if window is None else window
+        self.timeout = timeout or settings.TOKEN_REFRESH_TIMEOUT
+        self.redis = redis
+        self.refreshes = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._unlock_script = None
+
+    def get_redis(self):
+        if self.redis is None and is_redis_enabled():
+            self.redis = create_redis()
+        return self.redis
+
+    def get_unlock_script(self):
+        if self._unlock_script is None:
+            self._unlock_script = self.get_redis().register_script(UNLOCK_SCRIPT)
+        return self._unlock_script
+
+    def needs_refresh(self, session_data):
+        if not session_data or not session_data.get("refresh_token"):
+            return False
+        expires_at = float(session_data.get("expires_at") or 0)
+        return expires_at - time.time() < self.window
+
+    def refresh(self, session_id, session_data):
+        """
+        Refresh the tokens of the session, once for all the concurrent calls, and
+        return the updated session data, or None if the session was destroyed.
+        """
+        with self._lock:
+            flight = self._flights.get(session_id)
+            leader = flight is None
+            if leader:
+                flight = self._flights[session_id] = Flight()
+
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                return session_data
+            return flight.result
+
+        flight.result = session_data
+        try:
+            flight.result = self._refresh(session_id, session_data)
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[session_id]
+            flight.done.set()
+
+    async def refresh_async(self, session_id, session_data):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.refresh, session_id, session_data)
+
+    def _refresh(self, session_id, session_data):
+        lock = f"token-refresh:{session_id}"
+        token = uuid.uuid4().hex
+        redis = self.get_redis()
+        try:
+            if redis is not None and not redis.set(
+                lock, token, nx=True, px=int(self.timeout * 2000)
+            ):
+                _logger.debug(f"Session {session_id} is refreshed by another worker")
+                return session_data
+        except Exception as exc:
+            _logger.warning(f"Could not lock the refresh of the session: {exc}")
+            return session_data
+
+        try:
+            # Another worker may have refreshed the session since it was read
+            current = server_session.get(session_id)
+            if not current:
+                return None
+            if not self.needs_refresh(current):
+                return current
+            return self._update(session_id, current)
+        finally:
+            if redis is not None:
+                try:
+                    self.get_unlock_script()(keys=[lock], args=[token])
+                except Exception as exc:
+                    _logger.warning(f"Could not unlock the session refresh: {exc}")
+
+    def _update(self, session_id, session_data):
+        try:
+            new_tokens = get_client().refresh_access_token(
+                session_data["refresh_token"]
+            )
+            tokens = dict(session_data)
+            tokens.update(new_tokens)
+            # Decodes the new id token, which may be invalid as well
+            payload = self.build_payload(tokens)
+        except InvalidRefreshToken as exc:
+            _logger.info(f"Destroying session {session_id}: {exc}")
+            server_session.destroy_session(session_id)
+            return None
+        except Exception as exc:
+            _logger.warning(f"Could not refresh the tokens of the session: {exc}")
+            return session_data
+
+        server_session.update_session(
+            session_id, payload, expire_seconds=get_session_lifetime(tokens)
+        )
+        with self._lock:
+            self.refreshes += 1
+        _logger.debug(f"Refreshed the tokens of session {session_id}")
+        return payload
@@ -1,7 +1,18 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
 from jose import jwt
 import requests
 
 from app import settings
+from app.metrics import jwks_fetches, token_cache_hits, token_cache_misses
 from app.errors import (
     AppError,
     ERROR_TOKEN_EXPIRED,
@@ -10,14 +21,103 @@ from app.errors import (
     ERROR_JWKS_KEY_NOT_FOUND,
 )
 
+_logger = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of the claims of already verified tokens.
+    Entries are keyed by a digest of the token, the audience it was verified
+    against and the thumbprint of the key given to verify it if any, and expire with
+    the token itself (its exp claim).
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token, audience=None, key=None):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).digest(), audience, get_key_thumbprint(key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    token_cache_hits.inc()
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            token_cache_misses.inc()
+            return None
+
+    def set(self, key, payload, expires_at):
+        if not self.max_size or not expires_at:
+            return
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_key_thumbprint(key):
+    """
+    Digest identifying a verification key (PEM, secret, or JWK dict), or None.
+    """
+    if key is None:
+        return None
+    if isinstance(key, dict):
+        key = json.dumps(key, sort_keys=True)
+    elif not isinstance(key, (str, bytes)):
+        key = repr(key)
+    if isinstance(key, str):
+        key = key.encode()
+    return hashlib.sha256(key).digest()
+
 
 class TokenDecoder:
+    def __init__(self, cache_size=None):
+        if cache_size is None:
+            cache_size = settings.TOKEN_CACHE_SIZE
+        self.cache = TokenCache(cache_size)
+
+    def get_key(self, token):
+        """
+        Return the key used to verify the signature of the specified token.
+        """
+        return None
+
     def decode_token(self, token, key=None, audience=None):
         """
         Decode the specified token.
         The audience has to match the token's audience.
+        Tokens already verified for this audience, and key if given, are served from
+        the cache until they expire.
         """
-        payload = None
+        cache_key = self.cache.key(token, audience, key)
+        payload = self.cache.get(cache_key)
+        if payload is not None:
+            return dict(payload)
+
+        if key is None:
+            key = self.get_key(token)
         try:
             payload = jwt.decode(
                 token,
@@ -26,58 +126,156 @@ class TokenDecoder:
                 audience=audience,
                 issuer=settings.OAUTH_BASE_URL + "/",
             )
-            return payload
         except jwt.ExpiredSignatureError:
             raise AppError(ERROR_TOKEN_EXPIRED)
         except jwt.JWTClaimsError:
             raise AppError(ERROR_TOKEN_CLAIMS)
         except jwt.JWTError:
             raise AppError(ERROR_TOKEN_SIGNATURE)
+        self.cache.set(cache_key, payload, payload.get("exp"))
+        return dict(payload)
+
+    async def decode_token_async(self, token, audience=None):
+        """
+        Decode the specified token from a coroutine.
+        Cached tokens are returned right away, the others are verified in the default
+        executor so that the signature check (and JWKS fetch) does not block the
+        event loop.
+        """
+        payload = self.cache.get(self.cache.key(token, audience))
+        if payload is not None:
+            return dict(payload)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.decode_token, token, audience=audience)
+        )
 
 
 class SimpleTokenDecoder(TokenDecoder):
-    def __init__(self, key):
+    def __init__(self, key, **kwargs):
+        super().__init__(**kwargs)
         self.key = key
 
-    def decode_token(self, token, **kwargs):
-        """
-        Decode the specified token.
-        The audience has to match the token's audience.
-        """
-        return super().decode_token(token, self.key, **kwargs)
+    def get_key(self, token):
+        return self.key
 
 
 class JWKSTokenDecoder(TokenDecoder):
+    """
+    Token decoder verifying the tokens with the keys published by the identity
+    provider in its JWKS.
+
+    The keys are indexed by kid once per fetch of the JWKS, which is refreshed when
+    older than `ttl` seconds, or when a token is signed with an unknown kid (key
+    rotation), at most once every `min_refresh_interval` seconds. Failed fetches are
+    not retried sooner either: without keys yet, the error of the last fetch is raised
+    again until then.
+    Only one thread fetches the JWKS at a time: the others keep using the current
+    keys, or wait for the first fetch to complete.
+    """
+
     jwks = None
 
-    def __init__(self, jwks_url):
+    def __init__(self, jwks_url, ttl=None, min_refresh_interval=None, **kwargs):
+        super().__init__(**kwargs)
         self.jwks_url = jwks_url
+        self.ttl = settings.JWKS_TTL if ttl is None else ttl
+        self.min_refresh_interval = (
+            settings.JWKS_MIN_REFRESH_INTERVAL
+            if min_refresh_interval is None
+            else min_refresh_interval
+        )
+        self.keys = {}
+        self.fetch_count = 0
+        self._fetched_at = None
+        self._attempted_at = -math.inf
+        self._fetch_error = None
+        self._lock = threading.Lock()
+
+    def fetch_jwks(self):
+        resp = requests.get(self.jwks_url, timeout=settings.JWKS_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+    @staticmethod
+    def index_keys(jwks):
+        """
+        Map the kid (key id) of each key of the JWKS to the key itself.
+        """
+        keys = {}
+        for key in jwks.get("keys", []):
+            if "kid" not in key:
+                continue
+            keys[key["kid"]] = {
+                "kty": key.get("kty"),
+                "kid": key["kid"],
+                "use": key.get("use"),
+                "n": key.get("n"),
+                "e": key.get("e"),
+            }
+        return keys
+
+    def get_age(self):
+        if self._fetched_at is None:
+            return math.inf
+        return time.monotonic() - self._fetched_at
+
+    def refresh(self, max_age, blocking=True):
+        """
+        Fetch the JWKS again if the current one is older than max_age seconds.
+        Without blocking, return right away if another thread is already fetching it.
+        """
+        if not self._lock.acquire(blocking):
+            return
+        try:
+            # Another thread may have refreshed the keys while we were waiting
+            if self.get_age() < max_age:
+                return
+            # Do not hammer the identity provider if the last attempt failed
+            now = time.monotonic()
+            if now - self._attempted_at < self.min_refresh_interval:
+                if not self.keys and self._fetch_error is not None:
+                    raise self._fetch_error.with_traceback(None)
+                return
+            self._attempted_at = now
+            try:
+                jwks = self.fetch_jwks()
+            except Exception as exc:
+                if not self.keys:
+                    self._fetch_error = exc
+                    raise
+                _logger.warning(f"Could not refresh JWKS, keeping current keys: {exc}")
+                return
+            self._fetch_error = None
+            self.jwks = jwks
+            self.keys = self.index_keys(jwks)
+            self._fetched_at = time.monotonic()
+            self.fetch_count += 1
+            jwks_fetches.inc()
+            _logger.debug(f"Fetched JWKS with keys {list(self.keys)}")
+        finally:
+            self._lock.release()
 
     def get_jwks(self):
-        if not self.jwks:
-            resp = requests.get(self.jwks_url)
-            self.jwks = resp.json()
+        if self.get_age() >= self.ttl:
+            self.refresh(self.ttl)
         return self.jwks
 
     def get_key_from_jwks(self, token):
         """
-        Iterate on the keys from the JWKS to find the one matching the token header's kid
-        (key id).
+        Return the key from the JWKS matching the token header's kid (key id).
         """
-        jwks = self.get_jwks()
-        unverified_header = jwt.get_unverified_header(token)
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"],
-                }
-                return rsa_key
-        raise AppError(ERROR_JWKS_KEY_NOT_FOUND)
-
-    def decode_token(self, token, **kwargs):
-        key = self.get_key_from_jwks(token)
-        return super().decode_token(token, key, **kwargs)
+        kid = jwt.get_unverified_header(token).get("kid")
+        if self.get_age() >= self.ttl:
+            # Serve the current keys while another thread refreshes them
+            self.refresh(self.ttl, blocking=not self.keys)
+        key = self.keys.get(kid)
+        if key is None and self.get_age() >= self.min_refresh_interval:
+            self.refresh(self.min_refresh_interval)
+            key = self.keys.get(kid)
+        if key is None:
+            raise AppError(ERROR_JWKS_KEY_NOT_FOUND)
+        return key
+
+    def get_key(self, token):
+        return self.get_key_from_jwks(token)
@@ -1,19 +1,225 @@
+from app import settings
+from app.balancers import UpstreamBalancer
+from app.coalescing import RequestCoalescer
+from app.compression import ResponseCompressor
+from app.headers import HeaderPipeline
+from app.rate_limits import RateLimiter
+from app.retries import RetryPolicy
+from app.response_cache import ResponseCache
+from app.upstreams import UpstreamPool
+
+PROXY_METHODS = ["GET", "HEAD", "OPTIONS", "POST", "PUT", "DELETE", "PATCH"]
+
+
 class ProxyRoute:
-    def __init__(self, name, path, upstream):
+    def __init__(
+        self,
+        name,
+        path,
+        upstream,
+        pool=None,
+        chunk_size=None,
+        methods=None,
+        host=None,
+        balancer=None,
+        cache=None,
+        coalescer=None,
+        compressor=None,
+        header_pipeline=None,
+        retry=None,
+        rate_limiter=None,
+    ):
         self.name = name
         self.path = path
+        # Url of the upstream, or list of the urls of its replicas
         self.upstream = upstream
+        self.balancer = balancer or UpstreamBalancer(upstream)
+        self.pool = pool or UpstreamPool()
+        self.chunk_size = chunk_size or settings.PROXY_CHUNK_SIZE
+        self.methods = {method.upper() for method in methods} if methods else None
+        self.host = host.lower() if host else None
+        # Optional ResponseCache of the GET requests
+        self.cache = cache
+        # Optional RequestCoalescer of the GET requests
+        self.coalescer = coalescer
+        # Optional ResponseCompressor of the responses
+        self.compressor = compressor
+        # Headers forwarded to the upstream and back
+        self.header_pipeline = header_pipeline or HeaderPipeline()
+        self.retry = retry or RetryPolicy()
+        # Optional RateLimiter of the requests
+        self.rate_limiter = rate_limiter
+
+    @property
+    def prefix(self):
+        """
+        Path of the route without its trailing slash, "" for a route on "/".
+        """
+        return self.path.rstrip("/")
+
+    def accepts(self, method, host):
+        """
+        Check the optional method and host constraints of the route.
+        OPTIONS is always accepted, to let the CORS preflight requests through.
+        """
+        if self.methods and method not in self.methods and method != "OPTIONS":
+            return False
+        if self.host and host and self.host != host.split(":")[0].lower():
+            return False
+        return True
 
     @staticmethod
     def from_dict(dictionary):
         return ProxyRoute(
-            dictionary.get("name"), dictionary.get("path"), dictionary.get("upstream")
+            dictionary.get("name"),
+            dictionary.get("path"),
+            dictionary.get("upstream"),
+            pool=UpstreamPool.from_dict(
+                dictionary.get("pool"), dictionary.get("timeout")
+            ),
+            chunk_size=dictionary.get("chunk_size"),
+            methods=dictionary.get("methods"),
+            host=dictionary.get("host"),
+            balancer=UpstreamBalancer.from_dict(
+                dictionary.get("upstream"),
+                balancing=dictionary.get("balancing"),
+                outlier=dictionary.get("outlier"),
+                health_check=dictionary.get("health_check"),
+                circuit_breaker=dictionary.get("circuit_breaker"),
+            ),
+            cache=ResponseCache.from_dict(
+                dictionary.get("name"), dictionary.get("cache")
+            ),
+            coalescer=RequestCoalescer.from_dict(
+                dictionary.get("name"), dictionary.get("coalesce")
+            ),
+            compressor=ResponseCompressor.from_dict(dictionary.get("compress")),
+            header_pipeline=HeaderPipeline.from_dict(dictionary.get("headers")),
+            retry=RetryPolicy.from_dict(dictionary.get("retry")),
+            rate_limiter=RateLimiter.from_dict(
+                dictionary.get("name"), dictionary.get("rate_limits")
+            ),
         )
 
+    def close(self):
+        """
+        Drain the connections to the upstream, once the route has been replaced.
+        Idle connections are closed, the ones still in use are closed when released.
+        """
+        self.balancer.close()
+        self.pool.close()
+
     def __repr__(self):
         return (
             f"<ProxyRoute name={self.name} path={self.path} upstream={self.upstream}>"
         )
 
 
-proxy_routes = {}
+class ProxyRouterNode:
+    __slots__ = ("children", "routes")
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+
+    def find(self, method, host):
+        for route in self.routes:
+            if route.accepts(method, host):
+                return route
+        return None
+
+
+class ProxyRouter:
+    """
+    Dispatch the proxied requests to their route with a trie of the path segments of
+    the routes, built once when the routes are loaded.
+
+    Matching costs one dict lookup per segment of the request path, whatever the
+    number of routes, instead of trying the rules of the url map one after the other.
+    The route with the longest path accepting the method and host of the request wins.
+    Routes sharing the same path are tried in their declaration order.
+
+    A router is not modified once built: reloading the routes builds a new one.
+    """
+
+    def __init__(self, routes=None):
+        self.root = ProxyRouterNode()
+        self.routes = {}
+        for route in routes or []:
+            self.add(route)
+
+    def add(self, route):
+        node = self.root
+        for segment in split_path(route.prefix):
+            node = node.children.setdefault(segment, ProxyRouterNode())
+        node.routes.append(route)
+        self.routes[route.name] = route
+
+    def match(self, path, method=None, host=None):
+        """
+        Return the route matching the request, and the rest of the path to forward
+        to its upstream, or (None, None).
+
+        As with the former "<path>/<path:path>" rules, the rest of the path
+        must not be empty: "/api" and "/api/" do not match the route on "/api".
+        """
+        segments = split_path(path)
+        last = len(segments) - 1
+        node = self.root
+        best, best_depth = None, 0
+        for depth, segment in enumerate(segments):
+            if node.routes and (depth < last or segment):
+                route = node.find(method, host)
+                if route:
+                    best, best_depth = route, depth
+            node = node.children.get(segment)
+            if node is None:
+                break
+        if best is None:
+            return None, None
+        return best, "/".join(segments[best_depth:])
+
+    def __len__(self):
+        return len(self.routes)
+
+
+def split_path(path):
+    """
+    "/api/v1/users" -> ["api", "v1", "users"], "" -> [].
+    """
+    if path.startswith("/"):
+        path = path[1:]
+    return path.split("/") if path else []
+
+
+class ReloadableProxyRouter:
+    """
+    Proxy router whose routes can be replaced while requests are served.
+
+    The current router is swapped in a single assignment: a request is dispatched with
+    the router it read, and keeps its route until it completes, while the next requests
+    use the new routes.
+    """
+
+    def __init__(self, router=None):
+        self.router = router or ProxyRouter()
+
+    @property
+    def routes(self):
+        return self.router.routes
+
+    def match(self, path, method=None, host=None):
+        return self.router.match(path, method, host)
+
+    def swap(self, router):
+        """
+        Replace the current router, and return the previous one.
+        """
+        previous, self.router = self.router, router
+        return previous
+
+    def __len__(self):
+        return len(self.router)
+
+
+proxy_router = ReloadableProxyRouter()
@@ -0,0 +1,298 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from app import settings
+from app.redis_clients import create_redis
+
+_logger = logging.getLogger(__name__)
+
+SUBJECT_KEY = "subject"
+IP_KEY = "ip"
+ROUTE_KEY = "route"
+RATE_LIMIT_KEYS = (SUBJECT_KEY, IP_KEY, ROUTE_KEY)
+MEMORY_STORE = "memory"
+REDIS_STORE = "redis"
+
+# GCRA in a single atomic step: the key holds the theoretical arrival time (TAT) of
+# the next request. ARGV: emission interval, burst tolerance and now, in seconds.
+# Returns the number of seconds to wait, as a string (lua numbers are truncated to
+# integers in replies), "0" when the request is allowed.
+GCRA_SCRIPT = """
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tat = tonumber(redis.call("GET", KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local allow_at = new_tat - tolerance
+if now < allow_at then
+    return tostring(allow_at - now)
+end
+redis.call("SET", KEYS[1], tostring(new_tat), "PX", math.ceil((new_tat - now) * 1000))
+return "0"
+"""
+
+
+def gcra(tat, now, interval, tolerance):
+    """
+    Generic cell rate algorithm: return the new theoretical arrival time if the
+    request is allowed, or None, and the number of seconds to wait before retrying.
+    """
+    tat = max(tat or now, now)
+    new_tat = tat + interval
+    allow_at = new_tat - tolerance
+    if now < allow_at:
+        return None, allow_at - now
+    return new_tat, 0
+
+
+class MemoryRateLimitStore:
+    """
+    Rate limit states of a worker, for single nodes: each worker enforces the limits
+    on its own requests.
+    Bounded to `max_keys` keys, the least recently used ones being dropped.
+    """
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys or settings.RATE_LIMIT_MAX_KEYS
+        self._tats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, interval, tolerance):
+        """
+        Count a request, and return the number of seconds to wait before retrying,
+        0 if it is allowed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            new_tat, retry_after = gcra(self._tats.get(key), now, interval, tolerance)
+            if new_tat is not None:
+                self._tats[key] = new_tat
+                self._tats.move_to_end(key)
+                if len(self._tats) > self.max_keys:
+                    self._tats.popitem(last=False)
+            return retry_after
+
+    async def hit_async(self, key, interval, tolerance):
+        return self.hit(key, interval, tolerance)
+
+    def peek(self, key, interval, tolerance):
+        """
+        Return the number of seconds to wait before a request is allowed, 0 if it is,
+        without counting it.
+        """
+        with self._lock:
+            tat = self._tats.get(key)
+        return gcra(tat, time.monotonic(), interval, tolerance)[1]
+
+    async def peek_async(self, key, interval, tolerance):
+        return self.peek(key, interval, tolerance)
+
+    def __len__(self):
+        return len(self._tats)
+
+
+class RedisRateLimitStore:
+    """
+    Rate limit states shared by the workers and nodes in redis, updated atomically
+    by a lua script. The clocks of the nodes are expected to be synchronized.
+    Requests are let through when redis can not be reached.
+    """
+
+    _redis = None
+    _async_redis = None
+
+    def __init__(self, redis=None, async_redis=None, prefix="ratelimit:"):
+        self.redis = redis
+        self.async_redis = async_redis
+        self.prefix = prefix
+        self._script = None
+        self._async_script = None
+
+    @classmethod
+    def get_redis(cls, asynchronous=False):
+        # Clients shared by the rate limits of all the routes
+        if asynchronous:
+            if cls._async_redis is None:
+                cls._async_redis = create_redis(asynchronous=True)
+            return cls._async_redis
+        if cls._redis is None:
+            cls._redis = create_redis()
+        return cls._redis
+
+    def get_script(self):
+        if self._script is None:
+            redis = self.redis or RedisRateLimitStore.get_redis()
+            self._script = redis.register_script(GCRA_SCRIPT)
+        return self._script
+
+    def get_async_script(self):
+        if self._async_script is None:
+            redis = self.async_redis or RedisRateLimitStore.get_redis(True)
+            self._async_script = redis.register_script(GCRA_SCRIPT)
+        return self._async_script
+
+    def hit(self, key, interval, tolerance):
+        try:
+            retry_after = self.get_script()(
+                keys=[self.prefix + key], args=[interval, tolerance, time.time()]
+            )
+        except Exception as exc:
+            _logger.warning(f"Could not check the rate limit: {exc}")
+            return 0
+        return float(retry_after)
+
+    async def hit_async(self, key, interval, tolerance):
+        try:
+            retry_after = await self.get_async_script()(
+                keys=[self.prefix + key], args=[interval, tolerance, time.time()]
+            )
+        except Exception as exc:
+            _logger.warning(f"Could not check the rate limit: {exc}")
+            return 0
+        return float(retry_after)
+
+    def peek(self, key, interval, tolerance):
+        try:
+            tat = (self.redis or RedisRateLimitStore.get_redis()).get(self.prefix + key)
+        except Exception as exc:
+            _logger.warning(f"Could not check the rate limit: {exc}")
+            return 0
+        return gcra(tat and float(tat), time.time(), interval, tolerance)[1]
+
+    async def peek_async(self, key, interval, tolerance):
+        try:
+            redis = self.async_redis or RedisRateLimitStore.get_redis(True)
+            tat = await redis.get(self.prefix + key)
+        except Exception as exc:
+            _logger.warning(f"Could not check the rate limit: {exc}")
+            return 0
+        return gcra(tat and float(tat), time.time(), interval, tolerance)[1]
+
+
+class RateLimit:
+    """
+    Limit of `rate` requests per `period` seconds, with bursts of up to `burst`
+    requests, per `key`: the subject of the user (or the client address for
+    anonymous requests), the client address, or the whole route.
+
+    Limits follow the generic cell rate algorithm, a token bucket storing a single
+    timestamp per key: checking a request costs one lookup and update of the store.
+    """
+
+    def __init__(self, route_name, rate, period=1, burst=None, key=None, store=None):
+        self.route_name = route_name
+        self.rate = rate
+        self.period = period
+        self.burst = burst or rate
+        self.key = key or SUBJECT_KEY
+        if self.key not in RATE_LIMIT_KEYS:
+            raise ValueError(f"Unknown rate limit key {self.key}")
+        self.store = MemoryRateLimitStore() if store is None else store
+        # Time between two requests at the sustained rate, and bursts allowed
+        self.interval = period / rate
+        self.tolerance = self.interval * self.burst
+
+    @staticmethod
+    def from_dict(route_name, dictionary):
+        if dictionary.get("store", MEMORY_STORE) == REDIS_STORE:
+            store = RedisRateLimitStore()
+        else:
+            store = MemoryRateLimitStore()
+        return RateLimit(
+            route_name,
+            dictionary["rate"],
+            period=dictionary.get("period", 1),
+            burst=dictionary.get("burst"),
+            key=dictionary.get("key"),
+            store=store,
+        )
+
+    def get_key(self, subject, remote_addr):
+        if self.key == ROUTE_KEY:
+            return f"{self.route_name}:route"
+        if self.key == SUBJECT_KEY and subject:
+            return f"{self.route_name}:subject:{subject}"
+        return f"{self.route_name}:ip:{remote_addr}"
+
+    def __repr__(self):
+        return (
+            f"<RateLimit key={self.key} rate={self.rate} period={self.period} "
+            f"burst={self.burst}>"
+        )
+
+
+class RateLimiter:
+    """
+    Rate limits of a proxy route, all of them applying to each request.
+
+    With several limits, all of them are checked before the request is counted, so
+    that a request denied by one limit does not consume the others. Concurrent
+    requests may still be counted by the first limits and denied by a later one
+    between the check and the count.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+
+    @staticmethod
+    def from_dict(route_name, rate_limits):
+        """
+        Build the limiter of a route from its `rate_limits` list in routes.yaml,
+        or return None if the route is not rate limited.
+        """
+        if not rate_limits:
+            return None
+        return RateLimiter(
+            [RateLimit.from_dict(route_name, limit) for limit in rate_limits]
+        )
+
+    def check(self, subject, remote_addr):
+        """
+        Count a request, and return the number of seconds to wait before retrying
+        if a limit is exceeded, 0 otherwise.
+        """
+        keys = [limit.get_key(subject, remote_addr) for limit in self.limits]
+        if len(self.limits) > 1:
+            retry_after = max(
+                limit.store.peek(key, limit.interval, limit.tolerance)
+                for limit, key in zip(self.limits, keys)
+            )
+            if retry_after:
+                return retry_after
+        for limit, key in zip(self.limits, keys):
+            retry_after = limit.store.hit(key, limit.interval, limit.tolerance)
+            if retry_after:
+                return retry_after
+        return 0
+
+    async def check_async(self, subject, remote_addr):
+        keys = [limit.get_key(subject, remote_addr) for limit in self.limits]
+        if len(self.limits) > 1:
+            retry_after = max(
+                [
+                    await limit.store.peek_async(key, limit.interval, limit.tolerance)
+                    for limit, key in zip(self.limits, keys)
+                ]
+            )
+            if retry_after:
+                return retry_after
+        for limit, key in zip(self.limits, keys):
+            retry_after = await limit.store.hit_async(
+                key, limit.interval, limit.tolerance
+            )
+            if retry_after:
+                return retry_after
+        return 0
+
+
+def get_retry_after(retry_after):
+    """
+    Value of the Retry-After header, in whole seconds.
+    """
+    return str(max(1, math.ceil(retry_after)))
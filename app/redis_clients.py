@@ -0,0 +1,137 @@
+import redis
+import redis.asyncio
+import redis.asyncio.sentinel
+import redis.sentinel
+
+from app import settings
+
+REDIS_MODES = ("standalone", "sentinel", "cluster")
+
+
+def is_redis_enabled():
+    return bool(
+        settings.REDIS_HOST or settings.REDIS_UNIX_SOCKET or settings.REDIS_SENTINELS
+    )
+
+
+def parse_nodes(nodes):
+    """
+    Parse a comma-separated list of host:port.
+    """
+    parsed = []
+    for node in nodes.split(","):
+        host, _, port = node.strip().rpartition(":")
+        parsed.append((host, int(port)))
+    return parsed
+
+
+def get_connection_kwargs():
+    kwargs = {
+        "password": settings.REDIS_PASSWORD,
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+    }
+    if settings.REDIS_MODE != "cluster":
+        # Redis cluster only has the database 0
+        kwargs["db"] = settings.REDIS_DB
+    return kwargs
+
+
+def get_pool_kwargs():
+    """
+    Size of the connection pools, and how long to wait for a free connection when
+    the pool is blocking.
+    """
+    if settings.REDIS_BLOCKING_POOL:
+        return {
+            "max_connections": settings.REDIS_MAX_CONNECTIONS or 50,
+            "timeout": settings.REDIS_POOL_TIMEOUT,
+        }
+    return {"max_connections": settings.REDIS_MAX_CONNECTIONS}
+
+
+class BlockingSentinelConnectionPool(
+    redis.sentinel.SentinelConnectionPool, redis.BlockingConnectionPool
+):
+    """
+    Connection pool of a master discovered through sentinels, waiting for a free
+    connection instead of opening more than max_connections, as
+    BlockingConnectionPool does.
+    """
+
+    def disconnect(self, inuse_connections=True):
+        # Called without the connections in use when the master changes, which
+        # BlockingConnectionPool does not support: close the idle ones only
+        if inuse_connections:
+            return super().disconnect()
+        self._checkpid()
+        with self.pool.mutex:
+            idle = [connection for connection in self.pool.queue if connection]
+        for connection in idle:
+            connection.disconnect()
+
+
+class AsyncBlockingSentinelConnectionPool(
+    redis.asyncio.sentinel.SentinelConnectionPool, redis.asyncio.BlockingConnectionPool
+):
+    """
+    Asynchronous equivalent of BlockingSentinelConnectionPool.
+    """
+
+
+def create_redis(asynchronous=False):
+    """
+    Create the redis client used for the sessions, according to the REDIS_ settings:
+    a single node reached through a connection pool (possibly blocking when full,
+    possibly over a unix socket), a master discovered through sentinels,
+    or a redis cluster.
+    With asynchronous, create the equivalent redis.asyncio client.
+    """
+    lib = redis.asyncio if asynchronous else redis
+    kwargs = get_connection_kwargs()
+
+    if settings.REDIS_MODE == "sentinel":
+        sentinel = lib.Sentinel(
+            parse_nodes(settings.REDIS_SENTINELS),
+            sentinel_kwargs={"password": settings.REDIS_SENTINEL_PASSWORD},
+            **kwargs,
+        )
+        if not settings.REDIS_BLOCKING_POOL:
+            pool_class = lib.sentinel.SentinelConnectionPool
+        elif asynchronous:
+            pool_class = AsyncBlockingSentinelConnectionPool
+        else:
+            pool_class = BlockingSentinelConnectionPool
+        return sentinel.master_for(
+            settings.REDIS_SENTINEL_MASTER,
+            connection_pool_class=pool_class,
+            **get_pool_kwargs(),
+        )
+
+    if settings.REDIS_MODE == "cluster":
+        if settings.REDIS_MAX_CONNECTIONS:
+            kwargs["max_connections"] = settings.REDIS_MAX_CONNECTIONS
+        return lib.RedisCluster(
+            host=settings.REDIS_HOST, port=settings.REDIS_PORT, **kwargs
+        )
+
+    if settings.REDIS_MODE != "standalone":
+        raise Exception(
+            f"Unknown REDIS_MODE {settings.REDIS_MODE}, use one of {REDIS_MODES}."
+        )
+
+    if settings.REDIS_UNIX_SOCKET:
+        kwargs.update(
+            connection_class=lib.UnixDomainSocketConnection,
+            path=settings.REDIS_UNIX_SOCKET,
+        )
+    else:
+        kwargs.update(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
+
+    if settings.REDIS_BLOCKING_POOL:
+        # Wait for a free connection instead of opening more than max_connections
+        pool_class = lib.BlockingConnectionPool
+    else:
+        pool_class = lib.ConnectionPool
+    return lib.Redis(connection_pool=pool_class(**get_pool_kwargs(), **kwargs))
@@ -0,0 +1,352 @@
+import hashlib
+import json
+import logging
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from requests.structures import CaseInsensitiveDict
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import is_hop_by_hop_header, parse_cache_control_header, parse_date
+
+from app import settings
+from app.redis_clients import create_redis
+from app.streaming import parse_content_length
+
+_logger = logging.getLogger(__name__)
+
+# Statuses cacheable by default (RFC 7231, section 6.1), among the ones the upstreams
+# answer to GET requests
+CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 404, 405, 410, 414, 501}
+# Headers describing the message rather than the resource, never stored
+UNCACHED_HEADERS = {"age", "set-cookie"}
+MEMORY_STORE = "memory"
+REDIS_STORE = "redis"
+
+
+def parse_delta_seconds(value):
+    """
+    Parse a number of seconds (RFC 7234, section 1.2.1) like the Age header, returning
+    None when it is invalid.
+    """
+    value = value.strip()
+    if not value.isdigit() or not value.isascii():
+        return None
+    return int(value)
+
+
+class CachedResponse:
+    """
+    Upstream response stored in a response cache, fresh for `ttl` seconds after
+    `stored_at`.
+    """
+
+    __slots__ = ("status", "headers", "body", "stored_at", "ttl")
+
+    def __init__(self, status, headers, body, stored_at, ttl):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.ttl = ttl
+
+    @property
+    def etag(self):
+        for name, value in self.headers:
+            if name.lower() == "etag":
+                return value
+        return None
+
+    def get_age(self, now=None):
+        return max(0, int((now or time.time()) - self.stored_at))
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.stored_at + self.ttl
+
+    @staticmethod
+    def from_upstream(status, headers, body, ttl):
+        """
+        Buffered upstream response, without the headers of the message itself.
+        """
+        return CachedResponse(
+            status,
+            [
+                (name, value)
+                for name, value in headers.items()
+                if name.lower() not in UNCACHED_HEADERS
+                and not is_hop_by_hop_header(name)
+            ],
+            body,
+            time.time(),
+            ttl,
+        )
+
+    def dumps(self):
+        meta = json.dumps(
+            [self.status, self.headers, self.stored_at, self.ttl],
+            separators=(",", ":"),
+        ).encode()
+        return struct.pack("<I", len(meta)) + meta + self.body
+
+    @staticmethod
+    def loads(data):
+        (meta_length,) = struct.unpack_from("<I", data)
+        status, headers, stored_at, ttl = json.loads(data[4 : 4 + meta_length])
+        headers = [tuple(header) for header in headers]
+        return CachedResponse(status, headers, data[4 + meta_length :], stored_at, ttl)
+
+    def __len__(self):
+        return len(self.body) + sum(
+            len(name) + len(value) for name, value in self.headers
+        )
+
+
+class MemoryResponseStore:
+    """
+    LRU store of the responses of a route, bounded by its number of entries and the
+    size of their bodies and headers.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries or settings.RESPONSE_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or settings.RESPONSE_CACHE_MAX_BYTES
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def set(self, key, response, expire_seconds):
+        size = len(response)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (response, time.time() + expire_seconds)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisResponseStore:
+    """
+    Store of the responses in redis, shared by the workers. Entries expire with redis.
+    """
+
+    _redis = None
+
+    def __init__(self, redis=None, prefix="response:"):
+        self.redis = redis or RedisResponseStore.get_redis()
+        self.prefix = prefix
+
+    @classmethod
+    def get_redis(cls):
+        # A single client for the response caches of all the routes
+        if cls._redis is None:
+            cls._redis = create_redis()
+        return cls._redis
+
+    def get(self, key):
+        try:
+            data = self.redis.get(self.prefix + key)
+        except Exception as exc:
+            _logger.warning(f"Could not read the response cache: {exc}")
+            return None
+        return CachedResponse.loads(data) if data else None
+
+    def set(self, key, response, expire_seconds):
+        try:
+            self.redis.set(
+                self.prefix + key, response.dumps(), ex=max(1, int(expire_seconds))
+            )
+        except Exception as exc:
+            _logger.warning(f"Could not write the response cache: {exc}")
+
+    def delete(self, key):
+        try:
+            self.redis.delete(self.prefix + key)
+        except Exception as exc:
+            _logger.warning(f"Could not write the response cache: {exc}")
+
+
+class ResponseCache:
+    """
+    HTTP cache of the upstream responses to the GET requests of a proxy route.
+
+    Responses are stored when their Cache-Control (s-maxage, max-age) or Expires
+    headers make them fresh for some time, and are served from the cache until then.
+    Stale responses with an ETag are kept `stale_ttl` more seconds, to be revalidated
+    with If-None-Match rather than downloaded again.
+
+    Entries are keyed by the path and query of the request, the values of the request
+    headers listed in `vary`, and the subject of the user unless the cache is
+    `shared`. A shared cache only stores the responses marked public (or with
+    s-maxage), as they are the same for all users.
+    Responses with Set-Cookie, no-store, a Vary header not listed in `vary`, or a body
+    larger than `max_body_size` are not stored.
+    """
+
+    def __init__(
+        self,
+        name,
+        store=None,
+        vary=None,
+        shared=False,
+        max_body_size=None,
+        stale_ttl=None,
+    ):
+        self.name = name
+        self.store = MemoryResponseStore() if store is None else store
+        self.vary = [header.lower() for header in vary or []]
+        self.shared = shared
+        self.max_body_size = max_body_size or settings.RESPONSE_CACHE_MAX_BODY_SIZE
+        self.stale_ttl = (
+            settings.RESPONSE_CACHE_STALE_TTL if stale_ttl is None else stale_ttl
+        )
+
+    @staticmethod
+    def from_dict(name, dictionary):
+        """
+        Build the cache of a route from its `cache` section in routes.yaml,
+        or return None if the route is not cached.
+        """
+        if not dictionary:
+            return None
+        if dictionary.get("store", MEMORY_STORE) == REDIS_STORE:
+            store = RedisResponseStore()
+        else:
+            store = MemoryResponseStore(
+                dictionary.get("max_entries"), dictionary.get("max_bytes")
+            )
+        return ResponseCache(
+            name,
+            store=store,
+            vary=dictionary.get("vary"),
+            shared=dictionary.get("shared", False),
+            max_body_size=dictionary.get("max_body_size"),
+            stale_ttl=dictionary.get("stale_ttl"),
+        )
+
+    def accepts(self, method, headers):
+        """
+        Whether the request can be answered from the cache.
+        """
+        if method != "GET":
+            return False
+        cache_control = headers.get("Cache-Control", "").lower()
+        return "no-cache" not in cache_control and "no-store" not in cache_control
+
+    def key(self, path, headers, subject=None):
+        """
+        Key of the request, `headers` being the (case-insensitive) request headers.
+        """
+        parts = [self.name, path]
+        parts.extend(headers.get(header, "") for header in self.vary)
+        if not self.shared:
+            parts.append(subject or "")
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def get_ttl(self, status, headers):
+        """
+        Number of seconds the upstream response stays fresh, 0 to store it only
+        for revalidation, or None if it must not be stored.
+        """
+        if status not in CACHEABLE_STATUSES or "Set-Cookie" in headers:
+            return None
+        cache_control = parse_cache_control_header(
+            headers.get("Cache-Control"), cls=ResponseCacheControl
+        )
+        if cache_control.no_store or (self.shared and cache_control.private):
+            return None
+        if self.shared and not (cache_control.public or cache_control.s_maxage):
+            return None
+        if not self.is_vary_supported(headers.get("Vary")):
+            return None
+        content_length = parse_content_length(headers.get("Content-Length"))
+        if content_length is None or content_length > self.max_body_size:
+            return None
+
+        ttl = self.get_freshness(cache_control, headers)
+        if cache_control.no_cache:
+            ttl = 0
+        if ttl is None or (ttl <= 0 and not headers.get("ETag")):
+            return None
+        return max(ttl, 0)
+
+    def get_freshness(self, cache_control, headers):
+        ttl = cache_control.s_maxage
+        if ttl is None:
+            ttl = cache_control.max_age
+        if ttl is None:
+            expires = parse_date(headers.get("Expires"))
+            if expires is None:
+                return None
+            date = parse_date(headers.get("Date"))
+            ttl = (expires - date).total_seconds() if date else 0
+        age = parse_delta_seconds(headers.get("Age") or "0")
+        if age is None:
+            # Unknown age, the response may be stale already
+            return None
+        return int(ttl) - age
+
+    def is_vary_supported(self, vary):
+        if not vary:
+            return True
+        return all(
+            header.strip().lower() in self.vary
+            for header in vary.split(",")
+            if header.strip()
+        )
+
+    def set(self, key, status, headers, body, ttl):
+        response = CachedResponse.from_upstream(status, headers, body, ttl)
+        if response.etag:
+            expire_seconds = ttl + self.stale_ttl
+        else:
+            expire_seconds = ttl
+        if expire_seconds > 0:
+            self.store.set(key, response, expire_seconds)
+        return response
+
+    def revalidate(self, key, response, headers):
+        """
+        Refresh a stored response after a 304 Not Modified from the upstream, with the
+        headers of the 304 response.
+        """
+        merged = CaseInsensitiveDict(response.headers)
+        for name, value in headers.items():
+            if name.lower() != "content-length":
+                merged[name] = value
+        ttl = self.get_ttl(response.status, merged)
+        if ttl is None:
+            self.store.delete(key)
+            return CachedResponse(
+                response.status, response.headers, response.body, time.time(), 0
+            )
+        return self.set(key, response.status, merged, response.body, ttl)
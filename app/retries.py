@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+from app import settings
+
+# Methods that can be sent again without changing the result on the upstream
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+# Statuses of an upstream or a load balancer in front of it failing to answer
+RETRYABLE_STATUSES = (502, 503, 504)
+
+
+class RetryBudget:
+    """
+    Bound the retries to a `ratio` of the requests, so that retries do not multiply
+    the load of an upstream that is already failing.
+    Each request deposits `ratio` in the budget, and each retry withdraws 1. The
+    balance starts at, and is capped to, `max_balance`, letting a few retries through
+    when the traffic is low.
+    """
+
+    def __init__(self, ratio=None, max_balance=10):
+        self.ratio = settings.PROXY_RETRY_BUDGET if ratio is None else ratio
+        self.max_balance = max_balance
+        self.balance = max_balance
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, self.max_balance)
+
+    def withdraw(self):
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Retries of the requests of a proxy route.
+
+    Requests with an idempotent method and without body (which is streamed, and can
+    not be sent twice) are retried up to `retries` times on a connection error, a
+    timeout, or one of the `statuses`, on the upstream picked by the balancer for the
+    new attempt.
+    Attempts are spaced by an exponential backoff with full jitter, starting at
+    `backoff` seconds and capped at `max_backoff`, and are bounded by the budget of
+    the route.
+    """
+
+    def __init__(
+        self, retries=None, backoff=None, max_backoff=None, budget=None, statuses=None
+    ):
+        self.retries = settings.PROXY_RETRIES if retries is None else retries
+        self.backoff = settings.PROXY_RETRY_BACKOFF if backoff is None else backoff
+        self.max_backoff = (
+            settings.PROXY_RETRY_MAX_BACKOFF if max_backoff is None else max_backoff
+        )
+        self.budget = RetryBudget(budget)
+        self.statuses = frozenset(statuses or RETRYABLE_STATUSES)
+
+    @staticmethod
+    def from_dict(retry=None):
+        """
+        Build the policy of a route from its `retry` section in routes.yaml.
+        """
+        retry = retry or {}
+        return RetryPolicy(
+            retries=retry.get("retries"),
+            backoff=retry.get("backoff"),
+            max_backoff=retry.get("max_backoff"),
+            budget=retry.get("budget"),
+            statuses=retry.get("statuses"),
+        )
+
+    def is_retryable(self, method, has_body):
+        return bool(self.retries) and method in IDEMPOTENT_METHODS and not has_body
+
+    def should_retry(self, attempt, deadline=None):
+        """
+        Whether a failed attempt (counted from 0) can be retried, withdrawing the
+        retry from the budget.
+        """
+        if attempt >= self.retries:
+            return False
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        return self.budget.withdraw()
+
+    def get_backoff(self, attempt, deadline=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if deadline is not None:
+            delay = min(delay, max(0, deadline - time.monotonic()))
+        return delay
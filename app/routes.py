@@ -1,13 +1,36 @@
 import logging
+import os
+import threading
+import time
 import yaml
 from pathlib import Path
 from flask import Flask
+from werkzeug.exceptions import MethodNotAllowed
 from app import api
-from app.proxy_routes import ProxyRoute, proxy_routes
+from app import settings
+from app.balancers import BALANCINGS, ROUND_ROBIN
+from app.proxy_routes import PROXY_METHODS, ProxyRoute, ProxyRouter, proxy_router
+from app.rate_limits import MEMORY_STORE, RATE_LIMIT_KEYS, REDIS_STORE, SUBJECT_KEY
 
 _logger = logging.getLogger(__name__)
 
 
+# Sections of a route in routes.yaml
+SECTIONS = (
+    "pool",
+    "timeout",
+    "outlier",
+    "health_check",
+    "cache",
+    "headers",
+    "retry",
+)
+
+
+class RoutesConfigError(Exception):
+    pass
+
+
 def init_app(app: Flask):
     _logger.info("init_app routes")
     app.add_url_rule("/", "index", api.index)
@@ -16,37 +39,268 @@ def init_app(app: Flask):
     app.add_url_rule("/delete", "delete", api.delete, methods=["OPTIONS", "POST"])
     app.add_url_rule("/callback", "callback", api.callback)
     app.add_url_rule("/me", "me", api.me)
+    if settings.METRICS_PATH:
+        app.add_url_rule(settings.METRICS_PATH, "metrics", api.metrics_view)
 
     load_proxy_routes(app)
 
 
 def load_proxy_routes(app):
     _logger.info("Loading proxy routes from configuration")
-    routes = get_routes_from_config_file()
-    for route in routes.get("routes"):
-        load_route(app, route)
+    routes_watcher.reload(raise_errors=True)
+    routes_watcher.start()
+    add_method_not_allowed_rules(app)
+    # A single rule for all the proxied paths, api.proxy dispatches them with the
+    # proxy router. Static rules like /login are still matched first.
+    app.add_url_rule("/<path:path>", "proxy", api.proxy, methods=PROXY_METHODS)
+
+
+def add_method_not_allowed_rules(app):
+    """
+    Answer 405 Method Not Allowed to the methods that the rules already registered
+    (/login, /me...) do not accept, instead of proxying them with the catch-all rule.
+    """
+    for rule in list(app.url_map.iter_rules()):
+        methods = sorted(set(PROXY_METHODS) - rule.methods)
+        if methods:
+            app.add_url_rule(
+                rule.rule,
+                f"{rule.endpoint}_method_not_allowed",
+                method_not_allowed_view(sorted(rule.methods)),
+                methods=methods,
+                provide_automatic_options=False,
+            )
+
+
+def method_not_allowed_view(valid_methods):
+    def method_not_allowed(**kwargs):
+        raise MethodNotAllowed(valid_methods)
+
+    return method_not_allowed
 
 
-def get_routes_from_config_file():
-    routes_path = Path("routes.yaml")
+def get_routes_from_config_file(path=None):
+    routes_path = Path(path or settings.ROUTES_FILE)
     if not routes_path.exists():
-        raise Exception("No routes.yaml file found, nothing will be proxied.")
+        raise RoutesConfigError(
+            f"No {routes_path} file found, nothing will be proxied."
+        )
 
     with routes_path.open() as stream:
         try:
-            routes = yaml.load(stream)
-            return routes
+            routes = yaml.safe_load(stream)
         except yaml.YAMLError as exc:
-            print(exc)
-
-
-def load_route(app, route):
-    proxy_route = ProxyRoute.from_dict(route)
-    _logger.info(f"Adding route {proxy_route}")
-    proxy_routes[proxy_route.name] = proxy_route
-    app.add_url_rule(
-        f"{proxy_route.path}/<path:path>",
-        proxy_route.name,
-        api.proxy,
-        methods=["GET", "HEAD", "OPTIONS", "POST", "PUT", "DELETE", "PATCH"],
-    )
+            raise RoutesConfigError(f"Could not parse {routes_path}: {exc}")
+    validate_routes(routes)
+    return routes
+
+
+def validate_routes(routes):
+    """
+    Check the content of routes.yaml, raising a RoutesConfigError for the first
+    invalid route.
+    """
+    if not isinstance(routes, dict) or not isinstance(routes.get("routes"), list):
+        raise RoutesConfigError("routes.yaml must contain a list of routes")
+    names = set()
+    for route in routes["routes"]:
+        if not isinstance(route, dict):
+            raise RoutesConfigError(f"Invalid route {route!r}")
+        name = route.get("name")
+        if not name or not isinstance(name, str):
+            raise RoutesConfigError(f"Route without name: {route!r}")
+        if name in names:
+            raise RoutesConfigError(f"Duplicate route {name}")
+        names.add(name)
+        validate_route(name, route)
+
+
+def validate_route(name, route):
+    path = route.get("path")
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise RoutesConfigError(f"Route {name}: path must start with /")
+    upstreams = route.get("upstream")
+    if isinstance(upstreams, str):
+        upstreams = [upstreams]
+    if (
+        not isinstance(upstreams, list)
+        or not upstreams
+        or not all(
+            isinstance(upstream, str) and upstream.startswith(("http://", "https://"))
+            for upstream in upstreams
+        )
+    ):
+        raise RoutesConfigError(
+            f"Route {name}: upstream must be an http(s) url or a list of them"
+        )
+    if route.get("balancing", ROUND_ROBIN) not in BALANCINGS:
+        raise RoutesConfigError(f"Route {name}: balancing must be one of {BALANCINGS}")
+    methods = route.get("methods")
+    if methods is not None and (
+        not isinstance(methods, list)
+        or not {str(method).upper() for method in methods} <= set(PROXY_METHODS)
+    ):
+        raise RoutesConfigError(
+            f"Route {name}: methods must be a list among {PROXY_METHODS}"
+        )
+    for section in SECTIONS:
+        if not isinstance(route.get(section) or {}, dict):
+            raise RoutesConfigError(f"Route {name}: invalid {section} section")
+    for section in ("coalesce", "compress", "circuit_breaker"):
+        if not isinstance(route.get(section, False), (bool, dict)):
+            raise RoutesConfigError(
+                f"Route {name}: {section} must be a boolean or a section"
+            )
+    validate_headers(name, route.get("headers") or {})
+    validate_rate_limits(name, route.get("rate_limits") or [])
+
+
+def validate_rate_limits(name, rate_limits):
+    if not isinstance(rate_limits, list):
+        raise RoutesConfigError(f"Route {name}: rate_limits must be a list")
+    for limit in rate_limits:
+        if (
+            not isinstance(limit, dict)
+            or not is_positive_number(limit.get("rate"))
+            or not is_positive_number(limit.get("period", 1))
+            or not is_positive_number(limit.get("burst", 1))
+            or limit.get("key", SUBJECT_KEY) not in RATE_LIMIT_KEYS
+            or limit.get("store", MEMORY_STORE) not in (MEMORY_STORE, REDIS_STORE)
+        ):
+            raise RoutesConfigError(
+                f"Route {name}: a rate limit needs a positive rate and period, and a "
+                f"key among {RATE_LIMIT_KEYS}"
+            )
+
+
+def is_positive_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+
+def validate_headers(name, headers):
+    for key in ("allow", "deny", "response_deny"):
+        values = headers.get(key)
+        if values is not None and (
+            not isinstance(values, list)
+            or not all(isinstance(value, str) for value in values)
+        ):
+            raise RoutesConfigError(
+                f"Route {name}: headers {key} must be a list of header names"
+            )
+
+
+class RoutesWatcher:
+    """
+    Reload the proxy routes when their file changes, without restarting the workers.
+
+    The modification time, size and inode of the file are polled every `interval`
+    seconds by a background thread. A changed file is parsed with the safe loader and
+    validated, then a new router is built and swapped in (see ReloadableProxyRouter).
+    An invalid file is logged and ignored, the current routes stay in place.
+
+    Unchanged routes are reused with their connection pool. The pools of the changed
+    and removed routes are drained once the new router is in place.
+    """
+
+    def __init__(self, path=None, router=proxy_router, interval=None):
+        self.path = path or settings.ROUTES_FILE
+        self.router = router
+        self.interval = (
+            settings.ROUTES_RELOAD_INTERVAL if interval is None else interval
+        )
+        self.configs = {}
+        self.reload_count = 0
+        self._stat = None
+        self._watcher_pid = None
+        self._lock = threading.Lock()
+
+    def get_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def start(self):
+        """
+        Start the background polling, once per process: the thread does not survive
+        the fork of the gunicorn workers (with --preload), it is started again in
+        each of them.
+        """
+        if not self.interval or self._watcher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            if self._watcher_pid is None:
+                os.register_at_fork(after_in_child=self._after_fork)
+            threading.Thread(
+                target=self._watch_forever, name="routes-watcher", daemon=True
+            ).start()
+            self._watcher_pid = os.getpid()
+
+    def _after_fork(self):
+        # The lock may have been held by a thread of the parent
+        self._lock = threading.Lock()
+        self.start()
+
+    def _watch_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        """
+        Reload the routes if their file changed since the last load.
+        """
+        if self.get_stat() == self._stat:
+            return False
+        return self.reload()
+
+    def reload(self, raise_errors=False):
+        with self._lock:
+            stat = self.get_stat()
+            try:
+                routes = get_routes_from_config_file(self.path)
+                configs, proxy_routes = self.build_routes(routes["routes"])
+            except Exception as exc:
+                if raise_errors:
+                    raise
+                _logger.error(f"Routes not reloaded, keeping the current ones: {exc}")
+                # Do not retry until the file changes again
+                self._stat = stat
+                return False
+
+            previous = self.router.swap(ProxyRouter(proxy_routes))
+            previous_configs, self.configs, self._stat = self.configs, configs, stat
+            self.reload_count += 1
+
+        for name, route in previous.routes.items():
+            if self.router.routes.get(name) is not route:
+                _logger.info(f"Draining connections of the previous route {route}")
+                route.close()
+        _logger.info(
+            f"Loaded {len(proxy_routes)} proxy routes "
+            f"({len(previous_configs)} previously)"
+        )
+        return True
+
+    def build_routes(self, routes):
+        """
+        Create the routes of the new router, reusing the current ones that did not
+        change.
+        """
+        configs = {}
+        proxy_routes = []
+        for route in routes:
+            name = route["name"]
+            proxy_route = self.router.routes.get(name)
+            if proxy_route is None or self.configs.get(name) != route:
+                proxy_route = ProxyRoute.from_dict(route)
+                _logger.info(f"Adding route {proxy_route}")
+            configs[name] = route
+            proxy_routes.append(proxy_route)
+        return configs, proxy_routes
+
+
+routes_watcher = RoutesWatcher()
@@ -1,10 +1,22 @@
 import abc
+import contextlib
+import fcntl
+import hashlib
 import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
 
 import redis
-from werkzeug.contrib.cache import SimpleCache
 
 from app import settings
+from app.metrics import redis_session_lookup_duration
+from app.redis_clients import create_redis, is_redis_enabled
+from app.session_serializers import SessionSerializer
 
 _logger = logging.getLogger(__name__)
 
@@ -25,52 +37,502 @@ class SessionManager(abc.ABC):
     def get(self, session_id):
         pass
 
+    def update_session(self, session_id, payload: dict, expire_seconds=None):
+        """
+        Replace the payload of an existing session, as a whole.
+        """
+        return self.create_session(session_id, payload, expire_seconds)
+
+    async def get_async(self, session_id):
+        """
+        Get the session from a coroutine.
+        Stores that need I/O should override it to avoid blocking the event loop.
+        """
+        return self.get(session_id)
+
 
 class RedisSessionManager(SessionManager):
-    def __init__(self):
-        self.redis = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            password=settings.REDIS_PASSWORD,
-        )
+    """
+    Session manager that stores each session in redis as a single value, serialized
+    by a SessionSerializer.
+    """
+
+    def __init__(self, serializer=None):
+        self.redis = create_redis()
+        self.serializer = serializer or SessionSerializer()
+        # Created on first use, as it is bound to the running event loop
+        self.async_redis = None
 
     def create_session(self, session_id, payload: dict, expire_seconds=None):
-        ret = self.redis.hmset(session_id, payload)
-        if expire_seconds:
-            self.redis.expire(session_id, expire_seconds)
-        return ret
+        # Write and expire the session atomically, in a single round trip
+        return self.redis.set(
+            session_id, self.serializer.dumps(payload), ex=expire_seconds or None
+        )
 
     def get(self, session_id):
-        return self.redis.hgetall(session_id) or None
+        try:
+            with redis_session_lookup_duration.time():
+                data = self.redis.get(session_id)
+            return self._loads(data)
+        except redis.ResponseError:
+            return self._get_legacy(session_id)
+
+    def get_async_redis(self):
+        if self.async_redis is None:
+            self.async_redis = create_redis(asynchronous=True)
+        return self.async_redis
+
+    async def get_async(self, session_id):
+        try:
+            with redis_session_lookup_duration.time():
+                data = await self.get_async_redis().get(session_id)
+            return self._loads(data)
+        except redis.ResponseError:
+            return self._decode_legacy(await self.get_async_redis().hgetall(session_id))
+
+    def get_with_ttl(self, session_id):
+        """
+        Get the session along with its remaining time to live in seconds (None if it
+        does not expire), in a single round trip.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.get(session_id)
+        pipeline.pttl(session_id)
+        try:
+            with redis_session_lookup_duration.time():
+                results = pipeline.execute()
+            return self._with_ttl(*results)
+        except redis.ResponseError:
+            return self._get_legacy(session_id), None
+
+    async def get_with_ttl_async(self, session_id):
+        async with self.get_async_redis().pipeline(transaction=False) as pipeline:
+            pipeline.get(session_id)
+            pipeline.pttl(session_id)
+            try:
+                with redis_session_lookup_duration.time():
+                    results = await pipeline.execute()
+                return self._with_ttl(*results)
+            except redis.ResponseError:
+                return await self.get_async(session_id), None
+
+    def _loads(self, data):
+        return self.serializer.loads(data) if data else None
+
+    def _with_ttl(self, data, pttl):
+        return self._loads(data), pttl / 1000 if pttl >= 0 else None
+
+    def _get_legacy(self, session_id):
+        return self._decode_legacy(self.redis.hgetall(session_id))
+
+    @staticmethod
+    def _decode_legacy(session_data):
+        """
+        Sessions created before they were serialized are stored as redis hashes.
+        """
+        if not session_data:
+            return None
+        return {key.decode(): value.decode() for key, value in session_data.items()}
 
     def destroy_session(self, session_id):
         return self.redis.delete(session_id) and True or False
 
 
-class LocalSessionManager(SessionManager):
+class TieredSessionManager(SessionManager):
     """
-    Session manager that stores sessions in memory.
-    Do not use it in a multi-threaded/multi-processes environment,
-    and use RedisSessionManager instead.
+    Session manager keeping the most recently used sessions in memory, in front of
+    a RedisSessionManager.
+
+    Sessions are kept in memory for at most `ttl` seconds, and never past their
+    expiration in redis.
+    Destroyed sessions are published on a redis channel, to which every worker
+    listens in a background thread to evict them from its own memory.
+    A session read from redis is not kept in memory if an eviction happened during
+    the read: it may have been destroyed in the meantime.
     """
 
+    def __init__(self, backend, max_size=None, ttl=None, channel=None):
+        self.backend = backend
+        self.max_size = max_size or settings.SESSION_CACHE_SIZE
+        self.ttl = settings.SESSION_CACHE_TTL if ttl is None else ttl
+        self.channel = channel or settings.SESSION_INVALIDATION_CHANNEL
+        self._entries = OrderedDict()
+        # Incremented by every eviction, checked before keeping a session read
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listener_pid = None
+
+    def start_listener(self):
+        """
+        Listen to the invalidation channel, once per process: the thread does not
+        survive the fork of the gunicorn workers.
+        """
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            # Invalidations may have been missed in the meantime
+            self._entries.clear()
+            self._generation += 1
+            pubsub = self.backend.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_invalidation})
+            self._listener = pubsub.run_in_thread(
+                sleep_time=1, daemon=True, exception_handler=self._on_listener_error
+            )
+            self._listener_pid = os.getpid()
+
+    def _on_invalidation(self, message):
+        session_id = message["data"]
+        if isinstance(session_id, bytes):
+            session_id = session_id.decode()
+        self.evict(session_id)
+
+    def _on_listener_error(self, exc, pubsub, thread):
+        # The subscription is restored when reconnecting, but the invalidations
+        # published in the meantime are lost.
+        _logger.warning(f"Session invalidation listener failed: {exc}")
+        self.clear()
+        time.sleep(1)
+
+    def _get_cached(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            session_data, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return session_data
+
+    def _set_cached(self, session_id, session_data, session_ttl, generation):
+        ttl = self.ttl if session_ttl is None else min(self.ttl, session_ttl)
+        if not session_data or ttl <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[session_id] = (session_data, time.monotonic() + ttl)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def create_session(self, session_id, payload: dict, expire_seconds=None):
+        return self.backend.create_session(session_id, payload, expire_seconds)
+
+    def update_session(self, session_id, payload: dict, expire_seconds=None):
+        self.evict(session_id)
+        updated = self.backend.create_session(session_id, payload, expire_seconds)
+        self.backend.redis.publish(self.channel, session_id)
+        return updated
+
+    def get(self, session_id):
+        self.start_listener()
+        session_data = self._get_cached(session_id)
+        if session_data is None:
+            generation = self._generation
+            session_data, session_ttl = self.backend.get_with_ttl(session_id)
+            self._set_cached(session_id, session_data, session_ttl, generation)
+        return session_data
+
+    async def get_async(self, session_id):
+        self.start_listener()
+        session_data = self._get_cached(session_id)
+        if session_data is None:
+            generation = self._generation
+            session_data, session_ttl = await self.backend.get_with_ttl_async(
+                session_id
+            )
+            self._set_cached(session_id, session_data, session_ttl, generation)
+        return session_data
+
+    def destroy_session(self, session_id):
+        self.evict(session_id)
+        destroyed = self.backend.destroy_session(session_id)
+        self.backend.redis.publish(self.channel, session_id)
+        return destroyed
+
+
+class SessionShard:
+    __slots__ = ("lock", "entries", "size")
+
     def __init__(self):
-        # The default timeout is 0, meaning no expiration.
-        # When creating a session, the timeout of the key will be set accordingly
-        # to the expiration time of the access token.
-        self.sessions = SimpleCache(default_timeout=0)
+        self.lock = threading.Lock()
+        # session_id -> (payload, expires_at, size), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def remove(self, session_id):
+        entry = self.entries.pop(session_id, None)
+        if entry is not None:
+            self.size -= entry[2]
+        return entry
+
+
+class LocalSessionManager(SessionManager):
+    """
+    Session manager that stores sessions in memory, safe to use from several threads.
+
+    Sessions are spread over shards, each with its own lock, and bounded in number
+    (`max_entries`) and approximate size (`max_bytes`), 0 meaning no limit: the least
+    recently used sessions are evicted first.
+    Expired sessions are dropped when read, and by a background thread sweeping one
+    shard every `sweep_interval` seconds.
+    Sessions are not shared between processes, use RedisSessionManager with several
+    gunicorn workers.
+    """
+
+    def __init__(
+        self, shards=None, max_entries=None, max_bytes=None, sweep_interval=None
+    ):
+        self.shards = [
+            SessionShard() for _ in range(shards or settings.LOCAL_SESSION_SHARDS)
+        ]
+        self.max_entries = (
+            settings.LOCAL_SESSION_MAX_ENTRIES if max_entries is None else max_entries
+        )
+        self.max_bytes = (
+            settings.LOCAL_SESSION_MAX_BYTES if max_bytes is None else max_bytes
+        )
+        self.sweep_interval = sweep_interval or settings.LOCAL_SESSION_SWEEP_INTERVAL
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+
+    def get_shard(self, session_id):
+        return self.shards[hash(session_id) % len(self.shards)]
+
+    def start_sweeper(self):
+        """
+        Start the background sweep, once per process.
+        """
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            threading.Thread(target=self._sweep_forever, daemon=True).start()
+            self._sweeper_pid = os.getpid()
+
+    def _sweep_forever(self):
+        shard_index = 0
+        while True:
+            time.sleep(self.sweep_interval)
+            self.sweep(self.shards[shard_index])
+            shard_index = (shard_index + 1) % len(self.shards)
+
+    def sweep(self, shard):
+        now = time.monotonic()
+        with shard.lock:
+            expired = [
+                session_id
+                for session_id, (_, expires_at, _) in shard.entries.items()
+                if expires_at <= now
+            ]
+            for session_id in expired:
+                shard.remove(session_id)
+        return len(expired)
+
+    def create_session(self, session_id, payload: dict, expire_seconds=None):
+        self.start_sweeper()
+        expires_at = time.monotonic() + expire_seconds if expire_seconds else math.inf
+        size = len(session_id) + sum(
+            len(str(key)) + len(str(value)) for key, value in payload.items()
+        )
+        shard = self.get_shard(session_id)
+        max_entries = math.ceil(self.max_entries / len(self.shards)) or math.inf
+        max_bytes = self.max_bytes / len(self.shards)
+        with shard.lock:
+            shard.remove(session_id)
+            shard.entries[session_id] = (payload, expires_at, size)
+            shard.size += size
+            while len(shard.entries) > max_entries or (
+                self.max_bytes and shard.size > max_bytes and len(shard.entries) > 1
+            ):
+                shard.remove(next(iter(shard.entries)))
+
+    def get(self, session_id):
+        shard = self.get_shard(session_id)
+        with shard.lock:
+            entry = shard.entries.get(session_id)
+            if entry is None:
+                return None
+            payload, expires_at, _ = entry
+            if expires_at <= time.monotonic():
+                shard.remove(session_id)
+                return None
+            shard.entries.move_to_end(session_id)
+            return payload
+
+    def destroy_session(self, session_id):
+        shard = self.get_shard(session_id)
+        with shard.lock:
+            return shard.remove(session_id) is not None
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+
+# Layout of the shared memory session file: a header describing the table, followed
+# by the slots, each starting with a slot header.
+SHARED_MAGIC = b"PYOPSESS"
+SHARED_HEADER = struct.Struct("<8sIII")  # magic, slots, slot size, stripes
+SLOT_HEADER = struct.Struct("<B32sdI")  # state, session id digest, expires_at, length
+SLOT_EMPTY = 0
+SLOT_USED = 1
+SLOT_DELETED = 2
+
+
+class SharedMemorySessionManager(SessionManager):
+    """
+    Session manager storing sessions in a memory-mapped file (in /dev/shm for
+    instance), shared by all the processes of a host.
+
+    The file is an open-addressing hash table of fixed-size slots, split in stripes:
+    a session always lives in the stripe given by its hash, and is found by linear
+    probing within it. Each stripe is protected by a thread lock and a fcntl lock on
+    its byte range, so that the table can be used by several processes and threads.
+    A slot holds the digest of the session id, its expiration time, and the session
+    serialized by a SessionSerializer. Expired and destroyed slots are reused by new
+    sessions, and when a stripe is full the session closest to expiration is replaced.
+    """
+
+    def __init__(
+        self, path=None, slots=None, slot_size=None, stripes=None, serializer=None
+    ):
+        self.path = path or settings.SHARED_SESSION_FILE
+        self.slots = slots or settings.SHARED_SESSION_SLOTS
+        self.slot_size = slot_size or settings.SHARED_SESSION_SLOT_SIZE
+        self.stripes = min(stripes or settings.SHARED_SESSION_STRIPES, self.slots)
+        self.slots_per_stripe = self.slots // self.stripes
+        self.serializer = serializer or SessionSerializer()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = SHARED_HEADER.size + self.slots * self.slot_size
+        header = SHARED_HEADER.pack(
+            SHARED_MAGIC, self.slots, self.slot_size, self.stripes
+        )
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, SHARED_HEADER.size, 0)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, header, 0)
+            elif os.pread(self._fd, SHARED_HEADER.size, 0) != header:
+                raise Exception(
+                    f"{self.path} was created with another layout, remove it or "
+                    "update the SHARED_SESSION_ settings."
+                )
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, SHARED_HEADER.size, 0)
+        self.memory = mmap.mmap(self._fd, size)
+        self.view = memoryview(self.memory)
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+
+    def _locate(self, session_id):
+        digest = hashlib.sha256(session_id.encode()).digest()
+        stripe = int.from_bytes(digest[:8], "little") % self.stripes
+        home = int.from_bytes(digest[8:16], "little") % self.slots_per_stripe
+        return digest, stripe, home
+
+    def _slot_offset(self, index):
+        return SHARED_HEADER.size + index * self.slot_size
+
+    @contextlib.contextmanager
+    def _lock_stripe(self, stripe):
+        start = self._slot_offset(stripe * self.slots_per_stripe)
+        length = self.slots_per_stripe * self.slot_size
+        with self._locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def _lookup(self, digest, stripe, home, now):
+        """
+        Probe the stripe from the home slot of the session.
+        Return the slot holding the session (if any), the first reusable slot,
+        and the slot of the session closest to expiration.
+        """
+        free, oldest, oldest_expires_at = None, None, math.inf
+        first = stripe * self.slots_per_stripe
+        for i in range(self.slots_per_stripe):
+            index = first + (home + i) % self.slots_per_stripe
+            state, key, expires_at, _ = SLOT_HEADER.unpack_from(
+                self.memory, self._slot_offset(index)
+            )
+            if state == SLOT_EMPTY:
+                return None, index if free is None else free, oldest
+            if state == SLOT_USED and key == digest:
+                return index, free, oldest
+            if state == SLOT_DELETED or expires_at <= now:
+                if free is None:
+                    free = index
+            elif expires_at < oldest_expires_at:
+                oldest, oldest_expires_at = index, expires_at
+        return None, free, oldest
 
     def create_session(self, session_id, payload: dict, expire_seconds=None):
-        self.sessions.add(session_id, payload, timeout=expire_seconds)
+        data = self.serializer.dumps(payload)
+        if SLOT_HEADER.size + len(data) > self.slot_size:
+            raise Exception(
+                f"Session of {len(data)} bytes does not fit in shared memory slots "
+                f"of {self.slot_size} bytes, increase SHARED_SESSION_SLOT_SIZE."
+            )
+        expires_at = time.time() + expire_seconds if expire_seconds else math.inf
+        digest, stripe, home = self._locate(session_id)
+        with self._lock_stripe(stripe):
+            index, free, oldest = self._lookup(digest, stripe, home, time.time())
+            if index is None:
+                index = free if free is not None else oldest
+            offset = self._slot_offset(index)
+            start = offset + SLOT_HEADER.size
+            self.memory[start : start + len(data)] = data
+            SLOT_HEADER.pack_into(
+                self.memory, offset, SLOT_USED, digest, expires_at, len(data)
+            )
 
     def get(self, session_id):
-        return self.sessions.get(session_id)
+        digest, stripe, home = self._locate(session_id)
+        with self._lock_stripe(stripe):
+            now = time.time()
+            index, _, _ = self._lookup(digest, stripe, home, now)
+            if index is None:
+                return None
+            offset = self._slot_offset(index)
+            _, _, expires_at, length = SLOT_HEADER.unpack_from(self.memory, offset)
+            if expires_at <= now:
+                self.memory[offset] = SLOT_DELETED
+                return None
+            start = offset + SLOT_HEADER.size
+            return self.serializer.loads(self.view[start : start + length])
 
     def destroy_session(self, session_id):
-        return self.sessions.delete(session_id)
+        digest, stripe, home = self._locate(session_id)
+        with self._lock_stripe(stripe):
+            index, _, _ = self._lookup(digest, stripe, home, time.time())
+            if index is None:
+                return False
+            self.memory[self._slot_offset(index)] = SLOT_DELETED
+            return True
 
 
-if settings.REDIS_HOST:
+if is_redis_enabled():
     session = RedisSessionManager()
+    if settings.SESSION_CACHE_SIZE:
+        session = TieredSessionManager(session)
+elif settings.SHARED_SESSION_FILE:
+    session = SharedMemorySessionManager()
 else:
     session = LocalSessionManager()
@@ -0,0 +1,157 @@
+import base64
+import hashlib
+import hmac
+import logging
+import time
+
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature
+from werkzeug.datastructures import CallbackDict
+
+from app import settings
+
+_logger = logging.getLogger(__name__)
+
+# Derives the signing keys from the configured ones, dedicated to the session cookie
+KEY_DERIVATION_SALT = b"pyopenid-proxy.session-id"
+
+
+def derive_key(key):
+    return hmac.new(key.encode(), KEY_DERIVATION_SALT, hashlib.sha256).digest()
+
+
+class SessionIdCodec:
+    """
+    Signed cookie value holding a session id: "<session id>.<timestamp>.<signature>",
+    the signature being the HMAC-SHA256 of the id and the timestamp.
+
+    Values are signed with the first of the `keys`, and verified against all of them:
+    to rotate the keys, add the new key first, and remove the old one `max_age`
+    seconds later. The HMAC states of the keys are computed once, and copied for each
+    value.
+    """
+
+    def __init__(self, keys, max_age=None):
+        if isinstance(keys, str):
+            keys = keys.split(",")
+        keys = [key.strip() for key in keys if key.strip()]
+        if not keys:
+            raise ValueError("At least one session cookie key is required")
+        self.max_age = max_age
+        self._macs = [
+            hmac.new(derive_key(key), digestmod=hashlib.sha256) for key in keys
+        ]
+
+    @staticmethod
+    def _signature(mac, value):
+        mac = mac.copy()
+        mac.update(value)
+        return base64.urlsafe_b64encode(mac.digest()).rstrip(b"=")
+
+    def dumps(self, session_id, now=None):
+        value = f"{session_id}.{int(now or time.time())}"
+        signature = self._signature(self._macs[0], value.encode())
+        return f"{value}.{signature.decode()}"
+
+    def loads(self, cookie, now=None):
+        """
+        Session id of the cookie value, or None if it is invalid or expired.
+        """
+        try:
+            value, signature = cookie.encode().rsplit(b".", 1)
+            session_id, timestamp = value.rsplit(b".", 1)
+            timestamp = int(timestamp)
+        except (UnicodeError, ValueError):
+            return None
+        if not session_id:
+            return None
+        if self.max_age and timestamp + self.max_age < (now or time.time()):
+            return None
+        for mac in self._macs:
+            if hmac.compare_digest(self._signature(mac, value), signature):
+                return session_id.decode()
+        return None
+
+
+class SessionIdSession(CallbackDict, SessionMixin):
+    """
+    Client-side session, of which only the session id is kept in the cookie.
+    """
+
+    # The cookie lasts PERMANENT_SESSION_LIFETIME, whatever the session
+    permanent = True
+
+    def __init__(self, initial=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.modified = False
+
+
+class SessionIdInterface(SessionInterface):
+    """
+    Flask session interface storing the server-side session id in a cookie signed by
+    a SessionIdCodec, in place of the JSON, itsdangerous-signed, cookie of flask.
+
+    The cookie is only set when the session id changes (on /callback), and removed
+    when the session is cleared.
+    Cookies issued by the flask session interface are still accepted, and issued
+    again with the codec.
+    """
+
+    session_class = SessionIdSession
+
+    def __init__(self, keys=None, max_age=None):
+        self.codec = SessionIdCodec(keys or settings.SESSION_COOKIE_KEYS, max_age)
+        self.legacy_interface = SecureCookieSessionInterface()
+
+    def load_session_id(self, app, cookie):
+        """
+        Session id of the cookie or None, and whether the cookie was issued by the
+        flask session interface.
+        """
+        session_id = self.codec.loads(cookie)
+        if session_id is not None:
+            return session_id, False
+        serializer = self.legacy_interface.get_signing_serializer(app)
+        try:
+            data = serializer.loads(cookie, max_age=self.codec.max_age)
+        except BadSignature:
+            return None, False
+        if not isinstance(data, dict) or not data.get(settings.SESSION_ID):
+            return None, False
+        return data[settings.SESSION_ID], True
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(app.session_cookie_name)
+        if not cookie:
+            return self.session_class()
+        session_id, legacy = self.load_session_id(app, cookie)
+        if session_id is None:
+            return self.session_class()
+        session = self.session_class({settings.SESSION_ID: session_id})
+        session.modified = legacy
+        return session
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        session_id = session.get(settings.SESSION_ID)
+        if session_id:
+            response.vary.add("Cookie")
+        if not session.modified:
+            return
+        if not session_id:
+            response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        response.set_cookie(
+            app.session_cookie_name,
+            self.codec.dumps(session_id),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
@@ -0,0 +1,103 @@
+import json
+import zlib
+
+from app import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Header of the serialized sessions: format version, encoding and compression.
+# Sessions are always read according to their own header, so the encoding and
+# compression settings can be changed without invalidating existing sessions.
+VERSION = 1
+ENCODINGS = {"json": 0, "msgpack": 1}
+COMPRESSIONS = {"none": 0, "zlib": 1, "zstd": 2}
+
+
+class SessionSerializer:
+    """
+    Serialize a session payload into a single compact value.
+    The payload is encoded in JSON or msgpack, then compressed with zlib or zstd when
+    larger than `compression_threshold` bytes (JWT are the bulk of a session).
+    """
+
+    def __init__(
+        self,
+        encoding=None,
+        compression=None,
+        compression_threshold=None,
+        compression_level=None,
+    ):
+        self.encoding = encoding or settings.SESSION_SERIALIZER
+        self.compression = compression or settings.SESSION_COMPRESSION
+        self.compression_threshold = (
+            settings.SESSION_COMPRESSION_THRESHOLD
+            if compression_threshold is None
+            else compression_threshold
+        )
+        self.compression_level = compression_level or settings.SESSION_COMPRESSION_LEVEL
+        if self.encoding not in ENCODINGS:
+            raise Exception(f"Unknown session serializer {self.encoding}.")
+        if self.compression not in COMPRESSIONS:
+            raise Exception(f"Unknown session compression {self.compression}.")
+        if self.encoding == "msgpack" and msgpack is None:
+            raise Exception("Please install msgpack to serialize sessions with it.")
+        if self.compression == "zstd" and zstandard is None:
+            raise Exception("Please install zstandard to compress sessions with it.")
+
+    def dumps(self, payload: dict) -> bytes:
+        data = encode(self.encoding, payload)
+        compression = self.compression
+        if len(data) < self.compression_threshold:
+            compression = "none"
+        data = compress(compression, data, self.compression_level)
+        return (
+            bytes([VERSION, ENCODINGS[self.encoding], COMPRESSIONS[compression]]) + data
+        )
+
+    def loads(self, data: bytes) -> dict:
+        version, encoding, compression = data[:3]
+        if version != VERSION:
+            raise ValueError(f"Unsupported session format version {version}")
+        data = decompress(compression, data[3:])
+        return decode(encoding, data)
+
+
+def encode(encoding, payload):
+    if encoding == "msgpack":
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def decode(encoding, data):
+    if encoding == ENCODINGS["msgpack"]:
+        return msgpack.unpackb(data, raw=False)
+    if encoding == ENCODINGS["json"]:
+        return json.loads(data)
+    raise ValueError(f"Unknown session encoding {encoding}")
+
+
+def compress(compression, data, level):
+    if compression == "zlib":
+        return zlib.compress(data, level)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return data
+
+
+def decompress(compression, data):
+    if compression == COMPRESSIONS["zlib"]:
+        return zlib.decompress(data)
+    if compression == COMPRESSIONS["zstd"]:
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == COMPRESSIONS["none"]:
+        # The data may be a memoryview, over a shared memory session for instance
+        return bytes(data)
+    raise ValueError(f"Unknown session compression {compression}")
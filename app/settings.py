@@ -15,10 +15,51 @@ except KeyError as exc:
 # Optional
 OAUTH_JWKS_URL = os.environ.get("OAUTH_JWKS_URL", None)
 OAUTH_SIGNING_ALGORITHM = os.environ.get("OAUTH_SIGNING_ALGORITHM", "RS256")
+# Add offline_access for the provider to issue refresh tokens
+OAUTH_SCOPE = os.environ.get("OAUTH_SCOPE", "openid profile")
 REDIRECT_LOGGED_IN_URL = os.environ.get("REDIRECT_LOGGED_IN_URL", None)
+# Comma-separated keys of the session cookie, the first one signing it
+SESSION_COOKIE_KEYS = os.environ.get("SESSION_COOKIE_KEYS", SECRET_KEY)
 REDIS_HOST = os.environ.get("REDIS_HOST")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD")
+REDIS_DB = int(os.environ.get("REDIS_DB", 0))
+REDIS_UNIX_SOCKET = os.environ.get("REDIS_UNIX_SOCKET")
+# standalone, sentinel or cluster
+REDIS_MODE = os.environ.get("REDIS_MODE", "standalone")
+# Comma-separated host:port of the sentinels, and name of the monitored master
+REDIS_SENTINELS = os.environ.get("REDIS_SENTINELS")
+REDIS_SENTINEL_MASTER = os.environ.get("REDIS_SENTINEL_MASTER", "mymaster")
+REDIS_SENTINEL_PASSWORD = os.environ.get("REDIS_SENTINEL_PASSWORD")
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 0)) or None
+REDIS_BLOCKING_POOL = bool(os.environ.get("REDIS_BLOCKING_POOL", False))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.environ.get("REDIS_SOCKET_CONNECT_TIMEOUT", 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))
+# In-memory sessions, used without redis. 0 max entries or bytes means no limit.
+LOCAL_SESSION_SHARDS = int(os.environ.get("LOCAL_SESSION_SHARDS", 16))
+LOCAL_SESSION_MAX_ENTRIES = int(os.environ.get("LOCAL_SESSION_MAX_ENTRIES", 100000))
+LOCAL_SESSION_MAX_BYTES = int(os.environ.get("LOCAL_SESSION_MAX_BYTES", 0))
+LOCAL_SESSION_SWEEP_INTERVAL = float(os.environ.get("LOCAL_SESSION_SWEEP_INTERVAL", 1))
+# Sessions shared by the processes of a host through a memory-mapped file
+SHARED_SESSION_FILE = os.environ.get("SHARED_SESSION_FILE")
+SHARED_SESSION_SLOTS = int(os.environ.get("SHARED_SESSION_SLOTS", 16384))
+SHARED_SESSION_SLOT_SIZE = int(os.environ.get("SHARED_SESSION_SLOT_SIZE", 4096))
+SHARED_SESSION_STRIPES = int(os.environ.get("SHARED_SESSION_STRIPES", 64))
+# Encoding (json or msgpack) and compression (none, zlib or zstd) of redis sessions
+SESSION_SERIALIZER = os.environ.get("SESSION_SERIALIZER", "json")
+SESSION_COMPRESSION = os.environ.get("SESSION_COMPRESSION", "zlib")
+SESSION_COMPRESSION_THRESHOLD = int(
+    os.environ.get("SESSION_COMPRESSION_THRESHOLD", 256)
+)
+SESSION_COMPRESSION_LEVEL = int(os.environ.get("SESSION_COMPRESSION_LEVEL", 6))
+# In-memory cache of the redis sessions, 0 to disable it
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 60))
+SESSION_INVALIDATION_CHANNEL = os.environ.get(
+    "SESSION_INVALIDATION_CHANNEL", "pyopenid-proxy:session-invalidation"
+)
 PORT = int(os.environ.get("PORT", 8080))
 HOST = os.environ.get("HOST", "127.0.0.1")
 DEBUG = os.environ.get("DEBUG", False)
@@ -26,6 +67,70 @@ MOCK_OAUTH = os.environ.get("MOCK_OAUTH", False)
 CORS_ORIGIN = os.environ.get("CORS_ORIGIN", None)
 AUTH0_MANAGEMENT_CLIENT_ID = os.environ.get("AUTH0_MANAGEMENT_CLIENT_ID", None)
 AUTH0_MANAGEMENT_CLIENT_SECRET = os.environ.get("AUTH0_MANAGEMENT_CLIENT_SECRET", None)
+# Maximum number of verified tokens kept in cache, 0 to disable the cache
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
+# JWKS refresh period, minimum delay between refreshes on unknown kid, fetch timeout
+JWKS_TTL = float(os.environ.get("JWKS_TTL", 3600))
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get("JWKS_MIN_REFRESH_INTERVAL", 60))
+JWKS_TIMEOUT = float(os.environ.get("JWKS_TIMEOUT", 5))
+# Access tokens are refreshed TOKEN_REFRESH_WINDOW seconds before they expire, when the
+# session holds a refresh token. Such sessions are kept for REFRESH_SESSION_LIFETIME
+# seconds after the last refresh.
+TOKEN_REFRESH_WINDOW = float(os.environ.get("TOKEN_REFRESH_WINDOW", 60))
+TOKEN_REFRESH_TIMEOUT = float(os.environ.get("TOKEN_REFRESH_TIMEOUT", 5))
+REFRESH_SESSION_LIFETIME = int(
+    os.environ.get("REFRESH_SESSION_LIFETIME", 30 * 24 * 3600)
+)
+# Defaults of the upstream connection pools, can be overridden per route in routes.yaml
+PROXY_POOL_MAX_CONNECTIONS = int(os.environ.get("PROXY_POOL_MAX_CONNECTIONS", 10))
+PROXY_POOL_IDLE_TIMEOUT = float(os.environ.get("PROXY_POOL_IDLE_TIMEOUT", 60))
+PROXY_POOL_BLOCK = bool(os.environ.get("PROXY_POOL_BLOCK", False))
+PROXY_CONNECT_TIMEOUT = float(os.environ.get("PROXY_CONNECT_TIMEOUT", 3.05))
+PROXY_READ_TIMEOUT = float(os.environ.get("PROXY_READ_TIMEOUT", 30))
+# Bound of a whole proxied request, retries and response body included, 0 for none
+PROXY_TOTAL_TIMEOUT = float(os.environ.get("PROXY_TOTAL_TIMEOUT", 0))
+# Retries of the idempotent requests without body, can be overridden per route
+PROXY_RETRIES = int(os.environ.get("PROXY_RETRIES", 1))
+PROXY_RETRY_BACKOFF = float(os.environ.get("PROXY_RETRY_BACKOFF", 0.025))
+PROXY_RETRY_MAX_BACKOFF = float(os.environ.get("PROXY_RETRY_MAX_BACKOFF", 0.25))
+# Ratio of the requests that can be retried
+PROXY_RETRY_BUDGET = float(os.environ.get("PROXY_RETRY_BUDGET", 0.2))
+# Size of the chunks read from the request and upstream response bodies
+PROXY_CHUNK_SIZE = int(os.environ.get("PROXY_CHUNK_SIZE", 64 * 1024))
+# Defaults of the response caches of the routes, set in routes.yaml
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+RESPONSE_CACHE_MAX_BODY_SIZE = int(
+    os.environ.get("RESPONSE_CACHE_MAX_BODY_SIZE", 1024 * 1024)
+)
+# Seconds stale responses with an ETag are kept to be revalidated
+RESPONSE_CACHE_STALE_TTL = float(os.environ.get("RESPONSE_CACHE_STALE_TTL", 300))
+# Defaults of the coalescing of identical GET requests, enabled in routes.yaml
+COALESCING_TIMEOUT = float(os.environ.get("COALESCING_TIMEOUT", 30))
+COALESCING_MAX_BODY_SIZE = int(os.environ.get("COALESCING_MAX_BODY_SIZE", 1024 * 1024))
+# Smallest response compressed on the routes with compression, enabled in routes.yaml
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+# Passive outlier ejection of the upstreams, can be overridden per route in routes.yaml
+UPSTREAM_MAX_FAILURES = int(os.environ.get("UPSTREAM_MAX_FAILURES", 5))
+UPSTREAM_EJECTION_TIME = float(os.environ.get("UPSTREAM_EJECTION_TIME", 30))
+# Circuit breakers of the upstreams, can be overridden per route in routes.yaml
+CIRCUIT_BREAKER_MAX_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_MAX_FAILURES", 10))
+CIRCUIT_BREAKER_OPEN_TIME = float(os.environ.get("CIRCUIT_BREAKER_OPEN_TIME", 10))
+# Keys of the in-memory rate limit store of a route, enabled in routes.yaml
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+# Path of the Prometheus metrics, disabled by default as it is served on the public
+# listener. When METRICS_TOKEN is set, scrapes must send it as a bearer token.
+# With several worker processes, METRICS_DIR is shared by the workers, and emptied
+# when the server starts.
+METRICS_PATH = os.environ.get("METRICS_PATH", "")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+# Proxy routes file, polled every ROUTES_RELOAD_INTERVAL seconds (0 to never reload)
+ROUTES_FILE = os.environ.get("ROUTES_FILE", "routes.yaml")
+ROUTES_RELOAD_INTERVAL = float(os.environ.get("ROUTES_RELOAD_INTERVAL", 5))
 
 # Computed
 OAUTH_BASE_URL = "https://" + OAUTH_DOMAIN
@@ -0,0 +1,79 @@
+import logging
+import time
+
+from app import settings
+
+_logger = logging.getLogger(__name__)
+
+
+class RequestBodyStream:
+    """
+    Iterable over the body of the incoming request, read chunk by chunk so that it is
+    never held in memory as a whole.
+
+    When the content length is known, `len()` returns it and requests forwards the
+    body with the same Content-Length. Otherwise `len()` is 0 and the body is sent with
+    chunked transfer encoding. The stream is always true: requests replaces false
+    bodies with an empty one.
+    """
+
+    def __init__(self, stream, content_length=None, chunk_size=None):
+        self.stream = stream
+        self.content_length = content_length or 0
+        self.chunk_size = chunk_size or settings.PROXY_CHUNK_SIZE
+
+    def __iter__(self):
+        while True:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def __len__(self):
+        return self.content_length
+
+    def __bool__(self):
+        return True
+
+
+def parse_content_length(value):
+    """
+    Parse a Content-Length header value, returning None when it is missing or
+    invalid (the length is then unknown).
+    """
+    value = (value or "").strip()
+    if not value.isdigit() or not value.isascii():
+        return None
+    return int(value)
+
+
+def get_request_body(request, chunk_size=None):
+    """
+    Return the body of the flask request as a stream to give to requests,
+    or None if the request has no body.
+    """
+    chunked = "chunked" in request.headers.get("Transfer-Encoding", "").lower()
+    if not request.content_length and not chunked:
+        return None
+    return RequestBodyStream(request.stream, request.content_length, chunk_size)
+
+
+def iter_response_body(response, chunk_size=None, deadline=None):
+    """
+    Yield the raw body of an upstream response (opened with stream=True) chunk by
+    chunk, and release its connection back to the pool once it is consumed or the
+    client goes away.
+    The body is not decoded, so that it still matches the upstream Content-Encoding
+    and Content-Length headers.
+    When the deadline (monotonic time) of the request passes, the body is cut short.
+    """
+    try:
+        for chunk in response.raw.stream(
+            chunk_size or settings.PROXY_CHUNK_SIZE, decode_content=False
+        ):
+            yield chunk
+            if deadline is not None and time.monotonic() >= deadline:
+                _logger.warning("Total timeout reached, cutting the response body")
+                break
+    finally:
+        response.close()
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import settings
+
+_logger = logging.getLogger(__name__)
+
+
+class UpstreamPool:
+    """
+    Keep-alive connection pool used to reach the upstream of a proxy route.
+
+    A single instance is shared by all the threads of a worker: the underlying urllib3
+    pools are thread-safe, only the (re)creation of the requests session is locked.
+    Connections left unused for more than `idle_timeout` seconds are dropped instead of
+    being reused, as the upstream (or a load balancer in between) has likely closed
+    them already.
+    """
+
+    def __init__(
+        self,
+        max_connections=None,
+        idle_timeout=None,
+        connect_timeout=None,
+        read_timeout=None,
+        total_timeout=None,
+    ):
+        self.max_connections = max_connections or settings.PROXY_POOL_MAX_CONNECTIONS
+        self.idle_timeout = (
+            settings.PROXY_POOL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        )
+        self.connect_timeout = connect_timeout or settings.PROXY_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or settings.PROXY_READ_TIMEOUT
+        # Bound of the whole exchange with the upstream, retries and response body
+        # included, or 0 for none
+        self.total_timeout = (
+            settings.PROXY_TOTAL_TIMEOUT if total_timeout is None else total_timeout
+        )
+        self._session = None
+        self._last_used = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_dict(pool=None, timeout=None):
+        """
+        Build the pool from the `pool` and `timeout` sections of a route
+        in routes.yaml.
+        """
+        pool = pool or {}
+        timeout = timeout or {}
+        return UpstreamPool(
+            max_connections=pool.get("max_connections"),
+            idle_timeout=pool.get("idle_timeout"),
+            connect_timeout=timeout.get("connect"),
+            read_timeout=timeout.get("read"),
+            total_timeout=timeout.get("total"),
+        )
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def get_deadline(self):
+        """
+        Monotonic time by which a request starting now must be over, or None.
+        """
+        if not self.total_timeout:
+            return None
+        return time.monotonic() + self.total_timeout
+
+    def get_timeout(self, deadline=None):
+        """
+        Connect and read timeouts of an attempt, shortened to end by the deadline.
+        """
+        if deadline is None:
+            return self.timeout
+        remaining = max(deadline - time.monotonic(), 0.001)
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    def _create_session(self):
+        session = requests.Session()
+        # Only the headers of the client request are sent, not the default ones of
+        # requests (Accept-Encoding: gzip would get a body the client may not decode)
+        session.headers.clear()
+        adapter = HTTPAdapter(
+            pool_maxsize=self.max_connections, pool_block=settings.PROXY_POOL_BLOCK
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get_session(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._session is None:
+                self._session = self._create_session()
+            elif self.idle_timeout and now - self._last_used > self.idle_timeout:
+                _logger.debug("Upstream pool idle, dropping its connections")
+                stale_session, self._session = self._session, self._create_session()
+                stale_session.close()
+            self._last_used = now
+            return self._session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.get_session().request(method=method, url=url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __repr__(self):
+        return (
+            f"<UpstreamPool max_connections={self.max_connections} "
+            f"idle_timeout={self.idle_timeout} timeout={self.timeout} "
+            f"total_timeout={self.total_timeout}>"
+        )
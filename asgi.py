@@ -0,0 +1,5 @@
+import logging
+from app.asgi import create_asgi_app
+
+gunicorn_logger = logging.getLogger("gunicorn.error")
+app = create_asgi_app(logger_override=gunicorn_logger)
@@ -0,0 +1,398 @@
+"""
+Load test of the proxy: start the application (create_app, with the mock OAuth
+client) and a stub upstream in their own processes, then drive /me, authenticated
+proxied GET and POST requests, and large uploads (with their length, or chunked), at a
+controlled concurrency.
+
+For each scenario, it reports the latency percentiles (p50, p90, p99), the requests
+per second, and the CPU time per request and the memory (RSS) of the proxy process,
+read from /proc (Linux only). The results are written as JSON, along with the commit
+they were measured on, and can be compared with the results of another commit.
+
+It does not need any running service, only the mandatory variables of the
+application:
+
+    set -a && source .env.test && set +a
+    ./venv/bin/python -m benchmarks.load_test --concurrency 8 --requests 2000
+    ./venv/bin/python -m benchmarks.load_test --compare benchmarks/results/abc1234.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+HOST = "127.0.0.1"
+RESULTS_DIR = Path(__file__).parent / "results"
+UPSTREAM_BODY = json.dumps(
+    {"items": [{"id": i, "name": f"item {i}"} for i in range(50)]}
+)
+POST_BODY = json.dumps({"name": "item", "tags": ["a", "b", "c"] * 50})
+UPLOAD_SIZE = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Scenarios: method, path, body, and the share of the requests they are run with
+SCENARIOS = {
+    "me": ("GET", "/me", None, 1),
+    "proxy_get": ("GET", "/bench/items", None, 1),
+    "proxy_post": ("POST", "/bench/items", POST_BODY, 1),
+    "upload": ("POST", "/bench/upload", "upload", 0.05),
+    "upload_chunked": ("POST", "/bench/upload", "upload_chunked", 0.05),
+}
+# Fields compared between two results, lower is better for all of them but rps
+COMPARED_FIELDS = ("rps", "p50_ms", "p99_ms", "cpu_ms_per_request", "rss_mb")
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, do not delay the body
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_body(UPSTREAM_BODY.encode())
+
+    def do_POST(self):
+        # Read the body in chunks, as an upstream receiving an upload would
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            received = self.read_chunked_body()
+        else:
+            received = self.read_body(int(self.headers.get("Content-Length") or 0))
+        self.send_body(json.dumps({"received": received}).encode())
+
+    def read_body(self, length):
+        remaining = length
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, UPLOAD_CHUNK_SIZE)))
+        return length
+
+    def read_chunked_body(self):
+        received = 0
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            received += self.read_body(size)
+            # The line ending the chunk, or the empty trailer
+            self.rfile.readline()
+            if not size:
+                return received
+
+    def send_body(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_upstream(port):
+    ThreadingHTTPServer((HOST, port), UpstreamHandler).serve_forever()
+
+
+def write_routes_file(upstream_port):
+    routes_file = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    with routes_file:
+        routes_file.write(
+            "routes:\n"
+            "  - name: bench\n"
+            "    path: /bench\n"
+            f"    upstream: http://{HOST}:{upstream_port}\n"
+        )
+    return routes_file.name
+
+
+def run_proxy(port, routes_file):
+    """
+    Serve the application with the threaded werkzeug server, the settings being read
+    from the environment when the application is imported.
+    """
+    os.environ["MOCK_OAUTH"] = "1"
+    os.environ["ROUTES_FILE"] = routes_file
+    os.environ.setdefault("ROUTES_RELOAD_INTERVAL", "0")
+
+    from werkzeug.serving import make_server
+
+    from app.app import create_app
+
+    app = create_app()
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    make_server(HOST, port, app, threaded=True).serve_forever()
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    raise Exception(f"{url} is not ready after {timeout} seconds")
+
+
+def read_process_stats(pid):
+    """
+    CPU time (user and system, in seconds), current and peak RSS (in bytes) of a
+    process, or None when /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            # The fields following the command name, which may contain spaces
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as status_file:
+            status = dict(
+                line.split(":", 1) for line in status_file.read().splitlines()
+            )
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    rss = int(status["VmRSS"].split()[0]) * 1024
+    peak_rss = int(status["VmHWM"].split()[0]) * 1024
+    return cpu, rss, peak_rss
+
+
+def login(base_url):
+    """
+    Authenticated HTTP session, through /callback of the mock OAuth client.
+    """
+    http = requests.Session()
+    response = http.get(f"{base_url}/callback", allow_redirects=False)
+    if response.status_code != 302 or "session" not in http.cookies:
+        raise Exception(f"Could not log in: {response.status_code}")
+    return http
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def run_scenario(base_url, name, total, concurrency, pid):
+    method, path, body, _ = SCENARIOS[name]
+    sessions = [login(base_url) for _ in range(concurrency)]
+    latencies = []
+    errors = []
+    remaining = [total]
+    lock = threading.Lock()
+    upload = b"x" * UPLOAD_SIZE if body in ("upload", "upload_chunked") else None
+
+    def worker(http):
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            failed = not send_request(http, method, base_url + path, body, upload)
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                if failed:
+                    errors.append(latency)
+
+    threads = [threading.Thread(target=worker, args=(http,)) for http in sessions]
+    before = read_process_stats(pid)
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    after = read_process_stats(pid)
+    for http in sessions:
+        http.close()
+    return summarize(latencies, len(errors), concurrency, elapsed, before, after)
+
+
+def send_request(http, method, url, body, upload):
+    """
+    Send a request of the scenario, return whether it succeeded.
+    """
+    headers = {"Content-Type": "application/json"} if body else {}
+    try:
+        response = http.request(
+            method, url, data=get_request_data(body, upload), headers=headers
+        )
+        if response.status_code >= 400:
+            return False
+        # The upstream answers with the size of the upload it received
+        return not upload or response.json().get("received") == len(upload)
+    except (requests.RequestException, ValueError):
+        return False
+
+
+def get_request_data(body, upload):
+    """
+    Body to send: the upload with its length, or as a generator of unknown length
+    (sent chunked by requests).
+    """
+    if body == "upload":
+        return upload
+    if body == "upload_chunked":
+        return (
+            upload[start : start + UPLOAD_CHUNK_SIZE]
+            for start in range(0, len(upload), UPLOAD_CHUNK_SIZE)
+        )
+    return body
+
+
+def summarize(latencies, errors, concurrency, elapsed, before, after):
+    """
+    Result of a scenario, from the latencies of its requests, its duration, and the
+    stats of the proxy process before and after it.
+    """
+    total = len(latencies)
+    latencies.sort()
+    result = {
+        "requests": total,
+        "errors": errors,
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+    if before and after:
+        result["cpu_ms_per_request"] = round((after[0] - before[0]) / total * 1000, 3)
+        result["rss_mb"] = round(after[1] / 1024 / 1024, 1)
+        result["peak_rss_mb"] = round(after[2] / 1024 / 1024, 1)
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f"\nCompared to {baseline.get('commit')} ({baseline.get('date')}):")
+    for name, result in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        changes = []
+        for field in COMPARED_FIELDS:
+            if result.get(field) is None or not base.get(field):
+                continue
+            change = (result[field] - base[field]) / base[field] * 100
+            changes.append(f"{field} {change:+.1f}%")
+        print(f"  {name}: {', '.join(changes)}")
+
+
+def print_result(name, result):
+    line = (
+        f"{name}: {result['rps']} req/s, p50 {result['p50_ms']} ms, "
+        f"p99 {result['p99_ms']} ms, {result['errors']} errors"
+    )
+    if "cpu_ms_per_request" in result:
+        line += (
+            f", {result['cpu_ms_per_request']} ms CPU/req, "
+            f"RSS {result['rss_mb']} MB (peak {result['peak_rss_mb']} MB)"
+        )
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON results of another commit")
+    args = parser.parse_args()
+
+    # The processes do not need anything from this one, forked or not
+    context = multiprocessing.get_context("spawn")
+    upstream_port, port = get_free_port(), get_free_port()
+    routes_file = write_routes_file(upstream_port)
+    upstream = context.Process(target=run_upstream, args=(upstream_port,), daemon=True)
+    proxy = context.Process(target=run_proxy, args=(port, routes_file), daemon=True)
+    upstream.start()
+    proxy.start()
+    base_url = f"http://{HOST}:{port}"
+    try:
+        wait_until_ready(f"http://{HOST}:{upstream_port}/")
+        wait_until_ready(f"{base_url}/")
+        results = {
+            "commit": get_commit(),
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            share = SCENARIOS[name][3]
+            if args.warmup:
+                run_scenario(
+                    base_url,
+                    name,
+                    max(1, int(args.warmup * share)),
+                    args.concurrency,
+                    proxy.pid,
+                )
+            result = run_scenario(
+                base_url,
+                name,
+                max(1, int(args.requests * share)),
+                args.concurrency,
+                proxy.pid,
+            )
+            results["scenarios"][name] = result
+            print_result(name, result)
+    finally:
+        proxy.terminate()
+        upstream.terminate()
+        os.unlink(routes_file)
+
+    output = Path(
+        args.output or RESULTS_DIR / f"load_test-{results['commit'] or 'unknown'}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == "__main__":
+    main()
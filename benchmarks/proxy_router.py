@@ -0,0 +1,72 @@
+"""
+Compare the dispatch of a proxied request with 1000 routes: one werkzeug rule per
+route (before), and the proxy router (after).
+
+It does not need any running service, only the mandatory variables of the
+application:
+
+    set -a && source .env.test && set +a
+    ./venv/bin/python -m benchmarks.proxy_router
+"""
+import random
+import time
+
+from werkzeug.routing import Map, Rule
+
+from app.proxy_routes import PROXY_METHODS, ProxyRoute, ProxyRouter
+
+ROUTES = 1000
+ITERATIONS = 100000
+
+
+def create_routes():
+    return [
+        ProxyRoute(f"service{i}", f"/services/{i}", f"http://service{i}:8080")
+        for i in range(ROUTES)
+    ]
+
+
+def create_url_map(routes):
+    url_map = Map(
+        [
+            Rule(
+                f"{route.path}/<path:path>", endpoint=route.name, methods=PROXY_METHODS
+            )
+            for route in routes
+        ]
+    )
+    return url_map.bind("localhost")
+
+
+def run(name, match, paths):
+    start = time.perf_counter()
+    for path in paths:
+        match(path)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed / len(paths) * 1e6:.2f} us per request")
+
+
+def main():
+    routes = create_routes()
+    paths = [
+        f"/services/{random.randrange(ROUTES)}/items/{i}" for i in range(ITERATIONS)
+    ]
+
+    url_adapter = create_url_map(routes)
+    routes_by_name = {route.name: route for route in routes}
+
+    def match_before(path):
+        endpoint, args = url_adapter.match(path, "GET")
+        return routes_by_name[endpoint], args["path"]
+
+    router = ProxyRouter(routes)
+
+    def match_after(path):
+        return router.match(path, "GET")
+
+    run("before (werkzeug rules)", match_before, paths)
+    run("after (proxy router)", match_after, paths)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compare the redis round trips made to create the server-side session at login:
+HMSET then EXPIRE (before), and a single SET of the serialized session (after).
+
+It needs a running redis, configured with the REDIS_ environment variables, along with
+the mandatory variables of the application:
+
+    set -a && source .env.test && set +a
+    ./venv/bin/python -m benchmarks.session_round_trips
+"""
+import time
+import uuid
+
+from redis.connection import Connection
+
+from app.oauth.mock_data import ACCESS_TOKEN, ID_TOKEN
+from app.session import RedisSessionManager
+
+ITERATIONS = 1000
+PAYLOAD = {
+    "access_token": ACCESS_TOKEN,
+    "id_token": ID_TOKEN,
+    "expires_in": 3600,
+    "scope": "openid profile",
+    "token_type": "Bearer",
+}
+
+round_trips = 0
+_send_packed_command = Connection.send_packed_command
+
+
+def _counting_send_packed_command(self, *args, **kwargs):
+    # A pipeline packs all its commands in a single send
+    global round_trips
+    round_trips += 1
+    return _send_packed_command(self, *args, **kwargs)
+
+
+def create_session_before(manager, session_id):
+    manager.redis.hset(session_id, mapping=PAYLOAD)
+    manager.redis.expire(session_id, 3600)
+
+
+def create_session_after(manager, session_id):
+    manager.create_session(session_id, PAYLOAD, expire_seconds=3600)
+
+
+def run(name, create_session, manager):
+    global round_trips
+    session_ids = [uuid.uuid4().hex for _ in range(ITERATIONS)]
+    round_trips = 0
+    start = time.perf_counter()
+    for session_id in session_ids:
+        create_session(manager, session_id)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name}: {round_trips / ITERATIONS:.1f} round trips per login, "
+        f"{elapsed / ITERATIONS * 1e6:.0f} us per login"
+    )
+    manager.redis.delete(*session_ids)
+
+
+def main():
+    Connection.send_packed_command = _counting_send_packed_command
+    manager = RedisSessionManager()
+    run("before (HMSET + EXPIRE)", create_session_before, manager)
+    run("after (SET EX)", create_session_after, manager)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from unittest.mock import MagicMock
+
+import requests
+
+from app.balancers import (
+    CONSISTENT_HASH,
+    LEAST_OUTSTANDING,
+    UpstreamBalancer,
+    build_lookup_table,
+)
+
+URLS = ["http://api-1:8080", "http://api-2:8080", "http://api-3:8080"]
+
+
+def _urls(upstreams):
+    return [upstream.url for upstream in upstreams]
+
+
+class TestUpstreamBalancer:
+    def test_single_upstream(self):
+        balancer = UpstreamBalancer("http://api:8080/")
+        assert balancer.select().url == "http://api:8080"
+
+    def test_round_robin(self):
+        balancer = UpstreamBalancer(URLS)
+        assert _urls(balancer.select() for _ in range(6)) == URLS + URLS
+
+    def test_least_outstanding(self):
+        balancer = UpstreamBalancer(URLS[:2], balancing=LEAST_OUTSTANDING)
+        busy, idle = balancer.upstreams
+        balancer.acquire(busy)
+        assert {balancer.select().url for _ in range(10)} == {idle.url}
+        balancer.release(busy, 200)
+        assert busy.outstanding == 0
+
+    def test_consistent_hash(self):
+        balancer = UpstreamBalancer(URLS, balancing=CONSISTENT_HASH)
+        sessions = [f"session-{i}" for i in range(300)]
+        selected = {session: balancer.select(session).url for session in sessions}
+        # Stable, and spread over all the upstreams
+        assert selected == {
+            session: balancer.select(session).url for session in sessions
+        }
+        assert set(selected.values()) == set(URLS)
+
+        # The sessions of an ejected upstream move, nearly all the others stay
+        ejected = balancer.upstreams[0]
+        ejected.healthy = False
+        balancer.update()
+        moved = 0
+        for session, url in selected.items():
+            if url == ejected.url:
+                assert balancer.select(session).url != url
+            elif balancer.select(session).url != url:
+                moved += 1
+        assert moved <= len(sessions) * 0.05
+
+    def test_lookup_table(self):
+        balancer = UpstreamBalancer(URLS)
+        table = build_lookup_table(balancer.upstreams, size=101)
+        assert len(table) == 101
+        counts = [table.count(upstream) for upstream in balancer.upstreams]
+        assert max(counts) - min(counts) <= 1
+
+    def test_outlier_ejection(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr("app.balancers.time.monotonic", lambda: now[0])
+        balancer = UpstreamBalancer(URLS[:2], max_failures=2, ejection_time=30)
+        failing, healthy = balancer.upstreams
+
+        for status in (502, None):
+            balancer.acquire(failing)
+            balancer.release(failing, status)
+        assert _urls(balancer.available) == [healthy.url]
+        assert {balancer.select().url for _ in range(4)} == {healthy.url}
+
+        # Back once the ejection time is over
+        now[0] += 31
+        assert {balancer.select().url for _ in range(4)} == set(URLS[:2])
+
+    def test_success_resets_failures(self):
+        balancer = UpstreamBalancer(URLS[:2], max_failures=2)
+        upstream = balancer.upstreams[0]
+        for status in (500, 200, 500):
+            balancer.acquire(upstream)
+            balancer.release(upstream, status)
+        assert len(balancer.available) == 2
+
+    def test_all_upstreams_unavailable(self):
+        balancer = UpstreamBalancer(URLS[:2])
+        for upstream in balancer.upstreams:
+            upstream.healthy = False
+        balancer.update()
+        assert _urls(balancer.available) == URLS[:2]
+
+    def test_circuit_breaker(self):
+        balancer = UpstreamBalancer(
+            URLS[:2], max_failures=10, circuit_breaker={"max_failures": 1}
+        )
+        failing, healthy = balancer.upstreams
+        balancer.acquire(failing)
+        balancer.release(failing, None)
+        # Still available, but skipped while its circuit is open
+        assert len(balancer.available) == 2
+        assert {balancer.select().url for _ in range(4)} == {healthy.url}
+
+        balancer.acquire(healthy)
+        balancer.release(healthy, 503)
+        assert balancer.select() is None
+
+    def test_without_circuit_breaker(self):
+        balancer = UpstreamBalancer(URLS[:1], circuit_breaker=False)
+        upstream = balancer.upstreams[0]
+        for _ in range(20):
+            balancer.acquire(upstream)
+            balancer.release(upstream, None)
+        assert balancer.select() is upstream
+
+    def test_health_checks(self):
+        balancer = UpstreamBalancer(URLS[:2], health_check={"path": "/health"})
+        session = MagicMock()
+
+        def get(url, timeout):
+            if url == "http://api-1:8080/health":
+                raise requests.ConnectionError()
+            return MagicMock(ok=True)
+
+        session.get = get
+        assert balancer.check_health(session)
+        assert _urls(balancer.available) == ["http://api-2:8080"]
+        assert not balancer.check_health(session)
+
+    def test_from_dict(self):
+        balancer = UpstreamBalancer.from_dict(
+            URLS,
+            balancing=LEAST_OUTSTANDING,
+            outlier={"max_failures": 3, "ejection_time": 10},
+        )
+        assert balancer.balancing == LEAST_OUTSTANDING
+        assert balancer.max_failures == 3
+        assert balancer.ejection_time == 10
@@ -0,0 +1,47 @@
+from app.circuit_breakers import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class TestCircuitBreaker:
+    def test_opens_after_failures(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr("app.circuit_breakers.time.monotonic", lambda: now[0])
+        breaker = CircuitBreaker(max_failures=3, open_time=10)
+        for _ in range(2):
+            breaker.record(True)
+        assert breaker.state == CLOSED
+        assert breaker.allow()
+        breaker.record(True)
+        assert breaker.state == OPEN
+        assert not breaker.allow()
+
+        # A single probe once the open time is over
+        now[0] += 11
+        assert breaker.allow()
+        assert breaker.state == HALF_OPEN
+        assert not breaker.allow()
+        breaker.record(False)
+        assert breaker.state == CLOSED
+        assert breaker.allow()
+
+    def test_failed_probe_opens_again(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr("app.circuit_breakers.time.monotonic", lambda: now[0])
+        breaker = CircuitBreaker(max_failures=1, open_time=10)
+        breaker.record(True)
+        now[0] += 11
+        assert breaker.allow()
+        breaker.record(True)
+        assert breaker.state == OPEN
+        assert not breaker.allow()
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(max_failures=2)
+        for failed in (True, False, True):
+            breaker.record(failed)
+        assert breaker.state == CLOSED
+
+    def test_from_dict(self):
+        assert CircuitBreaker.from_dict(False) is None
+        assert CircuitBreaker.from_dict(None).state == CLOSED
+        breaker = CircuitBreaker.from_dict({"max_failures": 3, "open_time": 5})
+        assert (breaker.max_failures, breaker.open_time) == (3, 5)
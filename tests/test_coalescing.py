@@ -0,0 +1,139 @@
+import threading
+import time
+
+import pytest
+from requests.structures import CaseInsensitiveDict
+
+from app.coalescing import RequestCoalescer, is_shareable
+
+
+def _run_concurrently(coalescer, fetch, count=5):
+    """
+    Run `count` calls with the same key while the first one is in flight.
+    """
+    results = [None] * count
+    threads = []
+
+    def call(index):
+        try:
+            results[index] = coalescer.run("key", fetch)
+        except Exception as exc:
+            results[index] = exc
+
+    for index in range(count):
+        thread = threading.Thread(target=call, args=(index,))
+        thread.start()
+        threads.append(thread)
+    return results, threads
+
+
+class TestRequestCoalescer:
+    def test_single_flight(self):
+        coalescer = RequestCoalescer("test")
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return "response", True
+
+        results, threads = _run_concurrently(coalescer, fetch)
+        # Let the followers wait for the first call
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert results == ["response"] * 5
+        assert len(calls) == 1
+        assert coalescer.coalesced == 4
+        assert coalescer.in_flight == 0
+
+    def test_not_shared(self):
+        coalescer = RequestCoalescer("test")
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return f"streamed-{len(calls)}", False
+
+        results, threads = _run_concurrently(coalescer, fetch, count=3)
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(calls) == len(set(results))
+        assert coalescer.coalesced == 0
+
+    def test_error_raised_for_all(self):
+        coalescer = RequestCoalescer("test")
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            raise ConnectionError("upstream down")
+
+        results, threads = _run_concurrently(coalescer, fetch, count=3)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        assert all(isinstance(result, ConnectionError) for result in results)
+
+    def test_timeout(self):
+        coalescer = RequestCoalescer("test", timeout=0.01)
+        flight_started = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch():
+            flight_started.set()
+            release.wait(5)
+            return "slow", True
+
+        leader = threading.Thread(target=coalescer.run, args=("key", slow_fetch))
+        leader.start()
+        flight_started.wait(5)
+        assert coalescer.run("key", lambda: ("own", True)) == "own"
+        release.set()
+        leader.join(5)
+
+    def test_key(self):
+        coalescer = RequestCoalescer("test", vary=["Accept"])
+        key = coalescer.key("a?", {"accept": "text/html"}, "user-1")
+        assert key == coalescer.key("a?", {"accept": "text/html"}, "user-1")
+        assert key != coalescer.key("a?", {"accept": "text/html"}, "user-2")
+        assert key != coalescer.key("a?", {"accept": "application/json"}, "user-1")
+        assert key != coalescer.key(
+            "a?", {"accept": "text/html", "if-none-match": '"v1"'}, "user-1"
+        )
+        assert key != coalescer.key(
+            "a?", {"accept": "text/html", "cookie": "theme=dark"}, "user-1"
+        )
+
+    @pytest.mark.parametrize(
+        "headers, shareable",
+        [
+            ({}, True),
+            ({"Cache-Control": "public, max-age=60"}, True),
+            ({"Cache-Control": "no-cache"}, True),
+            ({"Cache-Control": "no-store"}, False),
+            ({"Cache-Control": "private, max-age=60"}, False),
+            ({"set-cookie": "session=abc"}, False),
+        ],
+    )
+    def test_is_shareable(self, headers, shareable):
+        assert is_shareable(CaseInsensitiveDict(headers)) is shareable
+
+    @pytest.mark.parametrize(
+        "coalesce, enabled", [(None, False), (False, False), (True, True), ({}, False)]
+    )
+    def test_from_dict(self, coalesce, enabled):
+        assert bool(RequestCoalescer.from_dict("test", coalesce)) == enabled
+
+    def test_from_dict_settings(self):
+        coalescer = RequestCoalescer.from_dict("test", {"timeout": 5, "vary": ["A"]})
+        assert coalescer.timeout == 5
+        assert coalescer.vary == ["a"]
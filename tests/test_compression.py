@@ -0,0 +1,133 @@
+import zlib
+
+import pytest
+from requests.structures import CaseInsensitiveDict
+
+from app.compression import ResponseCompressor, is_available
+
+BODY = b'{"items": ["a value repeated to be compressed"]}' * 100
+
+
+def _headers(**headers):
+    base = {"Content-Type": "application/json", "Content-Length": str(len(BODY))}
+    base.update({name.replace("_", "-"): value for name, value in headers.items()})
+    return CaseInsensitiveDict({k: v for k, v in base.items() if v is not None})
+
+
+class TestResponseCompressor:
+    def test_from_dict(self):
+        assert ResponseCompressor.from_dict(None) is None
+        assert ResponseCompressor.from_dict(False) is None
+        compressor = ResponseCompressor.from_dict(True)
+        assert "gzip" in compressor.encodings
+        compressor = ResponseCompressor.from_dict(
+            {"level": {"gzip": 9}, "min_size": 10, "encodings": ["gzip"]}
+        )
+        assert compressor.levels["gzip"] == 9
+        assert compressor.min_size == 10
+        assert compressor.encodings == ["gzip"]
+
+    def test_level_for_all_encodings(self):
+        compressor = ResponseCompressor(level=1)
+        assert set(compressor.levels.values()) == {1}
+
+    def test_get_encoding(self):
+        compressor = ResponseCompressor(encodings=["gzip"])
+        assert compressor.get_encoding(None) is None
+        assert compressor.get_encoding("identity") is None
+        assert compressor.get_encoding("gzip, deflate") == "gzip"
+        assert compressor.get_encoding("*") == "gzip"
+        assert compressor.get_encoding("gzip;q=0") is None
+
+    @pytest.mark.skipif(not is_available("zstd"), reason="zstandard not installed")
+    def test_get_encoding_preference(self):
+        compressor = ResponseCompressor(encodings=["zstd", "gzip"])
+        assert compressor.get_encoding("gzip, zstd") == "zstd"
+        assert compressor.get_encoding("gzip, zstd;q=0.5") == "gzip"
+
+    def test_accepts(self):
+        compressor = ResponseCompressor(min_size=1024)
+        assert compressor.accepts(200, _headers())
+        assert compressor.accepts(200, _headers(Content_Length=None))
+        assert compressor.accepts(200, _headers(Content_Length="2048, 2048"))
+        assert compressor.accepts(200, _headers(Content_Type="text/html"))
+        assert not compressor.accepts(200, _headers(Content_Type="image/png"))
+        assert not compressor.accepts(200, _headers(Content_Length="10"))
+        assert not compressor.accepts(204, _headers())
+        assert not compressor.accepts(304, _headers())
+        assert not compressor.accepts(206, _headers(Content_Range="bytes 0-9/100"))
+        assert not compressor.accepts(200, _headers(Cache_Control="no-transform"))
+
+    def test_accepts_already_encoded(self):
+        compressor = ResponseCompressor()
+        assert not compressor.accepts(200, _headers(Content_Encoding="gzip"))
+        assert not compressor.accepts(200, _headers(Content_Encoding="br"))
+        assert compressor.accepts(200, _headers(Content_Encoding="identity"))
+
+    def test_get_headers(self):
+        compressor = ResponseCompressor()
+        headers = compressor.get_headers(
+            [
+                ("Content-Type", "application/json"),
+                ("Content-Length", "4800"),
+                ("ETag", '"abc"'),
+                ("Vary", "Origin"),
+            ],
+            "gzip",
+        )
+        assert headers == [
+            ("Content-Type", "application/json"),
+            ("ETag", 'W/"abc"'),
+            ("Content-Encoding", "gzip"),
+            ("Vary", "Origin, Accept-Encoding"),
+        ]
+
+    def test_compress_gzip(self):
+        compressor = ResponseCompressor()
+        chunks = [BODY[:1000], BODY[1000:3000], BODY[3000:]]
+        compressed = list(compressor.compress(iter(chunks), "gzip"))
+        # A compressed chunk is sent for each chunk of the upstream body
+        assert len(compressed) == len(chunks) + 1
+        data = b"".join(compressed)
+        assert len(data) < len(BODY)
+        assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == BODY
+
+    def test_compress_streams(self):
+        compressor = ResponseCompressor()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(iter([b"first", b"second"]), "gzip")
+        # Each chunk can be decompressed as soon as it is received
+        assert decompressor.decompress(next(compressed)) == b"first"
+        assert decompressor.decompress(next(compressed)) == b"second"
+
+    def test_compress_closes_chunks(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield b"first"
+                yield b"second"
+            finally:
+                closed.append(True)
+
+        compressed = ResponseCompressor().compress(chunks(), "gzip")
+        next(compressed)
+        compressed.close()
+        assert closed == [True]
+
+    @pytest.mark.skipif(not is_available("zstd"), reason="zstandard not installed")
+    def test_compress_zstd(self):
+        import zstandard
+
+        compressor = ResponseCompressor()
+        data = b"".join(compressor.compress(iter([BODY[:1000], BODY[1000:]]), "zstd"))
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        assert decompressor.decompress(data) == BODY
+
+    @pytest.mark.skipif(not is_available("br"), reason="brotli not installed")
+    def test_compress_brotli(self):
+        import brotli
+
+        compressor = ResponseCompressor()
+        data = b"".join(compressor.compress(iter([BODY[:1000], BODY[1000:]]), "br"))
+        assert brotli.decompress(data) == BODY
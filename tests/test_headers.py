@@ -0,0 +1,134 @@
+from app.headers import (
+    HeaderPipeline,
+    get_forwarded_element,
+    join_repeated_headers,
+)
+
+
+class TestHeaderPipeline:
+    def test_request_headers(self):
+        pipeline = HeaderPipeline(forwarded=False)
+        headers = pipeline.request_headers(
+            [
+                ("Accept", "application/json"),
+                ("Connection", "keep-alive, X-Private"),
+                ("Keep-Alive", "timeout=5"),
+                ("Transfer-Encoding", "chunked"),
+                ("TE", "trailers"),
+                ("X-Private", "hop"),
+                ("Authorization", "Bearer fake"),
+                ("X-Userinfo", "fake"),
+            ],
+            {"Authorization": "Bearer stored", "X-Userinfo": "c3RvcmVk"},
+        )
+        assert headers == [
+            ("Accept", "application/json"),
+            ("Authorization", "Bearer stored"),
+            ("X-Userinfo", "c3RvcmVk"),
+        ]
+
+    def test_allow_and_deny(self):
+        pipeline = HeaderPipeline(
+            allow=["Accept", "Cookie"], deny=["cookie"], forwarded=False
+        )
+        headers = pipeline.request_headers(
+            [("Accept", "*/*"), ("Cookie", "session=1"), ("User-Agent", "test")]
+        )
+        assert headers == [("Accept", "*/*")]
+
+    def test_forwarded_headers(self):
+        pipeline = HeaderPipeline()
+        headers = pipeline.request_headers(
+            [("Accept", "*/*")], None, "10.0.0.1", "https", "example.com"
+        )
+        assert headers == [
+            ("Accept", "*/*"),
+            ("X-Forwarded-For", "10.0.0.1"),
+            ("Forwarded", "for=10.0.0.1;host=example.com;proto=https"),
+            ("X-Forwarded-Proto", "https"),
+            ("X-Forwarded-Host", "example.com"),
+        ]
+
+    def test_forwarded_headers_appended(self):
+        pipeline = HeaderPipeline()
+        headers = dict(
+            pipeline.request_headers(
+                [
+                    ("X-Forwarded-For", "1.2.3.4"),
+                    ("Forwarded", "for=1.2.3.4"),
+                    ("X-Forwarded-Proto", "https"),
+                ],
+                None,
+                "10.0.0.1",
+                "http",
+                "proxy:5000",
+            )
+        )
+        assert headers["X-Forwarded-For"] == "1.2.3.4, 10.0.0.1"
+        assert (
+            headers["Forwarded"]
+            == 'for=1.2.3.4, for=10.0.0.1;host="proxy:5000";proto=http'
+        )
+        # Set by a proxy in front
+        assert headers["X-Forwarded-Proto"] == "https"
+        assert headers["X-Forwarded-Host"] == "proxy:5000"
+
+    def test_forwarded_headers_repeated(self):
+        pipeline = HeaderPipeline()
+        headers = dict(
+            pipeline.request_headers(
+                [("X-Forwarded-For", "1.2.3.4"), ("X-Forwarded-For", "5.6.7.8")],
+                None,
+                "10.0.0.1",
+            )
+        )
+        assert headers["X-Forwarded-For"] == "1.2.3.4, 5.6.7.8, 10.0.0.1"
+
+    def test_join_repeated_headers(self):
+        assert join_repeated_headers(
+            [
+                ("Accept", "text/html"),
+                ("X-Tag", "a"),
+                ("accept", "application/json"),
+                ("Cookie", "a=1"),
+                ("Cookie", "b=2"),
+            ]
+        ) == {
+            "Accept": "text/html, application/json",
+            "X-Tag": "a",
+            "Cookie": "a=1; b=2",
+        }
+
+    def test_forwarded_element_ipv6(self):
+        assert get_forwarded_element("::1", None, None) == 'for="[::1]"'
+
+    def test_response_headers(self):
+        pipeline = HeaderPipeline(response_deny=["Server"])
+        headers = pipeline.response_headers(
+            [
+                ("Content-Type", "application/json"),
+                ("Content-Length", "2"),
+                ("Transfer-Encoding", "chunked"),
+                ("Connection", "close, X-Hop"),
+                ("X-Hop", "1"),
+                ("Server", "upstream"),
+                ("Set-Cookie", "a=1"),
+                ("Set-Cookie", "b=2"),
+            ]
+        )
+        assert headers == [
+            ("Content-Type", "application/json"),
+            ("Content-Length", "2"),
+            ("Set-Cookie", "a=1"),
+            ("Set-Cookie", "b=2"),
+        ]
+
+    def test_from_dict(self):
+        pipeline = HeaderPipeline.from_dict(
+            {"allow": ["Accept"], "deny": ["Cookie"], "forwarded": False}
+        )
+        assert pipeline.allow == {"accept"}
+        assert "cookie" in pipeline.deny
+        assert "transfer-encoding" in pipeline.deny
+        assert not pipeline.forwarded
+        assert HeaderPipeline.from_dict(None).forwarded
@@ -0,0 +1,114 @@
+import json
+import os
+
+from app import metrics
+from app.metrics import MetricsRegistry, RequestTracker, get_status_class
+
+
+def create_registry(directory=None):
+    registry = MetricsRegistry(directory)
+    requests = registry.counter("requests_total", "Requests.", ("route", "status"))
+    in_flight = registry.gauge("in_flight", "In flight.", ("route",))
+    duration = registry.histogram(
+        "duration_seconds", "Duration.", ("route",), buckets=(0.1, 1)
+    )
+    return registry, requests, in_flight, duration
+
+
+def dead_pid():
+    # Pids are below pid_max, 4194304 at most
+    return 4194304 + 1
+
+
+class TestMetricsRegistry:
+    def test_render(self):
+        registry, requests, in_flight, duration = create_registry()
+        requests.inc("api", "2xx")
+        requests.inc("api", "2xx")
+        requests.inc("api", "5xx")
+        in_flight.inc("api")
+        duration.observe(0.05, "api")
+        duration.observe(0.1, "api")
+        duration.observe(0.5, "api")
+        duration.observe(2, "api")
+
+        assert registry.render() == (
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{route="api",status="2xx"} 2\n'
+            'requests_total{route="api",status="5xx"} 1\n'
+            "# HELP in_flight In flight.\n"
+            "# TYPE in_flight gauge\n"
+            'in_flight{route="api"} 1\n'
+            "# HELP duration_seconds Duration.\n"
+            "# TYPE duration_seconds histogram\n"
+            'duration_seconds_bucket{route="api",le="0.1"} 2\n'
+            'duration_seconds_bucket{route="api",le="1"} 3\n'
+            'duration_seconds_bucket{route="api",le="+Inf"} 4\n'
+            'duration_seconds_sum{route="api"} 2.65\n'
+            'duration_seconds_count{route="api"} 4\n'
+        )
+
+    def test_render_escapes_labels(self):
+        registry, requests, _, _ = create_registry()
+        requests.inc('a "route"\\\n', "2xx")
+        assert 'route="a \\"route\\"\\\\\\n"' in registry.render()
+
+    def test_histogram_timer(self):
+        registry, _, _, duration = create_registry()
+        with duration.time("api"):
+            pass
+        assert 'duration_seconds_bucket{route="api",le="0.1"} 1' in registry.render()
+
+    def test_flush(self, tmp_path):
+        registry, requests, _, _ = create_registry(str(tmp_path))
+        requests.inc("api", "2xx")
+        registry.flush()
+
+        snapshot = json.loads(registry.get_path().read_text())
+        assert snapshot["requests_total"] == [[["api", "2xx"], 1]]
+        assert not list(tmp_path.glob("*.tmp"))
+
+    def test_collect_other_processes(self, tmp_path):
+        registry, requests, in_flight, duration = create_registry(str(tmp_path))
+        requests.inc("api", "2xx")
+        in_flight.inc("api")
+        duration.observe(0.5, "api")
+        # A running process (the parent of the tests), and one that exited
+        other = {
+            "requests_total": [[["api", "2xx"], 2], [["other", "2xx"], 1]],
+            "in_flight": [[["api"], 3]],
+            "duration_seconds": [[["api"], [1, 0, 0, 0.25]]],
+        }
+        for pid in [os.getppid(), dead_pid()]:
+            registry.get_path(pid).write_text(json.dumps(other))
+
+        values = registry.collect()
+
+        # Counters of the processes that exited are kept, not their gauges
+        assert values["requests_total"] == {("api", "2xx"): 5, ("other", "2xx"): 2}
+        assert values["in_flight"] == {("api",): 4}
+        assert values["duration_seconds"] == {("api",): [2, 1, 0, 1]}
+
+
+class TestRequestTracker:
+    def test_finish(self):
+        def values(metric):
+            return {tuple(labels): value for labels, value in metric.snapshot()}
+
+        tracker = RequestTracker("tracked", "GET")
+        assert values(metrics.proxy_requests_in_flight)[("tracked",)] == 1
+
+        tracker.finish(502)
+        tracker.finish(502)
+
+        assert values(metrics.proxy_requests_in_flight)[("tracked",)] == 0
+        assert values(metrics.proxy_requests)[("tracked", "GET", "5xx")] == 1
+        buckets = values(metrics.proxy_request_duration)[("tracked", "GET", "5xx")]
+        assert sum(buckets[:-1]) == 1
+
+
+def test_get_status_class():
+    assert get_status_class(200) == "2xx"
+    assert get_status_class(304) == "3xx"
+    assert get_status_class(504) == "5xx"
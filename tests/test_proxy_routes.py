@@ -0,0 +1,88 @@
+from app.proxy_routes import ProxyRoute, ProxyRouter
+
+
+def _route(name, path, **kwargs):
+    return ProxyRoute(name, path, f"http://{name}:8080", **kwargs)
+
+
+class TestProxyRouter:
+    def test_match(self):
+        route = _route("api", "/api")
+        router = ProxyRouter([route])
+        assert router.match("/api/users/1", "GET") == (route, "users/1")
+        assert router.match("/apis/users", "GET") == (None, None)
+        assert router.match("/other", "GET") == (None, None)
+
+    def test_match_needs_a_path_after_the_route(self):
+        router = ProxyRouter([_route("api", "/api")])
+        assert router.match("/api", "GET") == (None, None)
+        assert router.match("/api/", "GET") == (None, None)
+
+    def test_longest_prefix(self):
+        api = _route("api", "/api")
+        v2 = _route("v2", "/api/v2/")
+        router = ProxyRouter([api, v2])
+        assert router.match("/api/v2/users", "GET") == (v2, "users")
+        assert router.match("/api/v1/users", "GET") == (api, "v1/users")
+        # Nothing left for /api/v2, falls back to /api
+        assert router.match("/api/v2/", "GET") == (api, "v2/")
+
+    def test_root_route(self):
+        root = _route("root", "/")
+        api = _route("api", "/api")
+        router = ProxyRouter([root, api])
+        assert router.match("/api/users", "GET") == (api, "users")
+        assert router.match("/other/users", "GET") == (root, "other/users")
+        assert router.match("/", "GET") == (None, None)
+
+    def test_method_constraint(self):
+        read = _route("read", "/api", methods=["get"])
+        write = _route("write", "/api", methods=["POST", "PUT"])
+        router = ProxyRouter([read, write])
+        assert router.match("/api/users", "GET") == (read, "users")
+        assert router.match("/api/users", "POST") == (write, "users")
+        assert router.match("/api/users", "DELETE") == (None, None)
+        # CORS preflight requests
+        assert router.match("/api/users", "OPTIONS") == (read, "users")
+
+    def test_method_constraint_falls_back_to_shorter_prefix(self):
+        api = _route("api", "/api")
+        upload = _route("upload", "/api/upload", methods=["POST"])
+        router = ProxyRouter([api, upload])
+        assert router.match("/api/upload/1", "POST") == (upload, "1")
+        assert router.match("/api/upload/1", "GET") == (api, "upload/1")
+
+    def test_host_constraint(self):
+        internal = _route("internal", "/api", host="Internal.example.com")
+        public = _route("public", "/api")
+        router = ProxyRouter([internal, public])
+        assert router.match("/api/a", "GET", "internal.example.com:8080") == (
+            internal,
+            "a",
+        )
+        assert router.match("/api/a", "GET", "www.example.com") == (public, "a")
+
+    def test_many_routes(self):
+        routes = [_route(f"service{i}", f"/services/{i}") for i in range(1000)]
+        router = ProxyRouter(routes)
+        assert len(router) == 1000
+        assert router.match("/services/999/items", "GET") == (routes[999], "items")
+        assert router.match("/services/1000/items", "GET") == (None, None)
+
+
+class TestProxyRoute:
+    def test_from_dict_constraints(self):
+        route = ProxyRoute.from_dict(
+            {
+                "name": "test",
+                "path": "/test",
+                "upstream": "http://127.0.0.1:9999",
+                "methods": ["GET", "post"],
+                "host": "api.example.com",
+            }
+        )
+        assert route.methods == {"GET", "POST"}
+        assert route.host == "api.example.com"
+        assert route.accepts("POST", "api.example.com")
+        assert not route.accepts("DELETE", "api.example.com")
+        assert not route.accepts("GET", "www.example.com")
@@ -0,0 +1,161 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.rate_limits import (
+    MemoryRateLimitStore,
+    RateLimit,
+    RateLimiter,
+    RedisRateLimitStore,
+    gcra,
+    get_retry_after,
+)
+
+
+class TestGcra:
+    def test_burst_then_rate(self):
+        # 1 request per second, bursts of 3
+        tat, now = None, 100.0
+        for _ in range(3):
+            tat, retry_after = gcra(tat, now, 1, 3)
+            assert retry_after == 0
+        new_tat, retry_after = gcra(tat, now, 1, 3)
+        assert new_tat is None
+        assert retry_after == pytest.approx(1)
+        # A request is allowed again every second
+        tat, retry_after = gcra(tat, now + 1, 1, 3)
+        assert retry_after == 0
+        assert gcra(tat, now + 1, 1, 3)[0] is None
+
+
+class TestMemoryRateLimitStore:
+    def test_hit(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr("app.rate_limits.time.monotonic", lambda: now[0])
+        store = MemoryRateLimitStore()
+        assert store.hit("key", 0.5, 1) == 0
+        assert store.hit("key", 0.5, 1) == 0
+        assert store.hit("key", 0.5, 1) == pytest.approx(0.5)
+        # Other keys have their own bucket
+        assert store.hit("other", 0.5, 1) == 0
+        now[0] += 0.5
+        assert store.hit("key", 0.5, 1) == 0
+
+    def test_peek(self, monkeypatch):
+        monkeypatch.setattr("app.rate_limits.time.monotonic", lambda: 100.0)
+        store = MemoryRateLimitStore()
+        assert store.peek("key", 1, 1) == 0
+        assert store.peek("key", 1, 1) == 0
+        store.hit("key", 1, 1)
+        assert store.peek("key", 1, 1) == pytest.approx(1)
+
+    def test_max_keys(self):
+        store = MemoryRateLimitStore(max_keys=2)
+        for key in ("a", "b", "c"):
+            store.hit(key, 1, 1)
+        assert len(store) == 2
+
+
+class TestRedisRateLimitStore:
+    def test_hit(self):
+        redis = MagicMock()
+        script = redis.register_script.return_value
+        script.return_value = b"0.25"
+        store = RedisRateLimitStore(redis=redis)
+        assert store.hit("key", 1, 2) == 0.25
+        kwargs = script.call_args.kwargs
+        assert kwargs["keys"] == ["ratelimit:key"]
+        assert kwargs["args"][:2] == [1, 2]
+        # The script is registered once
+        store.hit("key", 1, 2)
+        redis.register_script.assert_called_once()
+
+    def test_redis_down(self):
+        redis = MagicMock()
+        redis.register_script.return_value.side_effect = ConnectionError()
+        assert RedisRateLimitStore(redis=redis).hit("key", 1, 2) == 0
+
+    def test_hit_async(self):
+        redis = MagicMock()
+        redis.register_script.return_value = AsyncMock(return_value=b"0")
+        store = RedisRateLimitStore(async_redis=redis)
+        assert asyncio.run(store.hit_async("key", 1, 2)) == 0
+
+    def test_peek(self, monkeypatch):
+        monkeypatch.setattr("app.rate_limits.time.time", lambda: 100.0)
+        redis = MagicMock()
+        redis.get.return_value = None
+        store = RedisRateLimitStore(redis=redis)
+        assert store.peek("key", 1, 2) == 0
+        redis.get.assert_called_once_with("ratelimit:key")
+        redis.get.return_value = b"102.5"
+        assert store.peek("key", 1, 2) == pytest.approx(1.5)
+        redis.register_script.assert_not_called()
+
+        redis = MagicMock()
+        redis.get = AsyncMock(return_value=b"102.5")
+        store = RedisRateLimitStore(async_redis=redis)
+        assert asyncio.run(store.peek_async("key", 1, 2)) == pytest.approx(1.5)
+
+
+class TestRateLimit:
+    def test_keys(self):
+        assert RateLimit("api", 10).get_key("user", "1.2.3.4") == "api:subject:user"
+        # Anonymous requests are limited by address
+        assert RateLimit("api", 10).get_key(None, "1.2.3.4") == "api:ip:1.2.3.4"
+        limit = RateLimit("api", 10, key="ip")
+        assert limit.get_key("user", "1.2.3.4") == "api:ip:1.2.3.4"
+        assert RateLimit("api", 10, key="route").get_key("user", "1.2.3.4") == (
+            "api:route"
+        )
+
+    def test_interval(self):
+        limit = RateLimit("api", 120, period=60, burst=10)
+        assert limit.interval == 0.5
+        assert limit.tolerance == 5
+
+    def test_unknown_key(self):
+        with pytest.raises(ValueError):
+            RateLimit("api", 10, key="header")
+
+
+class TestRateLimiter:
+    def test_from_dict(self):
+        assert RateLimiter.from_dict("api", None) is None
+        limiter = RateLimiter.from_dict(
+            "api",
+            [
+                {"key": "subject", "rate": 10, "period": 60},
+                {"key": "route", "rate": 100, "store": "redis"},
+            ],
+        )
+        assert [limit.key for limit in limiter.limits] == ["subject", "route"]
+        assert isinstance(limiter.limits[0].store, MemoryRateLimitStore)
+        assert isinstance(limiter.limits[1].store, RedisRateLimitStore)
+
+    def test_check(self):
+        limiter = RateLimiter(
+            [RateLimit("api", 1, period=60), RateLimit("api", 100, key="route")]
+        )
+        assert limiter.check("user-1", "1.2.3.4") == 0
+        assert limiter.check("user-1", "1.2.3.4") > 0
+        assert limiter.check("user-2", "1.2.3.4") == 0
+        assert asyncio.run(limiter.check_async("user-3", "1.2.3.4")) == 0
+
+    def test_denied_request_not_counted(self):
+        subject_limit = RateLimit("api", 10, period=60)
+        ip_limit = RateLimit("api", 1, period=60, key="ip")
+        limiter = RateLimiter([subject_limit, ip_limit])
+        assert limiter.check("user-1", "1.2.3.4") == 0
+        tats = dict(subject_limit.store._tats)
+
+        for _ in range(3):
+            assert limiter.check("user-1", "1.2.3.4") > 0
+        assert subject_limit.store._tats == tats
+        assert asyncio.run(limiter.check_async("user-1", "1.2.3.4")) > 0
+        assert subject_limit.store._tats == tats
+
+    def test_retry_after(self):
+        assert get_retry_after(0.2) == "1"
+        assert get_retry_after(2.5) == "3"
@@ -0,0 +1,81 @@
+from unittest.mock import MagicMock
+
+import pytest
+import redis
+import redis.asyncio
+import redis.asyncio.sentinel
+
+from app.redis_clients import create_redis, parse_nodes
+
+
+class TestRedisClients:
+    def test_parse_nodes(self):
+        assert parse_nodes("10.0.0.1:26379, sentinel:26380") == [
+            ("10.0.0.1", 26379),
+            ("sentinel", 26380),
+        ]
+
+    def test_standalone(self, monkeypatch):
+        monkeypatch.setattr("app.settings.REDIS_HOST", "127.0.0.1")
+        monkeypatch.setattr("app.settings.REDIS_MAX_CONNECTIONS", 12)
+        client = create_redis()
+        pool = client.connection_pool
+        assert type(pool) is redis.ConnectionPool
+        assert pool.max_connections == 12
+        assert pool.connection_kwargs["host"] == "127.0.0.1"
+
+    def test_blocking_pool(self, monkeypatch):
+        monkeypatch.setattr("app.settings.REDIS_HOST", "127.0.0.1")
+        monkeypatch.setattr("app.settings.REDIS_BLOCKING_POOL", True)
+        monkeypatch.setattr("app.settings.REDIS_MAX_CONNECTIONS", 8)
+        pool = create_redis().connection_pool
+        assert isinstance(pool, redis.BlockingConnectionPool)
+        assert pool.max_connections == 8
+
+    def test_unix_socket(self, monkeypatch):
+        monkeypatch.setattr("app.settings.REDIS_UNIX_SOCKET", "/tmp/redis.sock")
+        pool = create_redis().connection_pool
+        assert pool.connection_class is redis.UnixDomainSocketConnection
+        assert pool.connection_kwargs["path"] == "/tmp/redis.sock"
+
+    def test_unix_socket_async(self, monkeypatch):
+        monkeypatch.setattr("app.settings.REDIS_UNIX_SOCKET", "/tmp/redis.sock")
+        pool = create_redis(asynchronous=True).connection_pool
+        assert pool.connection_class is redis.asyncio.UnixDomainSocketConnection
+
+    def test_sentinel(self, monkeypatch):
+        monkeypatch.setattr("app.settings.REDIS_MODE", "sentinel")
+        monkeypatch.setattr("app.settings.REDIS_SENTINELS", "s1:26379,s2:26379")
+        monkeypatch.setattr("app.settings.REDIS_SENTINEL_MASTER", "sessions")
+        pool = create_redis().connection_pool
+        assert isinstance(pool, redis.SentinelConnectionPool)
+        assert pool.service_name == "sessions"
+
+    def test_sentinel_blocking_pool(self, monkeypatch):
+        monkeypatch.setattr("app.settings.REDIS_MODE", "sentinel")
+        monkeypatch.setattr("app.settings.REDIS_SENTINELS", "s1:26379")
+        monkeypatch.setattr("app.settings.REDIS_SENTINEL_MASTER", "sessions")
+        monkeypatch.setattr("app.settings.REDIS_BLOCKING_POOL", True)
+        monkeypatch.setattr("app.settings.REDIS_MAX_CONNECTIONS", 8)
+        monkeypatch.setattr("app.settings.REDIS_POOL_TIMEOUT", 3)
+        pool = create_redis().connection_pool
+        assert isinstance(pool, redis.SentinelConnectionPool)
+        assert isinstance(pool, redis.BlockingConnectionPool)
+        assert (pool.max_connections, pool.timeout) == (8, 3)
+        assert pool.service_name == "sessions"
+        # Closes the idle connections when the master changes
+        idle = MagicMock()
+        pool.pool.get_nowait()
+        pool.pool.put_nowait(idle)
+        pool.disconnect(inuse_connections=False)
+        idle.disconnect.assert_called_once()
+
+        pool = create_redis(asynchronous=True).connection_pool
+        assert isinstance(pool, redis.asyncio.sentinel.SentinelConnectionPool)
+        assert isinstance(pool, redis.asyncio.BlockingConnectionPool)
+        assert (pool.max_connections, pool.timeout) == (8, 3)
+
+    def test_unknown_mode(self, monkeypatch):
+        monkeypatch.setattr("app.settings.REDIS_MODE", "unknown")
+        with pytest.raises(Exception):
+            create_redis()
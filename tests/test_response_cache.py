@@ -0,0 +1,165 @@
+from unittest.mock import MagicMock
+
+from requests.structures import CaseInsensitiveDict
+
+from app.response_cache import (
+    CachedResponse,
+    MemoryResponseStore,
+    RedisResponseStore,
+    ResponseCache,
+)
+
+
+def _headers(**headers):
+    headers = CaseInsensitiveDict(
+        {name.replace("_", "-"): value for name, value in headers.items()}
+    )
+    headers.setdefault("Content-Length", "4")
+    return headers
+
+
+class TestResponseCache:
+    def test_ttl_from_cache_control(self):
+        cache = ResponseCache("test")
+        assert cache.get_ttl(200, _headers(Cache_Control="max-age=60")) == 60
+        assert cache.get_ttl(200, _headers(Cache_Control="max-age=60, s-maxage=5")) == 5
+        assert cache.get_ttl(200, _headers(Cache_Control="max-age=60", Age="10")) == 50
+
+    def test_ttl_from_expires(self):
+        cache = ResponseCache("test")
+        headers = _headers(
+            Date="Sun, 18 Oct 2026 10:00:00 GMT",
+            Expires="Sun, 18 Oct 2026 10:02:00 GMT",
+        )
+        assert cache.get_ttl(200, headers) == 120
+
+    def test_not_stored(self):
+        cache = ResponseCache("test", vary=["Accept"], max_body_size=10)
+        for status, headers in [
+            (200, _headers()),
+            (500, _headers(Cache_Control="max-age=60")),
+            (200, _headers(Cache_Control="no-store, max-age=60")),
+            (200, _headers(Cache_Control="max-age=60", Set_Cookie="a=b")),
+            (200, _headers(Cache_Control="max-age=60", Vary="Accept, Cookie")),
+            (200, _headers(Cache_Control="max-age=60", Content_Length="11")),
+            (200, _headers(Cache_Control="max-age=60", Content_Length="4, 4")),
+            (200, _headers(Cache_Control="max-age=60", Content_Length="-1")),
+            (200, _headers(Cache_Control="max-age=60", Age="1.5")),
+            (200, _headers(Cache_Control="max-age=60", Age="abc")),
+            (200, _headers(Cache_Control="max-age=0")),
+        ]:
+            assert cache.get_ttl(status, headers) is None, headers
+
+    def test_stored_for_revalidation(self):
+        cache = ResponseCache("test")
+        headers = _headers(Cache_Control="no-cache", ETag='"v1"')
+        assert cache.get_ttl(200, headers) == 0
+
+    def test_vary(self):
+        cache = ResponseCache("test", vary=["accept"])
+        assert cache.get_ttl(200, _headers(Cache_Control="max-age=60", Vary="Accept"))
+        assert (
+            cache.get_ttl(200, _headers(Cache_Control="max-age=60", Vary="*")) is None
+        )
+
+    def test_shared(self):
+        cache = ResponseCache("test", shared=True)
+        assert cache.get_ttl(200, _headers(Cache_Control="max-age=60")) is None
+        assert cache.get_ttl(200, _headers(Cache_Control="private, max-age=60")) is None
+        assert cache.get_ttl(200, _headers(Cache_Control="public, max-age=60")) == 60
+        assert cache.key("a?", {}, "user-1") == cache.key("a?", {}, "user-2")
+
+    def test_key(self):
+        cache = ResponseCache("test", vary=["Accept-Language"])
+        key = cache.key("a?b=1", {"accept-language": "fr"}, "user-1")
+        assert key == cache.key("a?b=1", {"accept-language": "fr"}, "user-1")
+        assert key != cache.key("a?b=2", {"accept-language": "fr"}, "user-1")
+        assert key != cache.key("a?b=1", {"accept-language": "en"}, "user-1")
+        assert key != cache.key("a?b=1", {"accept-language": "fr"}, "user-2")
+        assert key != ResponseCache("other", vary=["Accept-Language"]).key(
+            "a?b=1", {"accept-language": "fr"}, "user-1"
+        )
+
+    def test_from_dict(self):
+        assert ResponseCache.from_dict("test", None) is None
+        cache = ResponseCache.from_dict("test", {"max_entries": 10, "vary": ["Accept"]})
+        assert cache.store.max_entries == 10
+        assert cache.vary == ["accept"]
+
+    def test_accepts(self):
+        cache = ResponseCache("test")
+        assert cache.accepts("GET", {})
+        assert not cache.accepts("POST", {})
+        assert not cache.accepts("GET", {"Cache-Control": "no-cache"})
+
+    def test_set_and_revalidate(self):
+        cache = ResponseCache("test", stale_ttl=60)
+        headers = _headers(Cache_Control="max-age=0", ETag='"v1"', Connection="close")
+        cached = cache.set("key", 200, headers, b"body", 0)
+        assert dict(cached.headers).keys() == {
+            "Cache-Control",
+            "ETag",
+            "Content-Length",
+        }
+        assert not cached.is_fresh()
+        assert cache.get("key") is cached
+
+        revalidated = cache.revalidate(
+            "key", cached, _headers(Cache_Control="max-age=30", ETag='"v1"')
+        )
+        assert revalidated.is_fresh()
+        assert revalidated.body == b"body"
+        assert dict(revalidated.headers)["Content-Length"] == "4"
+        assert cache.get("key") is revalidated
+
+    def test_revalidate_no_store(self):
+        cache = ResponseCache("test")
+        cached = cache.set(
+            "key", 200, _headers(Cache_Control="no-cache", ETag='"v1"'), b"body", 0
+        )
+        cache.revalidate("key", cached, _headers(Cache_Control="no-store"))
+        assert cache.get("key") is None
+
+    def test_dumps_loads(self):
+        cached = CachedResponse(200, [("ETag", '"v1"')], b"\x00body", 1000.5, 60)
+        loaded = CachedResponse.loads(cached.dumps())
+        assert (loaded.status, loaded.headers, loaded.body) == (
+            200,
+            [("ETag", '"v1"')],
+            b"\x00body",
+        )
+        assert (loaded.stored_at, loaded.ttl, loaded.etag) == (1000.5, 60, '"v1"')
+
+
+class TestResponseStores:
+    def test_memory_store_bounds(self):
+        store = MemoryResponseStore(max_entries=2, max_bytes=100)
+        for key in ("a", "b", "c"):
+            store.set(key, CachedResponse(200, [], b"x" * 10, 0, 60), 60)
+        assert len(store) == 2
+        assert store.get("a") is None
+
+        store.set("big", CachedResponse(200, [], b"x" * 95, 0, 60), 60)
+        assert len(store) == 1
+        assert store.size == 95
+        store.set("too-big", CachedResponse(200, [], b"x" * 101, 0, 60), 60)
+        assert store.get("too-big") is None
+        assert store.get("big")
+
+    def test_memory_store_expiration(self):
+        store = MemoryResponseStore()
+        store.set("a", CachedResponse(200, [], b"x", 0, 0), -1)
+        assert store.get("a") is None
+        assert store.size == 0
+
+    def test_redis_store(self):
+        redis = MagicMock()
+        store = RedisResponseStore(redis)
+        cached = CachedResponse(200, [("ETag", '"v1"')], b"body", 1000, 60)
+        store.set("key", cached, 90.5)
+        redis.set.assert_called_once_with("response:key", cached.dumps(), ex=90)
+
+        redis.get.return_value = cached.dumps()
+        assert store.get("key").body == b"body"
+        redis.get.side_effect = ConnectionError()
+        assert store.get("key") is None
@@ -0,0 +1,61 @@
+from app.retries import RetryBudget, RetryPolicy
+
+
+class TestRetryBudget:
+    def test_bounds_retries(self):
+        budget = RetryBudget(ratio=0.5, max_balance=2)
+        assert budget.withdraw()
+        assert budget.withdraw()
+        assert not budget.withdraw()
+        # Two requests pay for a retry
+        budget.deposit()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert budget.withdraw()
+
+    def test_balance_is_capped(self):
+        budget = RetryBudget(ratio=1, max_balance=2)
+        for _ in range(10):
+            budget.deposit()
+        assert budget.balance == 2
+
+
+class TestRetryPolicy:
+    def test_is_retryable(self):
+        policy = RetryPolicy(retries=1)
+        assert policy.is_retryable("GET", False)
+        assert policy.is_retryable("DELETE", False)
+        assert not policy.is_retryable("POST", False)
+        assert not policy.is_retryable("PUT", True)
+        assert not RetryPolicy(retries=0).is_retryable("GET", False)
+
+    def test_should_retry(self, monkeypatch):
+        monkeypatch.setattr("app.retries.time.monotonic", lambda: 100)
+        policy = RetryPolicy(retries=2)
+        assert policy.should_retry(0)
+        assert policy.should_retry(1)
+        assert not policy.should_retry(2)
+        # Not after the deadline
+        assert not policy.should_retry(0, deadline=100)
+
+    def test_should_retry_within_budget(self):
+        policy = RetryPolicy(retries=1, budget=0)
+        policy.budget.balance = 1
+        assert policy.should_retry(0)
+        assert not policy.should_retry(0)
+
+    def test_backoff(self, monkeypatch):
+        monkeypatch.setattr("app.retries.time.monotonic", lambda: 100)
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3)
+        for attempt in range(5):
+            delay = policy.get_backoff(attempt)
+            assert 0 <= delay <= min(0.3, 0.1 * 2**attempt)
+        assert policy.get_backoff(3, deadline=100.05) <= 0.05
+
+    def test_from_dict(self):
+        policy = RetryPolicy.from_dict(
+            {"retries": 3, "backoff": 0.5, "budget": 0.1, "statuses": [503]}
+        )
+        assert (policy.retries, policy.backoff) == (3, 0.5)
+        assert policy.budget.ratio == 0.1
+        assert policy.statuses == {503}
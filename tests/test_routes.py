@@ -0,0 +1,143 @@
+import os
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.proxy_routes import ReloadableProxyRouter
+from app.routes import RoutesConfigError, RoutesWatcher, get_routes_from_config_file
+
+ROUTES = """
+routes:
+  - name: api
+    path: /api
+    upstream: http://api:8080
+  - name: other
+    path: /other
+    upstream: http://other:8080
+"""
+
+
+def _write(path, content):
+    path.write_text(content)
+    # Make sure the modification is seen, whatever the mtime resolution
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def _watcher(tmp_path, content=ROUTES):
+    path = tmp_path / "routes.yaml"
+    _write(path, content)
+    watcher = RoutesWatcher(str(path), ReloadableProxyRouter(), interval=0)
+    watcher.reload(raise_errors=True)
+    return watcher, path
+
+
+class TestRoutesConfig:
+    def test_load(self, tmp_path):
+        path = tmp_path / "routes.yaml"
+        _write(path, ROUTES)
+        routes = get_routes_from_config_file(str(path))
+        assert [route["name"] for route in routes["routes"]] == ["api", "other"]
+
+    def test_unsafe_yaml(self, tmp_path):
+        path = tmp_path / "routes.yaml"
+        _write(path, "routes: !!python/object/apply:os.system ['true']")
+        with pytest.raises(RoutesConfigError):
+            get_routes_from_config_file(str(path))
+
+    @pytest.mark.parametrize(
+        "route",
+        [
+            "{path: /api, upstream: 'http://api'}",
+            "{name: api, path: api, upstream: 'http://api'}",
+            "{name: api, path: /api, upstream: 'ftp://api'}",
+            "{name: api, path: /api, upstream: []}",
+            "{name: api, path: /api, upstream: ['http://api', 42]}",
+            "{name: api, path: /api, upstream: 'http://api', balancing: random}",
+            "{name: api, path: /api, upstream: 'http://api', methods: [FETCH]}",
+            "{name: api, path: /api, upstream: 'http://api', pool: 10}",
+            "{name: api, path: /api, upstream: 'http://api', compress: 1}",
+            "{name: api, path: /api, upstream: 'http://api', circuit_breaker: 3}",
+            "{name: api, path: /api, upstream: 'http://api', retry: 2}",
+            "{name: api, path: /api, upstream: 'http://api', rate_limits: [{rate: 0}]}",
+            "{name: api, path: /api, upstream: 'http://a', "
+            "rate_limits: [{rate: 1, key: x}]}",
+            "{name: api, path: /api, upstream: 'http://api', headers: {deny: Cookie}}",
+        ],
+    )
+    def test_invalid_route(self, tmp_path, route):
+        path = tmp_path / "routes.yaml"
+        _write(path, f"routes: [{route}]")
+        with pytest.raises(RoutesConfigError):
+            get_routes_from_config_file(str(path))
+
+    def test_duplicate_route(self, tmp_path):
+        path = tmp_path / "routes.yaml"
+        _write(path, ROUTES + ROUTES.replace("routes:", ""))
+        with pytest.raises(RoutesConfigError, match="Duplicate"):
+            get_routes_from_config_file(str(path))
+
+
+class TestRoutesWatcher:
+    def test_check_unchanged(self, tmp_path):
+        watcher, _ = _watcher(tmp_path)
+        router = watcher.router.router
+        assert not watcher.check()
+        assert watcher.router.router is router
+        assert watcher.reload_count == 1
+
+    def test_reload_swaps_router(self, tmp_path):
+        watcher, path = _watcher(tmp_path)
+        api, _ = watcher.router.match("/api/users", "GET")
+        other, _ = watcher.router.match("/other/users", "GET")
+        api.pool.close = MagicMock()
+        other.pool.close = MagicMock()
+
+        _write(path, ROUTES.replace("http://other:8080", "http://other:9090"))
+        assert watcher.check()
+
+        # Unchanged route kept with its pool, changed one rebuilt and drained
+        assert watcher.router.match("/api/users", "GET") == (api, "users")
+        new_other, _ = watcher.router.match("/other/users", "GET")
+        assert new_other is not other
+        assert new_other.upstream == "http://other:9090"
+        api.pool.close.assert_not_called()
+        other.pool.close.assert_called_once()
+
+    def test_reload_removed_route(self, tmp_path):
+        watcher, path = _watcher(tmp_path)
+        other, _ = watcher.router.match("/other/users", "GET")
+        other.pool.close = MagicMock()
+
+        _write(path, ROUTES.split("  - name: other")[0])
+        assert watcher.check()
+        assert watcher.router.match("/other/users", "GET") == (None, None)
+        other.pool.close.assert_called_once()
+
+    def test_invalid_file_keeps_routes(self, tmp_path):
+        watcher, path = _watcher(tmp_path)
+        router = watcher.router.router
+
+        _write(path, "routes: [")
+        assert not watcher.check()
+        assert watcher.router.router is router
+        # Not parsed again until the file changes
+        assert not watcher.check()
+
+        _write(path, ROUTES.replace("/other", "/others"))
+        assert watcher.check()
+        assert watcher.router.match("/others/users", "GET")[0].name == "other"
+
+    def test_started_again_after_fork(self, tmp_path):
+        watcher, _ = _watcher(tmp_path)
+        watcher.interval = 60
+        watcher.start()
+
+        pid = os.fork()
+        if not pid:
+            # Only the forking thread survives in the child
+            threads = [thread.name for thread in threading.enumerate()]
+            os._exit(0 if "routes-watcher" in threads else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.WEXITSTATUS(status) == 0
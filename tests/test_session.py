@@ -0,0 +1,305 @@
+import multiprocessing
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+import redis
+
+from app.session import (
+    LocalSessionManager,
+    RedisSessionManager,
+    SharedMemorySessionManager,
+    TieredSessionManager,
+)
+
+
+class TestRedisSessionManager:
+    def test_create_session_single_value(self):
+        manager = RedisSessionManager()
+        manager.redis = MagicMock()
+
+        manager.create_session("1234", {"access_token": "a"}, expire_seconds=60)
+
+        manager.redis.set.assert_called_once_with(
+            "1234", manager.serializer.dumps({"access_token": "a"}), ex=60
+        )
+
+    def test_create_session_without_expiration(self):
+        manager = RedisSessionManager()
+        manager.redis = MagicMock()
+
+        manager.create_session("1234", {"access_token": "a"})
+
+        manager.redis.set.assert_called_once_with(
+            "1234", manager.serializer.dumps({"access_token": "a"}), ex=None
+        )
+
+    def test_get(self):
+        manager = RedisSessionManager()
+        manager.redis = MagicMock()
+        manager.redis.get.return_value = manager.serializer.dumps({"access_token": "a"})
+
+        assert manager.get("1234") == {"access_token": "a"}
+
+    def test_get_missing_session(self):
+        manager = RedisSessionManager()
+        manager.redis = MagicMock()
+        manager.redis.get.return_value = None
+
+        assert manager.get("1234") is None
+
+    def test_get_legacy_hash_session(self):
+        manager = RedisSessionManager()
+        manager.redis = MagicMock()
+        manager.redis.get.side_effect = redis.ResponseError("WRONGTYPE")
+        manager.redis.hgetall.return_value = {b"access_token": b"a"}
+
+        assert manager.get("1234") == {"access_token": "a"}
+
+
+class TestTieredSessionManager:
+    def create_manager(self, **kwargs):
+        backend = MagicMock()
+        backend.get_with_ttl.return_value = ({"access_token": "a"}, 3600)
+        return TieredSessionManager(backend, **kwargs)
+
+    def test_get_from_memory(self):
+        manager = self.create_manager(ttl=60)
+
+        assert manager.get("1234") == {"access_token": "a"}
+        assert manager.get("1234") == {"access_token": "a"}
+
+        manager.backend.get_with_ttl.assert_called_once_with("1234")
+        manager.backend.redis.pubsub.return_value.run_in_thread.assert_called_once()
+
+    def test_get_expiration(self, monkeypatch):
+        manager = self.create_manager(ttl=60)
+        manager.backend.get_with_ttl.return_value = ({"access_token": "a"}, 10)
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.session.time.monotonic", now)
+        manager.get("1234")
+
+        # The session expires in redis before the in-memory ttl
+        now.return_value = 1011
+        manager.get("1234")
+        assert manager.backend.get_with_ttl.call_count == 2
+
+    def test_get_missing_session(self):
+        manager = self.create_manager()
+        manager.backend.get_with_ttl.return_value = (None, None)
+
+        assert manager.get("1234") is None
+        assert manager.get("1234") is None
+        assert manager.backend.get_with_ttl.call_count == 2
+
+    def test_bounded(self):
+        manager = self.create_manager(max_size=2)
+        for session_id in ["1", "2", "3"]:
+            manager.get(session_id)
+
+        assert list(manager._entries) == ["2", "3"]
+
+    def test_destroy_session_publishes_invalidation(self):
+        manager = self.create_manager()
+        manager.get("1234")
+
+        manager.destroy_session("1234")
+
+        manager.backend.destroy_session.assert_called_once_with("1234")
+        manager.backend.redis.publish.assert_called_once_with(manager.channel, "1234")
+        assert "1234" not in manager._entries
+
+    def test_update_session_publishes_invalidation(self):
+        manager = self.create_manager()
+        manager.get("1234")
+
+        manager.update_session("1234", {"access_token": "b"}, expire_seconds=60)
+
+        manager.backend.create_session.assert_called_once_with(
+            "1234", {"access_token": "b"}, 60
+        )
+        manager.backend.redis.publish.assert_called_once_with(manager.channel, "1234")
+        assert "1234" not in manager._entries
+
+    def test_invalidation_from_other_worker(self):
+        manager = self.create_manager()
+        manager.get("1234")
+
+        manager._on_invalidation({"type": "message", "data": b"1234"})
+
+        assert "1234" not in manager._entries
+
+    def test_get_destroyed_during_read(self):
+        manager = self.create_manager()
+
+        def get_with_ttl(session_id):
+            # Destroyed by another worker while the session is read
+            manager._on_invalidation({"type": "message", "data": b"1234"})
+            return {"access_token": "a"}, 3600
+
+        manager.backend.get_with_ttl.side_effect = get_with_ttl
+
+        assert manager.get("1234") == {"access_token": "a"}
+        assert "1234" not in manager._entries
+
+
+class TestLocalSessionManager:
+    def test_create_and_get(self):
+        manager = LocalSessionManager()
+        manager.create_session("1234", {"access_token": "a"}, expire_seconds=60)
+
+        assert manager.get("1234") == {"access_token": "a"}
+        assert manager.get("5678") is None
+
+    def test_destroy_session(self):
+        manager = LocalSessionManager()
+        manager.create_session("1234", {"access_token": "a"})
+
+        assert manager.destroy_session("1234") is True
+        assert manager.get("1234") is None
+        assert manager.destroy_session("1234") is False
+
+    def test_expiration(self, monkeypatch):
+        manager = LocalSessionManager()
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.session.time.monotonic", now)
+        manager.create_session("1234", {"access_token": "a"}, expire_seconds=60)
+        manager.create_session("5678", {"access_token": "a"})
+
+        now.return_value = 1061
+        assert manager.get("1234") is None
+        assert manager.get("5678") == {"access_token": "a"}
+
+    def test_sweep(self, monkeypatch):
+        manager = LocalSessionManager(shards=1)
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.session.time.monotonic", now)
+        manager.create_session("1234", {"access_token": "a"}, expire_seconds=60)
+        manager.create_session("5678", {"access_token": "a"}, expire_seconds=120)
+
+        now.return_value = 1061
+        assert manager.sweep(manager.shards[0]) == 1
+        assert len(manager) == 1
+
+    def test_max_entries(self):
+        manager = LocalSessionManager(shards=1, max_entries=2)
+        for session_id in ["1", "2", "3"]:
+            manager.create_session(session_id, {"access_token": "a"})
+        manager.get("2")
+        manager.create_session("4", {"access_token": "a"})
+
+        assert list(manager.shards[0].entries) == ["2", "4"]
+
+    def test_no_max_entries(self):
+        manager = LocalSessionManager(shards=4, max_entries=0)
+        for session_id in ["1", "2", "3"]:
+            manager.create_session(session_id, {"access_token": "a"})
+
+        assert all(manager.get(session_id) for session_id in ["1", "2", "3"])
+
+    def test_max_bytes(self):
+        manager = LocalSessionManager(shards=1, max_bytes=100)
+        manager.create_session("1", {"access_token": "a" * 60})
+        manager.create_session("2", {"access_token": "a" * 60})
+
+        assert list(manager.shards[0].entries) == ["2"]
+        assert manager.shards[0].size < 100
+
+    def test_threads(self):
+        manager = LocalSessionManager(shards=4, max_entries=1000)
+
+        def create_sessions(thread_index):
+            for i in range(500):
+                session_id = f"{thread_index}-{i}"
+                manager.create_session(session_id, {"access_token": "a"})
+                manager.get(session_id)
+
+        threads = [
+            threading.Thread(target=create_sessions, args=(i,)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(manager) <= 1000
+        assert sum(shard.size for shard in manager.shards) == sum(
+            entry[2] for shard in manager.shards for entry in shard.entries.values()
+        )
+
+
+class TestSharedMemorySessionManager:
+    def create_manager(self, tmp_path, **kwargs):
+        kwargs.setdefault("slots", 64)
+        kwargs.setdefault("slot_size", 512)
+        kwargs.setdefault("stripes", 4)
+        return SharedMemorySessionManager(str(tmp_path / "sessions"), **kwargs)
+
+    def test_create_and_get(self, tmp_path):
+        manager = self.create_manager(tmp_path)
+        manager.create_session("1234", {"access_token": "a"}, expire_seconds=60)
+
+        assert manager.get("1234") == {"access_token": "a"}
+        assert manager.get("5678") is None
+
+    def test_destroy_session(self, tmp_path):
+        manager = self.create_manager(tmp_path)
+        manager.create_session("1234", {"access_token": "a"})
+
+        assert manager.destroy_session("1234") is True
+        assert manager.get("1234") is None
+        assert manager.destroy_session("1234") is False
+
+    def test_expiration(self, tmp_path, monkeypatch):
+        manager = self.create_manager(tmp_path)
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.session.time.time", now)
+        manager.create_session("1234", {"access_token": "a"}, expire_seconds=60)
+
+        now.return_value = 1061
+        assert manager.get("1234") is None
+
+    def test_collisions(self, tmp_path):
+        manager = self.create_manager(tmp_path, slots=64, stripes=1)
+        for i in range(64):
+            manager.create_session(str(i), {"access_token": str(i)})
+        manager.destroy_session("10")
+        manager.create_session("10", {"access_token": "again"})
+
+        for i in range(64):
+            expected = "again" if i == 10 else str(i)
+            assert manager.get(str(i)) == {"access_token": expected}
+
+    def test_full_stripe_replaces_closest_expiration(self, tmp_path):
+        manager = self.create_manager(tmp_path, slots=4, stripes=1)
+        for i in range(4):
+            manager.create_session(str(i), {"access_token": "a"}, 100 + i)
+        manager.create_session("new", {"access_token": "a"}, 60)
+
+        assert manager.get("0") is None
+        assert manager.get("new") == {"access_token": "a"}
+        assert manager.get("3") == {"access_token": "a"}
+
+    def test_session_too_large(self, tmp_path):
+        manager = self.create_manager(tmp_path, slot_size=64)
+        with pytest.raises(Exception):
+            manager.create_session("1234", {"access_token": "a" * 100})
+
+    def test_layout_mismatch(self, tmp_path):
+        self.create_manager(tmp_path, slots=64)
+        with pytest.raises(Exception):
+            self.create_manager(tmp_path, slots=128)
+
+    def test_shared_between_processes(self, tmp_path):
+        manager = self.create_manager(tmp_path)
+
+        def create_session():
+            worker_manager = self.create_manager(tmp_path)
+            worker_manager.create_session("1234", {"access_token": "a"}, 60)
+
+        process = multiprocessing.get_context("fork").Process(target=create_session)
+        process.start()
+        process.join()
+
+        assert process.exitcode == 0
+        assert manager.get("1234") == {"access_token": "a"}
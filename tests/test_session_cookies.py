@@ -0,0 +1,101 @@
+from flask import Flask, session
+from flask.sessions import SecureCookieSessionInterface
+
+from app import settings
+from app.session_cookies import SessionIdCodec, SessionIdInterface
+
+
+class TestSessionIdCodec:
+    def test_roundtrip(self):
+        codec = SessionIdCodec("key", max_age=60)
+        cookie = codec.dumps("1234")
+        assert cookie.startswith("1234.")
+        assert codec.loads(cookie) == "1234"
+
+    def test_invalid(self):
+        codec = SessionIdCodec("key")
+        cookie = codec.dumps("1234")
+        assert codec.loads(cookie.replace("1234", "1235")) is None
+        assert codec.loads(cookie[:-1]) is None
+        assert codec.loads(SessionIdCodec("other").dumps("1234")) is None
+        for cookie in ["", "1234", "1234.abc", "1234.abc.def", ".1.abc", "é.1.abc"]:
+            assert codec.loads(cookie) is None
+
+    def test_expired(self):
+        codec = SessionIdCodec("key", max_age=60)
+        cookie = codec.dumps("1234", now=1000)
+        assert codec.loads(cookie, now=1060) == "1234"
+        assert codec.loads(cookie, now=1061) is None
+
+    def test_key_rotation(self):
+        old_cookie = SessionIdCodec("old").dumps("1234")
+        codec = SessionIdCodec("new,old")
+        new_cookie = codec.dumps("1234")
+        assert codec.loads(old_cookie) == "1234"
+        assert codec.loads(new_cookie) == "1234"
+        assert SessionIdCodec("new").loads(new_cookie) == "1234"
+        assert SessionIdCodec("old").loads(new_cookie) is None
+
+
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = "secret"
+    app.session_interface = SessionIdInterface("key", 3600)
+
+    @app.route("/login")
+    def login():
+        session[settings.SESSION_ID] = "1234"
+        return ""
+
+    @app.route("/logout")
+    def logout():
+        session.clear()
+        return ""
+
+    @app.route("/session")
+    def session_id():
+        return session.get(settings.SESSION_ID, "")
+
+    return app
+
+
+class TestSessionIdInterface:
+    def test_cookie_set_when_session_id_changes(self):
+        with create_app().test_client() as client:
+            response = client.get("/login")
+            cookie = response.headers["Set-Cookie"]
+            assert cookie.startswith("session=1234.")
+            assert "Expires=" in cookie
+            assert "HttpOnly" in cookie
+
+            response = client.get("/session")
+            assert response.data == b"1234"
+            assert "Set-Cookie" not in response.headers
+            assert response.headers["Vary"] == "Cookie"
+
+            response = client.get("/logout")
+            assert response.headers["Set-Cookie"].startswith("session=;")
+            assert client.get("/session").data == b""
+
+    def test_invalid_cookie(self):
+        with create_app().test_client() as client:
+            client.set_cookie("localhost", "session", "1234.1.abc")
+            response = client.get("/session")
+            assert response.data == b""
+            assert "Set-Cookie" not in response.headers
+
+    def test_legacy_cookie_issued_again(self):
+        app = create_app()
+        serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+        with app.test_client() as client:
+            client.set_cookie(
+                "localhost", "session", serializer.dumps({settings.SESSION_ID: "1234"})
+            )
+            response = client.get("/session")
+            assert response.data == b"1234"
+            cookie = response.headers["Set-Cookie"]
+            assert cookie.startswith("session=1234.")
+
+            response = client.get("/session")
+            assert response.data == b"1234"
+            assert "Set-Cookie" not in response.headers
@@ -0,0 +1,61 @@
+import pytest
+
+from app.oauth.mock_data import ACCESS_TOKEN, ID_TOKEN
+from app.session_serializers import SessionSerializer
+
+
+def get_payload():
+    return {
+        "access_token": ACCESS_TOKEN,
+        "id_token": ID_TOKEN,
+        "expires_in": 86400,
+        "scope": "openid profile",
+        "token_type": "Bearer",
+    }
+
+
+class TestSessionSerializer:
+    def test_json(self):
+        serializer = SessionSerializer("json", "none")
+        data = serializer.dumps(get_payload())
+        assert data[:3] == bytes([1, 0, 0])
+        assert serializer.loads(data) == get_payload()
+
+    def test_zlib(self):
+        serializer = SessionSerializer("json", "zlib")
+        data = serializer.dumps(get_payload())
+        assert data[:3] == bytes([1, 0, 1])
+        assert len(data) < len(SessionSerializer("json", "none").dumps(get_payload()))
+        assert serializer.loads(data) == get_payload()
+
+    def test_no_compression_under_threshold(self):
+        serializer = SessionSerializer("json", "zlib", compression_threshold=1024)
+        data = serializer.dumps({"access_token": "a"})
+        assert data[:3] == bytes([1, 0, 0])
+        assert serializer.loads(data) == {"access_token": "a"}
+
+    def test_reads_other_formats(self):
+        data = SessionSerializer("json", "zlib").dumps(get_payload())
+        assert SessionSerializer("json", "none").loads(data) == get_payload()
+
+    def test_msgpack(self):
+        pytest.importorskip("msgpack")
+        serializer = SessionSerializer("msgpack", "zlib")
+        data = serializer.dumps(get_payload())
+        assert data[:2] == bytes([1, 1])
+        assert serializer.loads(data) == get_payload()
+
+    def test_zstd(self):
+        pytest.importorskip("zstandard")
+        serializer = SessionSerializer("json", "zstd")
+        data = serializer.dumps(get_payload())
+        assert data[:3] == bytes([1, 0, 2])
+        assert serializer.loads(data) == get_payload()
+
+    def test_unsupported_version(self):
+        with pytest.raises(ValueError):
+            SessionSerializer().loads(bytes([9, 0, 0]) + b"{}")
+
+    def test_unknown_serializer(self):
+        with pytest.raises(Exception):
+            SessionSerializer("pickle")
@@ -2,6 +2,8 @@ import math
 import time
 import pytest
 
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 from jose import jwt, jwk
 from unittest.mock import MagicMock
 
@@ -97,3 +99,166 @@ hB9Bpl3kDeaLFIVYxQIDFAKE
 
         token_decoder.decode_token(token, audience="https://127.0.0.1:8080")
         assert True
+
+    def test_decode_token_cached(self, monkeypatch):
+        token_decoder = SimpleTokenDecoder(RS256_PUBLIC)
+        token = create_token(get_token_data(), RS256_PRIVATE)
+        decode = MagicMock(wraps=jwt.decode)
+        monkeypatch.setattr("app.oauth.token_decoders.jwt.decode", decode)
+
+        first = token_decoder.decode_token(token, audience="https://127.0.0.1:8080")
+        second = token_decoder.decode_token(token, audience="https://127.0.0.1:8080")
+
+        assert first == second
+        assert decode.call_count == 1
+        assert token_decoder.cache.hits == 1
+        assert token_decoder.cache.misses == 1
+
+    def test_decode_token_cached_per_audience(self, monkeypatch):
+        token_decoder = SimpleTokenDecoder(RS256_PUBLIC)
+        token = create_token(get_token_data(), RS256_PRIVATE)
+        token_decoder.decode_token(token, audience="https://127.0.0.1:8080")
+
+        with pytest.raises(AppError) as exc:
+            token_decoder.decode_token(token, audience="bad_audience")
+
+        assert exc.value.code == 2
+
+    def test_decode_token_cached_per_key(self):
+        other_key = (
+            rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            .public_key()
+            .public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo,
+            )
+        )
+        token_decoder = SimpleTokenDecoder(RS256_PUBLIC)
+        token = create_token(get_token_data(), RS256_PRIVATE)
+        token_decoder.decode_token(
+            token, key=RS256_PUBLIC, audience="https://127.0.0.1:8080"
+        )
+
+        with pytest.raises(AppError) as exc:
+            token_decoder.decode_token(
+                token, key=other_key, audience="https://127.0.0.1:8080"
+            )
+
+        assert exc.value.code == 3
+
+    def test_decode_token_cache_expiration(self, monkeypatch):
+        token_decoder = SimpleTokenDecoder(RS256_PUBLIC)
+        token_data = get_token_data()
+        token = create_token(token_data, RS256_PRIVATE)
+        token_decoder.decode_token(token, audience="https://127.0.0.1:8080")
+
+        monkeypatch.setattr(
+            "app.oauth.token_decoders.time.time",
+            MagicMock(return_value=token_data["exp"] + 1),
+        )
+        cache_key = token_decoder.cache.key(token, "https://127.0.0.1:8080")
+        assert token_decoder.cache.get(cache_key) is None
+        assert len(token_decoder.cache) == 0
+
+    def test_decode_token_cache_bounded(self):
+        token_decoder = SimpleTokenDecoder(RS256_PUBLIC, cache_size=2)
+        for i in range(3):
+            token_data = get_token_data()
+            token_data["sub"] = f"auth0|{i}"
+            token = create_token(token_data, RS256_PRIVATE)
+            token_decoder.decode_token(token, audience="https://127.0.0.1:8080")
+
+        assert len(token_decoder.cache) == 2
+
+    def test_jwks_keys_indexed_by_kid(self):
+        public_jwk = jwk.construct(RS256_PUBLIC, "RS256").to_dict()
+        public_jwk.update({"kid": "1234", "use": "sig"})
+        token = create_token(get_token_data(), RS256_PRIVATE, headers={"kid": "1234"})
+
+        token_decoder = JWKSTokenDecoder("https://fake-jwks-url")
+        token_decoder.fetch_jwks = MagicMock(return_value={"keys": [public_jwk]})
+
+        token_decoder.decode_token(token, audience="https://127.0.0.1:8080")
+        assert set(token_decoder.keys) == {"1234"}
+        assert token_decoder.fetch_count == 1
+
+    def test_jwks_refetch_on_unknown_kid(self, monkeypatch):
+        token = create_token(get_token_data(), RS256_PRIVATE, headers={"kid": "new"})
+        token_decoder = JWKSTokenDecoder(
+            "https://fake-jwks-url", min_refresh_interval=60
+        )
+        token_decoder.fetch_jwks = MagicMock(
+            return_value={"keys": [{"kid": "old", "kty": "RSA"}]}
+        )
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.oauth.token_decoders.time.monotonic", now)
+
+        with pytest.raises(AppError) as exc:
+            token_decoder.get_key_from_jwks(token)
+        assert exc.value.code == 4
+        assert token_decoder.fetch_count == 1
+
+        # Unknown kid, but the JWKS was fetched too recently
+        now.return_value = 1030
+        with pytest.raises(AppError):
+            token_decoder.get_key_from_jwks(token)
+        assert token_decoder.fetch_count == 1
+
+        # The identity provider rotated its keys
+        token_decoder.fetch_jwks.return_value = {"keys": [{"kid": "new"}]}
+        now.return_value = 1070
+        assert token_decoder.get_key_from_jwks(token)["kid"] == "new"
+        assert token_decoder.fetch_count == 2
+
+    def test_jwks_ttl_refresh(self, monkeypatch):
+        token = create_token(get_token_data(), RS256_PRIVATE, headers={"kid": "1234"})
+        token_decoder = JWKSTokenDecoder("https://fake-jwks-url", ttl=3600)
+        token_decoder.fetch_jwks = MagicMock(return_value={"keys": [{"kid": "1234"}]})
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.oauth.token_decoders.time.monotonic", now)
+
+        token_decoder.get_key_from_jwks(token)
+        now.return_value = 2000
+        token_decoder.get_key_from_jwks(token)
+        assert token_decoder.fetch_count == 1
+
+        now.return_value = 5000
+        token_decoder.get_key_from_jwks(token)
+        assert token_decoder.fetch_count == 2
+
+    def test_jwks_refresh_failure_keeps_keys(self, monkeypatch):
+        token = create_token(get_token_data(), RS256_PRIVATE, headers={"kid": "1234"})
+        token_decoder = JWKSTokenDecoder("https://fake-jwks-url", ttl=3600)
+        token_decoder.fetch_jwks = MagicMock(return_value={"keys": [{"kid": "1234"}]})
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.oauth.token_decoders.time.monotonic", now)
+        token_decoder.get_key_from_jwks(token)
+
+        token_decoder.fetch_jwks.side_effect = Exception("IdP down")
+        now.return_value = 5000
+        assert token_decoder.get_key_from_jwks(token)["kid"] == "1234"
+        now.return_value = 5010
+        token_decoder.get_key_from_jwks(token)
+        assert token_decoder.fetch_jwks.call_count == 2
+
+    def test_jwks_cold_start_failure_backoff(self, monkeypatch):
+        token = create_token(get_token_data(), RS256_PRIVATE, headers={"kid": "1234"})
+        token_decoder = JWKSTokenDecoder(
+            "https://fake-jwks-url", min_refresh_interval=60
+        )
+        token_decoder.fetch_jwks = MagicMock(side_effect=ConnectionError("IdP down"))
+        now = MagicMock(return_value=1000)
+        monkeypatch.setattr("app.oauth.token_decoders.time.monotonic", now)
+
+        for timestamp in (1000, 1001, 1030):
+            now.return_value = timestamp
+            with pytest.raises(ConnectionError):
+                token_decoder.get_key_from_jwks(token)
+        # Not fetched again until min_refresh_interval passed
+        assert token_decoder.fetch_jwks.call_count == 1
+
+        token_decoder.fetch_jwks.side_effect = None
+        token_decoder.fetch_jwks.return_value = {"keys": [{"kid": "1234"}]}
+        now.return_value = 1060
+        assert token_decoder.get_key_from_jwks(token)["kid"] == "1234"
+        assert token_decoder.fetch_jwks.call_count == 2
@@ -0,0 +1,180 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from app import settings
+from app.oauth.clients import InvalidRefreshToken
+from app.oauth.refresh import UNLOCK_SCRIPT, TokenRefresher, get_session_lifetime
+
+
+def session_data(expires_in=10, refresh_token="r1"):
+    return {
+        "access_token": "a1",
+        "refresh_token": refresh_token,
+        "expires_at": time.time() + expires_in,
+        "expires_in": expires_in,
+    }
+
+
+def build_payload(tokens):
+    payload = dict(tokens)
+    payload["authorization_header"] = f"Bearer {tokens['access_token']}"
+    return payload
+
+
+@pytest.fixture
+def server_session(monkeypatch):
+    server_session = MagicMock()
+    monkeypatch.setattr("app.oauth.refresh.server_session", server_session)
+    return server_session
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = MagicMock()
+    client.refresh_access_token.return_value = {
+        "access_token": "a2",
+        "refresh_token": "r2",
+        "expires_at": time.time() + 3600,
+        "expires_in": 3600,
+    }
+    monkeypatch.setattr("app.oauth.refresh.get_client", MagicMock(return_value=client))
+    return client
+
+
+class TestTokenRefresher:
+    def test_needs_refresh(self):
+        refresher = TokenRefresher(build_payload, window=60)
+        assert refresher.needs_refresh(session_data(expires_in=10))
+        assert refresher.needs_refresh(session_data(expires_in=-10))
+        assert not refresher.needs_refresh(session_data(expires_in=3600))
+        assert not refresher.needs_refresh(session_data(refresh_token=None))
+        assert not refresher.needs_refresh(None)
+
+    def test_refresh(self, server_session, client):
+        data = session_data()
+        server_session.get.return_value = data
+        refresher = TokenRefresher(build_payload, redis=MagicMock())
+
+        refreshed = refresher.refresh("1234", data)
+
+        client.refresh_access_token.assert_called_once_with("r1")
+        assert refreshed["access_token"] == "a2"
+        assert refreshed["refresh_token"] == "r2"
+        assert refreshed["authorization_header"] == "Bearer a2"
+        server_session.update_session.assert_called_once_with(
+            "1234", refreshed, expire_seconds=settings.REFRESH_SESSION_LIFETIME
+        )
+        assert refresher.refreshes == 1
+
+    def test_refresh_single_flight(self, server_session, client):
+        data = session_data()
+        server_session.get.return_value = data
+        started, release = threading.Event(), threading.Event()
+
+        def refresh_access_token(refresh_token):
+            started.set()
+            release.wait(5)
+            return {"access_token": "a2", "expires_at": time.time() + 3600}
+
+        client.refresh_access_token.side_effect = refresh_access_token
+        refresher = TokenRefresher(build_payload, redis=MagicMock())
+        results = []
+
+        def run():
+            results.append(refresher.refresh("1234", data))
+
+        threads = [threading.Thread(target=run) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        client.refresh_access_token.assert_called_once()
+        assert [result["access_token"] for result in results] == ["a2"] * 5
+        assert not refresher._flights
+
+    def test_refresh_locked_by_other_worker(self, server_session, client):
+        data = session_data()
+        redis = MagicMock()
+        redis.set.return_value = None
+        refresher = TokenRefresher(build_payload, redis=redis)
+
+        assert refresher.refresh("1234", data) is data
+
+        client.refresh_access_token.assert_not_called()
+        redis.register_script.return_value.assert_not_called()
+
+    def test_refresh_already_refreshed(self, server_session, client):
+        refreshed = session_data(expires_in=3600)
+        server_session.get.return_value = refreshed
+        redis = MagicMock()
+        refresher = TokenRefresher(build_payload, redis=redis)
+
+        assert refresher.refresh("1234", session_data()) is refreshed
+
+        client.refresh_access_token.assert_not_called()
+        token = redis.set.call_args[0][1]
+        redis.register_script.return_value.assert_called_once_with(
+            keys=["token-refresh:1234"], args=[token]
+        )
+
+    def test_refresh_unlocks_own_lock_only(self, server_session, client):
+        server_session.get.return_value = session_data(expires_in=3600)
+        redis = MagicMock()
+        refresher = TokenRefresher(build_payload, redis=redis)
+
+        refresher.refresh("1234", session_data())
+        refresher.refresh("1234", session_data())
+
+        first, second = [call[0][1] for call in redis.set.call_args_list]
+        assert first != second
+        redis.register_script.assert_called_once_with(UNLOCK_SCRIPT)
+        assert [
+            call[1]["args"]
+            for call in redis.register_script.return_value.call_args_list
+        ] == [[first], [second]]
+        redis.delete.assert_not_called()
+
+    def test_refresh_token_rejected(self, server_session, client):
+        data = session_data()
+        server_session.get.return_value = data
+        client.refresh_access_token.side_effect = InvalidRefreshToken("revoked")
+        refresher = TokenRefresher(build_payload, redis=MagicMock())
+
+        assert refresher.refresh("1234", data) is None
+
+        server_session.destroy_session.assert_called_once_with("1234")
+
+    def test_refresh_error_keeps_session(self, server_session, client):
+        data = session_data()
+        server_session.get.return_value = data
+        client.refresh_access_token.side_effect = Exception("unreachable")
+        refresher = TokenRefresher(build_payload, redis=MagicMock())
+
+        assert refresher.refresh("1234", data) is data
+
+        server_session.update_session.assert_not_called()
+        server_session.destroy_session.assert_not_called()
+
+    def test_refresh_invalid_tokens_keep_session(self, server_session, client):
+        data = session_data()
+        server_session.get.return_value = data
+        build_payload = MagicMock(side_effect=Exception("invalid id token"))
+        refresher = TokenRefresher(build_payload, redis=MagicMock())
+
+        assert refresher.refresh("1234", data) is data
+
+        server_session.update_session.assert_not_called()
+        assert refresher.refreshes == 0
+
+
+def test_get_session_lifetime():
+    assert get_session_lifetime(session_data()) == settings.REFRESH_SESSION_LIFETIME
+    assert get_session_lifetime(session_data(refresh_token=None)) == 10
+    assert get_session_lifetime({}, 60) == 60
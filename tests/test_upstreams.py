@@ -0,0 +1,64 @@
+from unittest.mock import MagicMock
+
+from app import settings
+from app.proxy_routes import ProxyRoute
+from app.upstreams import UpstreamPool
+
+
+class TestUpstreamPool:
+    def test_defaults_from_settings(self):
+        pool = UpstreamPool()
+        assert pool.max_connections == settings.PROXY_POOL_MAX_CONNECTIONS
+        assert pool.idle_timeout == settings.PROXY_POOL_IDLE_TIMEOUT
+        assert pool.timeout == (
+            settings.PROXY_CONNECT_TIMEOUT,
+            settings.PROXY_READ_TIMEOUT,
+        )
+
+    def test_route_from_dict(self):
+        route = ProxyRoute.from_dict(
+            {
+                "name": "test",
+                "path": "/test",
+                "upstream": "http://127.0.0.1:9999",
+                "pool": {"max_connections": 42, "idle_timeout": 5},
+                "timeout": {"connect": 1, "read": 2},
+            }
+        )
+        assert route.pool.max_connections == 42
+        assert route.pool.idle_timeout == 5
+        assert route.pool.timeout == (1, 2)
+
+    def test_session_is_reused(self):
+        pool = UpstreamPool()
+        assert pool.get_session() is pool.get_session()
+
+    def test_idle_session_is_recycled(self, monkeypatch):
+        pool = UpstreamPool(idle_timeout=10)
+        monkeypatch.setattr("app.upstreams.time.monotonic", MagicMock(return_value=0))
+        session = pool.get_session()
+        monkeypatch.setattr("app.upstreams.time.monotonic", MagicMock(return_value=5))
+        assert pool.get_session() is session
+        monkeypatch.setattr("app.upstreams.time.monotonic", MagicMock(return_value=20))
+        assert pool.get_session() is not session
+
+    def test_request_uses_route_timeout(self, monkeypatch):
+        def request(*a, **kw):
+            assert kw.get("url") == "http://127.0.0.1:9999/bla"
+            assert kw.get("timeout") == (1, 2)
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+        UpstreamPool(connect_timeout=1, read_timeout=2).request(
+            "get", "http://127.0.0.1:9999/bla"
+        )
+
+    def test_total_timeout(self, monkeypatch):
+        pool = UpstreamPool(connect_timeout=1, read_timeout=10, total_timeout=5)
+        monkeypatch.setattr("app.upstreams.time.monotonic", MagicMock(return_value=100))
+        deadline = pool.get_deadline()
+        assert deadline == 105
+        monkeypatch.setattr("app.upstreams.time.monotonic", MagicMock(return_value=102))
+        # Attempts are shortened to end by the deadline
+        assert pool.get_timeout(deadline) == (1, 3)
+        assert pool.get_timeout() == (1, 10)
+        assert UpstreamPool(total_timeout=0).get_deadline() is None
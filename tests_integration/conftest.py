@@ -1,4 +1,7 @@
 from flask import Flask
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
 import pytest
 from app.app import create_app
 
@@ -13,3 +16,61 @@ def app():
 def client(app):
     client = app.test_client()
     yield client
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Upstream answering with the request it received: its method, path, headers (as a
+    list of pairs) and the length of its body, decoded if it was chunked.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_echo()
+
+    do_POST = do_PUT = do_DELETE = do_PATCH = do_GET
+
+    def read_body(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    return body
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def send_echo(self):
+        received = self.read_body()
+        body = json.dumps(
+            {
+                "method": self.command,
+                "path": self.path,
+                "headers": list(self.headers.items()),
+                "body_length": len(received),
+                "body_start": received[:16].decode(errors="replace"),
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    """
+    Url of an upstream server echoing the requests it receives.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
@@ -1,9 +1,22 @@
 from flask import Flask
+from requests.structures import CaseInsensitiveDict
 import base64
+import io
 import json
+import pytest
+import requests
+import threading
+import time
+import zlib
 from unittest.mock import Mock, MagicMock
-from app import api
-from app.proxy_routes import ProxyRoute
+from app import api, errors
+from app.balancers import UpstreamBalancer
+from app.coalescing import RequestCoalescer
+from app.compression import ResponseCompressor
+from app.proxy_routes import ProxyRoute, ProxyRouter
+from app.rate_limits import RateLimit, RateLimiter
+from app.response_cache import ResponseCache
+from app.retries import RetryPolicy
 from app.oauth.mock_data import ACCESS_TOKEN, ID_TOKEN, RS256_PUBLIC, ID_TOKEN_DATA
 
 
@@ -11,6 +24,7 @@ def _mock_response(status=200, content="CONTENT", json_data=None):
     mock_resp = Mock()
     mock_resp.status_code = status
     mock_resp.content = content
+    mock_resp.raw.stream = Mock(return_value=iter([content]))
     mock_resp.headers = {}
     if json_data:
         mock_resp.json = Mock(return_value=json_data)
@@ -27,8 +41,7 @@ class TestApiProxy:
 
         # Create the proxy route configuration and mock it
         route = ProxyRoute("test", "/test", "http://127.0.0.1:9999")
-        proxy_routes = {route.name: route}
-        monkeypatch.setattr("app.api.proxy_routes", proxy_routes)
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
 
         # Mock requests to call the following method
         def request(*a, **kw):
@@ -59,15 +72,18 @@ class TestApiProxy:
 
         # Create the proxy route configuration and mock it
         route = ProxyRoute("test", "/test", "http://127.0.0.1:9999")
-        proxy_routes = {route.name: route}
-        monkeypatch.setattr("app.api.proxy_routes", proxy_routes)
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
 
         # Mock requests to call the following method
         def request(*a, **kw):
             assert kw.get("url") == "http://127.0.0.1:9999/bla?"
+            # requests does not take lists of headers
             headers = kw.get("headers")
+            assert isinstance(headers, dict)
             assert headers.get("Authorization") == f"Bearer {ACCESS_TOKEN}"
-            encoded_id_token_data = base64.b64encode(json.dumps(ID_TOKEN_DATA).encode())
+            encoded_id_token_data = base64.b64encode(
+                json.dumps(ID_TOKEN_DATA).encode()
+            ).decode()
             assert headers.get("X-Userinfo") == encoded_id_token_data
             return _mock_response(json_data={"status": "ok"})
 
@@ -109,13 +125,12 @@ class TestApiProxy:
 
         # Create the proxy route configuration and mock it
         route = ProxyRoute("test", "/test", "http://127.0.0.1:9999")
-        proxy_routes = {route.name: route}
-        monkeypatch.setattr("app.api.proxy_routes", proxy_routes)
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
 
         # Mock requests to call the following method
         def request(*a, **kw):
             assert kw.get("url") == "http://127.0.0.1:9999/bla?"
-            headers = kw.get("headers")
+            headers = dict(kw.get("headers"))
             assert "Authorization" not in headers
             assert "X-Userinfo" not in headers
             return _mock_response(json_data={"status": "ok"})
@@ -142,3 +157,713 @@ class TestApiProxy:
             }
             res = client.get("/test/bla", headers=headers)
             assert res.status_code == 200
+
+    def test_proxy_streams_bodies(self, monkeypatch):
+        """
+        Test that the request body is forwarded as a stream with its content length,
+        and that the upstream response body is streamed back to the client.
+        """
+        # Create the test app
+        app = Flask(__name__)
+
+        # Add a route to be proxied
+        app.add_url_rule("/test/<path:path>", "test", api.proxy, methods=["POST"])
+
+        # Create the proxy route configuration and mock it
+        route = ProxyRoute("test", "/test", "http://127.0.0.1:9999", chunk_size=4)
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        upload = b"0123456789" * 10
+
+        # Mock requests to call the following method
+        def request(*a, **kw):
+            assert kw.get("stream") is True
+            data = kw.get("data")
+            assert len(data) == len(upload)
+            chunks = list(data)
+            assert max(len(chunk) for chunk in chunks) == 4
+            assert b"".join(chunks) == upload
+            mock_resp = _mock_response()
+            mock_resp.raw.stream = Mock(return_value=iter([b"STREAMED", b"BODY"]))
+            return mock_resp
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            res = client.post(
+                "/test/bla",
+                data=upload,
+                headers={"Content-Type": "multipart/form-data; boundary=x"},
+            )
+            assert res.status_code == 200
+            assert res.data == b"STREAMEDBODY"
+
+    def test_proxy_streams_chunked_upload(self, monkeypatch, upstream):
+        """
+        Test that a chunked upload, of unknown length, reaches a real upstream through
+        requests with its whole body.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy, methods=["POST"])
+
+        route = ProxyRoute("test", "/test", upstream)
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        upload = b"0123456789" * 300000
+        client = app.test_client()
+        res = client.post(
+            "/test/upload",
+            input_stream=io.BytesIO(upload),
+            headers={"Transfer-Encoding": "chunked"},
+            environ_overrides={"CONTENT_LENGTH": "", "wsgi.input_terminated": True},
+        )
+        assert res.status_code == 200
+        received = res.get_json()
+        assert received["method"] == "POST"
+        assert received["body_length"] == len(upload)
+        assert received["body_start"] == "0123456789012345"
+        headers = dict(received["headers"])
+        assert headers["Transfer-Encoding"] == "chunked"
+        assert "Content-Length" not in headers
+        assert [name for name, _ in received["headers"]].count("Host") == 1
+
+    def test_proxy_forwards_pipeline_headers(self, monkeypatch, upstream):
+        """
+        Test that the headers built by the header pipeline reach a real upstream
+        through requests.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute("test", "/test", upstream)
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        res = app.test_client().get(
+            "/test/bla",
+            headers={
+                # Repeated headers are joined by the WSGI server
+                "X-Tag": "a, b",
+                "Connection": "X-Private",
+                "X-Private": "1",
+                "X-Forwarded-For": "1.2.3.4",
+            },
+        )
+        assert res.status_code == 200
+        headers = res.get_json()["headers"]
+        names = [name for name, _ in headers]
+        assert names.count("X-Tag") == names.count("Host") == 1
+        assert "X-Private" not in names
+        headers = dict(headers)
+        assert headers["X-Tag"] == "a, b"
+        assert headers["X-Forwarded-For"] == "1.2.3.4, 127.0.0.1"
+        assert headers["Forwarded"] == "for=127.0.0.1;host=localhost;proto=http"
+
+    def test_proxy_sends_client_headers_only(self, monkeypatch, upstream):
+        """
+        Test that the default headers of requests are not sent to the upstream.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute("test", "/test", upstream)
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        res = app.test_client().get("/test/bla")
+        assert res.status_code == 200
+        headers = dict(res.get_json()["headers"])
+        assert "gzip" not in headers.get("Accept-Encoding", "")
+        assert "Accept" not in headers
+        assert "Connection" not in headers
+        assert not headers.get("User-Agent", "").startswith("python-requests")
+
+    def test_proxy_authenticated_headers_from_session(self, monkeypatch):
+        """
+        Test that the headers derived when the session was created are reused,
+        without decoding the id token again.
+        """
+        # Create the test app
+        app = Flask(__name__)
+
+        # Add a route to be proxied
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        # Create the proxy route configuration and mock it
+        route = ProxyRoute("test", "/test", "http://127.0.0.1:9999")
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        # Mock requests to call the following method
+        def request(*a, **kw):
+            headers = dict(kw.get("headers"))
+            assert headers.get("Authorization") == "Bearer stored"
+            assert headers.get("X-Userinfo") == "c3RvcmVk"
+            return _mock_response(json_data={"status": "ok"})
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        def get_session_data(*a, **kw):
+            return {
+                "access_token": ACCESS_TOKEN,
+                "id_token": ID_TOKEN,
+                api.AUTHORIZATION_HEADER_FIELD: "Bearer stored",
+                api.USERINFO_HEADER_FIELD: "c3RvcmVk",
+                api.USERINFO_EXPIRES_AT_FIELD: ID_TOKEN_DATA["exp"],
+                api.SUBJECT_FIELD: ID_TOKEN_DATA["sub"],
+            }
+
+        monkeypatch.setattr("app.api.get_session_data_or_none", get_session_data)
+
+        mock_oauth_client = Mock()
+        monkeypatch.setattr(
+            "app.api.get_client", MagicMock(return_value=mock_oauth_client)
+        )
+
+        client = app.test_client()
+        with app.test_request_context():
+            res = client.get("/test/bla")
+            assert res.status_code == 200
+            mock_oauth_client.token_decoder.decode_token.assert_not_called()
+
+    def test_proxy_dispatches_with_router(self, monkeypatch):
+        """
+        Test that a single catch-all rule dispatches the requests to the route with
+        the longest matching path, and answers 404 when no route accepts them.
+        """
+        # Create the test app, with a single rule for all the proxied paths
+        app = Flask(__name__)
+        app.add_url_rule(
+            "/<path:path>", "proxy", api.proxy, methods=["GET", "POST", "DELETE"]
+        )
+
+        # Create the proxy route configurations and mock them
+        api_route = ProxyRoute("api", "/api", "http://127.0.0.1:9999")
+        v2_route = ProxyRoute(
+            "v2", "/api/v2", "http://127.0.0.1:9998", methods=["GET", "POST"]
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([api_route, v2_route]))
+
+        urls = []
+
+        def request(*a, **kw):
+            urls.append(kw.get("url"))
+            return _mock_response(json_data={"status": "ok"})
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            assert client.get("/api/v2/items?page=2").status_code == 200
+            assert client.delete("/api/v2/items/1").status_code == 200
+            assert client.get("/api/v1/items").status_code == 200
+            assert client.get("/other/items").status_code == 404
+            assert urls == [
+                "http://127.0.0.1:9998/items?page=2",
+                "http://127.0.0.1:9999/v2/items/1?",
+                "http://127.0.0.1:9999/v1/items?",
+            ]
+
+    def test_proxy_balances_upstreams(self, monkeypatch):
+        """
+        Test that the requests of a route with several upstreams are spread over them,
+        and that the upstream failing requests is ejected.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            ["http://127.0.0.1:9998", "http://127.0.0.1:9999"],
+            balancer=UpstreamBalancer(
+                ["http://127.0.0.1:9998", "http://127.0.0.1:9999"], max_failures=1
+            ),
+            retry=RetryPolicy(retries=0),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        urls = []
+
+        def request(*a, **kw):
+            urls.append(kw.get("url"))
+            status = 503 if kw.get("url").startswith("http://127.0.0.1:9998") else 200
+            return _mock_response(status=status)
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            statuses = []
+            for _ in range(3):
+                # The upstream is released once the response is sent and closed
+                res = client.get("/test/bla")
+                statuses.append(res.status_code)
+                res.close()
+            assert statuses == [503, 200, 200]
+            assert urls == [
+                "http://127.0.0.1:9998/bla?",
+                "http://127.0.0.1:9999/bla?",
+                "http://127.0.0.1:9999/bla?",
+            ]
+            assert [upstream.outstanding for upstream in route.balancer.upstreams] == [
+                0,
+                0,
+            ]
+
+    def test_proxy_response_cache(self, monkeypatch):
+        """
+        Test that cacheable GET responses are served from the cache of the route,
+        and revalidated with If-None-Match once stale.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test", "/test", "http://127.0.0.1:9999", cache=ResponseCache("test")
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        upstream_headers = []
+
+        def request(*a, **kw):
+            upstream_headers.append(dict(kw.get("headers")))
+            if upstream_headers[-1].get("If-None-Match") == '"v1"':
+                response = _mock_response(status=304, content=b"")
+                response.headers = CaseInsensitiveDict({"Cache-Control": "max-age=60"})
+                return response
+            response = _mock_response(content=b"CONTENT")
+            response.raw.read = Mock(return_value=b"CONTENT")
+            response.headers = CaseInsensitiveDict(
+                {"Cache-Control": "max-age=0", "ETag": '"v1"', "Content-Length": "7"}
+            )
+            return response
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            # Stored, but stale right away
+            res = client.get("/test/bla")
+            assert (res.status_code, res.data) == (200, b"CONTENT")
+            assert len(upstream_headers) == 1
+
+            # Revalidated, and fresh for 60 seconds
+            res = client.get("/test/bla")
+            assert (res.status_code, res.data) == (200, b"CONTENT")
+            assert upstream_headers[1].get("If-None-Match") == '"v1"'
+            assert res.headers["Cache-Control"] == "max-age=60"
+
+            res = client.get("/test/bla")
+            assert (res.status_code, res.data) == (200, b"CONTENT")
+            assert res.headers["Age"] == "0"
+            res = client.get("/test/bla", headers={"If-None-Match": '"v1"'})
+            assert res.status_code == 304
+            assert len(upstream_headers) == 2
+
+            # Not shared between users
+            monkeypatch.setattr(
+                "app.api.get_session_data_fields",
+                lambda: {
+                    api.AUTHORIZATION_HEADER_FIELD: "Bearer user-2",
+                    api.USERINFO_HEADER_FIELD: "dXNlci0y",
+                    api.SUBJECT_FIELD: "user-2",
+                },
+            )
+            assert client.get("/test/bla").status_code == 200
+            assert len(upstream_headers) == 3
+
+    def test_proxy_coalesces_requests(self, monkeypatch):
+        """
+        Test that identical concurrent GET requests share one upstream request.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            "http://127.0.0.1:9999",
+            coalescer=RequestCoalescer("test"),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        release = threading.Event()
+        urls = []
+
+        def request(*a, **kw):
+            urls.append(kw.get("url"))
+            release.wait(5)
+            response = _mock_response(content=b"CONTENT")
+            response.raw.read = Mock(return_value=b"CONTENT")
+            response.headers = CaseInsensitiveDict({"Content-Length": "7"})
+            return response
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        results = []
+
+        def get():
+            res = client.get("/test/bla")
+            results.append((res.status_code, res.data, "Age" in res.headers))
+
+        threads = [threading.Thread(target=get) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        # Not cached, without Age
+        assert results == [(200, b"CONTENT", False)] * 3
+        assert urls == ["http://127.0.0.1:9999/bla?"]
+        assert route.coalescer.coalesced == 2
+
+    @pytest.mark.parametrize(
+        "upstream_headers",
+        [{"Set-Cookie": "theme=dark"}, {"Cache-Control": "no-store"}],
+    )
+    def test_proxy_coalesces_not_shareable(self, monkeypatch, upstream_headers):
+        """
+        Test that the responses setting a cookie or not to be stored are given to
+        their own request only, with their headers unchanged.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            "http://127.0.0.1:9999",
+            coalescer=RequestCoalescer("test"),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        release = threading.Event()
+        urls = []
+
+        def request(*a, **kw):
+            urls.append(kw.get("url"))
+            release.wait(5)
+            response = _mock_response(content=b"CONTENT")
+            response.headers = CaseInsensitiveDict(
+                {"Content-Length": "7", **upstream_headers}
+            )
+            return response
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        results = []
+
+        def get():
+            res = client.get("/test/bla")
+            results.append((res.status_code, res.data, res.headers))
+
+        threads = [threading.Thread(target=get) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(urls) == 3
+        assert route.coalescer.coalesced == 0
+        for status, data, headers in results:
+            assert (status, data) == (200, b"CONTENT")
+            assert "Age" not in headers
+            for name, value in upstream_headers.items():
+                assert headers[name] == value
+
+    def test_proxy_coalesces_invalid_content_length(self, monkeypatch):
+        """
+        Test that a response with an invalid Content-Length is streamed instead of
+        being shared.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            "http://127.0.0.1:9999",
+            coalescer=RequestCoalescer("test"),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        def request(*a, **kw):
+            response = _mock_response(content=b"CONTENT")
+            response.headers = CaseInsensitiveDict({"Content-Length": "7, 7"})
+            return response
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        res = app.test_client().get("/test/bla")
+        assert (res.status_code, res.data) == (200, b"CONTENT")
+
+    def test_proxy_compresses_responses(self, monkeypatch):
+        """
+        Test that responses are compressed with an encoding accepted by the client,
+        and that the ones already encoded by the upstream pass through unchanged.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            "http://127.0.0.1:9999",
+            compressor=ResponseCompressor(min_size=0, encodings=["gzip"]),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        body = b'{"status": "ok"}' * 100
+        gzipped = zlib.compress(body)
+
+        def request(*a, **kw):
+            response = _mock_response()
+            if kw.get("url").endswith("/encoded?"):
+                response.raw.stream = Mock(return_value=iter([gzipped]))
+                response.headers = CaseInsensitiveDict(
+                    {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+                )
+            else:
+                response.raw.stream = Mock(return_value=iter([body[:800], body[800:]]))
+                response.headers = CaseInsensitiveDict(
+                    {"Content-Type": "application/json", "ETag": '"v1"'}
+                )
+            return response
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            res = client.get("/test/bla", headers={"Accept-Encoding": "gzip"})
+            assert res.status_code == 200
+            assert res.headers["Content-Encoding"] == "gzip"
+            assert res.headers["Vary"] == "Accept-Encoding"
+            assert res.headers["ETag"] == 'W/"v1"'
+            assert zlib.decompress(res.data, 16 + zlib.MAX_WBITS) == body
+
+            res = client.get("/test/bla")
+            assert "Content-Encoding" not in res.headers
+            assert res.data == body
+
+            res = client.get("/test/encoded", headers={"Accept-Encoding": "gzip"})
+            assert res.headers["Content-Encoding"] == "gzip"
+            assert res.data == gzipped
+
+    def test_proxy_forwards_headers(self, monkeypatch):
+        """
+        Test that hop-by-hop headers are not forwarded, in either direction, and that
+        the forwarded headers are added to the upstream request.
+        """
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute("test", "/test", "http://127.0.0.1:9999")
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        def request(*a, **kw):
+            headers = dict(kw.get("headers"))
+            assert headers["Accept"] == "application/json"
+            assert "Keep-Alive" not in headers
+            assert "X-Hop" not in headers
+            assert headers["X-Forwarded-For"] == "1.2.3.4, 127.0.0.1"
+            assert headers["X-Forwarded-Proto"] == "http"
+            assert headers["X-Forwarded-Host"] == "localhost"
+            response = _mock_response()
+            response.raw.stream = Mock(return_value=iter([b"STREAMED", b"BODY"]))
+            response.headers = CaseInsensitiveDict(
+                {
+                    "Content-Type": "text/plain",
+                    "Transfer-Encoding": "chunked",
+                    "Connection": "keep-alive",
+                    "Keep-Alive": "timeout=5",
+                }
+            )
+            return response
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            res = client.get(
+                "/test/bla",
+                headers={
+                    "Accept": "application/json",
+                    "Connection": "X-Hop",
+                    "Keep-Alive": "timeout=5",
+                    "X-Hop": "1",
+                    "X-Forwarded-For": "1.2.3.4",
+                },
+            )
+            assert res.status_code == 200
+            assert res.data == b"STREAMEDBODY"
+            assert res.headers["Content-Type"] == "text/plain"
+            assert "Transfer-Encoding" not in res.headers
+            assert "Keep-Alive" not in res.headers
+            res.close()
+
+    def test_proxy_retries_idempotent_requests(self, monkeypatch):
+        """
+        Test that idempotent requests failing on an upstream are retried on another
+        one, and that requests with a body are not.
+        """
+        app = Flask(__name__)
+        errors.init_app(app)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy, methods=["GET", "PUT"])
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            ["http://127.0.0.1:9998", "http://127.0.0.1:9999"],
+            retry=RetryPolicy(retries=2, backoff=0),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        urls = []
+
+        def request(*a, **kw):
+            urls.append(kw.get("url"))
+            if kw.get("url").startswith("http://127.0.0.1:9998"):
+                raise requests.ConnectionError("refused")
+            return _mock_response(status=200)
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            res = client.get("/test/bla")
+            assert res.status_code == 200
+            res.close()
+            assert urls == ["http://127.0.0.1:9998/bla?", "http://127.0.0.1:9999/bla?"]
+
+            # The body is streamed to the upstream, the request can not be sent again
+            del urls[:]
+            res = client.put("/test/bla", data=b"body")
+            assert res.status_code == 502
+            assert res.json["error"]["code"] == 8
+            assert urls == ["http://127.0.0.1:9998/bla?"]
+
+    def test_proxy_circuit_breaker(self, monkeypatch):
+        """
+        Test that requests fail fast with a 503 once the circuit of the upstream is
+        open.
+        """
+        app = Flask(__name__)
+        errors.init_app(app)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            "http://127.0.0.1:9999",
+            balancer=UpstreamBalancer(
+                "http://127.0.0.1:9999", circuit_breaker={"max_failures": 2}
+            ),
+            retry=RetryPolicy(retries=0),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        urls = []
+
+        def request(*a, **kw):
+            urls.append(kw.get("url"))
+            raise requests.ReadTimeout("timed out")
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            assert [client.get("/test/bla").status_code for _ in range(3)] == [
+                504,
+                504,
+                503,
+            ]
+            assert len(urls) == 2
+
+    def test_proxy_rate_limit(self, monkeypatch):
+        """
+        Test that requests over the rate limit of the route are answered with a 429
+        and Retry-After, without reaching the upstream.
+        """
+        app = Flask(__name__)
+        errors.init_app(app)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+
+        route = ProxyRoute(
+            "test",
+            "/test",
+            "http://127.0.0.1:9999",
+            rate_limiter=RateLimiter([RateLimit("test", 2, period=60)]),
+        )
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+
+        urls = []
+
+        def request(*a, **kw):
+            urls.append(kw.get("url"))
+            return _mock_response()
+
+        monkeypatch.setattr("requests.sessions.Session.request", request)
+
+        client = app.test_client()
+        with app.test_request_context():
+            assert [client.get("/test/bla").status_code for _ in range(3)] == [
+                200,
+                200,
+                429,
+            ]
+            res = client.get("/test/bla")
+            assert res.status_code == 429
+            assert res.headers["Retry-After"] == "30"
+            assert res.json["error"]["code"] == 9
+            assert len(urls) == 2
+
+    def test_proxy_metrics(self, monkeypatch):
+        app = Flask(__name__)
+        app.add_url_rule("/test/<path:path>", "test", api.proxy)
+        app.add_url_rule("/metrics", "metrics", api.metrics_view)
+        errors.init_app(app)
+        route = ProxyRoute("metrics-test", "/test", "http://127.0.0.1:9999")
+        monkeypatch.setattr("app.api.proxy_router", ProxyRouter([route]))
+        monkeypatch.setattr(
+            "requests.sessions.Session.request",
+            lambda *a, **kw: _mock_response(json_data={"status": "ok"}),
+        )
+
+        client = app.test_client()
+        res = client.get("/test/bla")
+        assert res.status_code == 200
+        res.close()
+
+        res = client.get("/metrics")
+        assert res.content_type.startswith("text/plain; version=0.0.4")
+        body = res.get_data(as_text=True)
+        assert (
+            'pyopenid_proxy_requests_total{route="metrics-test",method="GET",'
+            'status="2xx"} 1\n'
+        ) in body
+        assert 'pyopenid_proxy_requests_in_flight{route="metrics-test"} 0\n' in body
+        for phase in ["session", "upstream"]:
+            assert (
+                'pyopenid_proxy_phase_duration_seconds_count{route="metrics-test",'
+                f'phase="{phase}"}} 1\n'
+            ) in body
+
+    def test_metrics_token(self, monkeypatch):
+        app = Flask(__name__)
+        app.add_url_rule("/metrics", "metrics", api.metrics_view)
+        errors.init_app(app)
+        monkeypatch.setattr("app.settings.METRICS_TOKEN", "s3cret")
+
+        client = app.test_client()
+        for headers in [{}, {"Authorization": "Bearer other"}]:
+            res = client.get("/metrics", headers=headers)
+            assert res.status_code == 401
+            assert res.json["error"]["code"] == 10
+        res = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+        assert res.status_code == 200
+        assert res.content_type.startswith("text/plain; version=0.0.4")
@@ -0,0 +1,280 @@
+import asyncio
+import httpx
+from flask import Flask, jsonify
+from werkzeug.datastructures import Headers
+from unittest.mock import Mock, MagicMock
+from app import api, metrics
+from app.asgi import AsyncProxyApp, get_request_body
+from app.balancers import UpstreamBalancer
+from app.compression import ResponseCompressor
+from app.proxy_routes import ProxyRoute, ProxyRouter
+from app.rate_limits import RateLimit, RateLimiter
+from app.retries import RetryPolicy
+from app.session_cookies import SessionIdInterface
+from app.oauth.mock_data import ACCESS_TOKEN, ID_TOKEN, ID_TOKEN_DATA
+
+
+def _upstream_response(status=200, content=b"", **kwargs):
+    """
+    Upstream response whose body is not read yet, as for a real upstream.
+    """
+
+    async def stream():
+        yield content
+
+    return httpx.Response(status, content=stream(), **kwargs)
+
+
+def _create_app(monkeypatch, handler):
+    """
+    Create an ASGI app proxying /test to 127.0.0.1:9999, where upstream requests
+    are answered by the given handler.
+    """
+    # Create the test app
+    app = Flask(__name__)
+    app.secret_key = "secret"
+    app.session_interface = SessionIdInterface("secret", 3600)
+
+    # Add a route to be proxied, and a regular one
+    app.add_url_rule(
+        "/test/<path:path>", "test", api.proxy, methods=["GET", "OPTIONS", "POST"]
+    )
+    app.add_url_rule("/status", "status", lambda: jsonify({"status": "flask"}))
+
+    # Create the proxy route configuration and mock it
+    route = ProxyRoute("test", "/test", "http://127.0.0.1:9999")
+    proxy_router = ProxyRouter([route])
+    monkeypatch.setattr("app.asgi.proxy_router", proxy_router)
+    monkeypatch.setattr("app.api.proxy_router", proxy_router)
+
+    asgi_app = AsyncProxyApp(app)
+    asgi_app.clients[route] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return asgi_app
+
+
+def _request(asgi_app, method, url, **kwargs):
+    async def send():
+        async with httpx.AsyncClient(
+            app=asgi_app, base_url="http://testserver"
+        ) as client:
+            return await client.request(method, url, **kwargs)
+
+    return asyncio.run(send())
+
+
+class TestAsgiProxy:
+    def test_proxy(self, monkeypatch):
+        def handler(request):
+            assert str(request.url) == "http://127.0.0.1:9999/bla?a=1"
+            assert "Authorization" not in request.headers
+            return _upstream_response(
+                content=b'{"status": "ok"}',
+                headers={"Content-Type": "application/json"},
+            )
+
+        asgi_app = _create_app(monkeypatch, handler)
+        res = _request(asgi_app, "GET", "/test/bla?a=1")
+        assert res.status_code == 200
+        assert res.json() == {"status": "ok"}
+
+    def test_proxy_streams_body(self, monkeypatch):
+        upload = b"0123456789" * 1000
+
+        def handler(request):
+            assert request.headers["Content-Length"] == str(len(upload))
+            assert request.read() == upload
+            return _upstream_response(201, b"created")
+
+        asgi_app = _create_app(monkeypatch, handler)
+        res = _request(asgi_app, "POST", "/test/bla", content=upload)
+        assert res.status_code == 201
+        assert res.content == b"created"
+
+    def test_request_body_invalid_content_length(self):
+        receive = Mock()
+        for value in ("", "0", "-1", "4, 4"):
+            headers = Headers([("Content-Length", value)])
+            assert get_request_body(headers, receive) is None
+        assert get_request_body(Headers([("Content-Length", "4")]), receive)
+
+    def test_proxy_forwards_headers(self, monkeypatch):
+        def handler(request):
+            assert request.headers["X-Forwarded-For"] == "127.0.0.1"
+            assert request.headers["X-Forwarded-Host"] == "testserver"
+            assert "X-Hop" not in request.headers
+            return _upstream_response(
+                content=b"ok", headers={"Connection": "close", "Keep-Alive": "5"}
+            )
+
+        asgi_app = _create_app(monkeypatch, handler)
+        res = _request(
+            asgi_app, "GET", "/test/bla", headers={"Connection": "X-Hop", "X-Hop": "1"}
+        )
+        assert res.status_code == 200
+        assert "Keep-Alive" not in res.headers
+
+    def test_client_without_default_headers(self):
+        route = ProxyRoute("test", "/test", "http://127.0.0.1:9999")
+        client = AsyncProxyApp(Flask(__name__)).get_client(route)
+        assert not client.headers
+
+    def test_proxy_keeps_repeated_headers(self, monkeypatch):
+        def handler(request):
+            assert request.headers.get_list("X-Custom") == ["1", "2"]
+            return _upstream_response(
+                content=b"ok",
+                headers=[("Server", "upstream"), ("Date", "today"), ("X-Up", "1")],
+            )
+
+        asgi_app = _create_app(monkeypatch, handler)
+        res = _request(
+            asgi_app, "GET", "/test/bla", headers=[("X-Custom", "1"), ("X-Custom", "2")]
+        )
+        assert res.status_code == 200
+        assert res.headers["X-Up"] == "1"
+        # Set by the ASGI server
+        assert "Server" not in res.headers
+        assert "Date" not in res.headers
+
+    def test_proxy_retries_and_fails_fast(self, monkeypatch):
+        attempts = []
+
+        def handler(request):
+            attempts.append(request.url)
+            raise httpx.ConnectError("refused")
+
+        asgi_app = _create_app(monkeypatch, handler)
+        route = next(iter(asgi_app.clients))
+        route.retry = RetryPolicy(retries=1, backoff=0)
+        route.balancer = UpstreamBalancer(
+            route.upstream, circuit_breaker={"max_failures": 2}
+        )
+        res = _request(asgi_app, "GET", "/test/bla")
+        assert res.status_code == 502
+        assert len(attempts) == 2
+        # The circuit of the upstream is open
+        res = _request(asgi_app, "GET", "/test/bla")
+        assert res.status_code == 503
+        assert res.json()["error"]["code"] == 6
+        assert len(attempts) == 2
+
+    def test_proxy_rate_limit(self, monkeypatch):
+        def handler(request):
+            return _upstream_response(content=b"ok")
+
+        asgi_app = _create_app(monkeypatch, handler)
+        route = next(iter(asgi_app.clients))
+        route.rate_limiter = RateLimiter([RateLimit("test", 1, period=10, key="ip")])
+        assert _request(asgi_app, "GET", "/test/bla").status_code == 200
+        res = _request(asgi_app, "GET", "/test/bla")
+        assert res.status_code == 429
+        assert res.headers["Retry-After"] == "10"
+
+    def test_proxy_compresses_body(self, monkeypatch):
+        body = b'{"status": "ok"}' * 100
+
+        def handler(request):
+            return _upstream_response(
+                content=body, headers={"Content-Type": "application/json"}
+            )
+
+        asgi_app = _create_app(monkeypatch, handler)
+        route = next(iter(asgi_app.clients))
+        route.compressor = ResponseCompressor(encodings=["gzip"])
+        res = _request(
+            asgi_app, "GET", "/test/bla", headers={"Accept-Encoding": "gzip"}
+        )
+        assert res.headers["Content-Encoding"] == "gzip"
+        assert res.headers["Vary"] == "Accept-Encoding"
+        # Decompressed by httpx
+        assert res.content == body
+
+    def test_proxy_authenticated_headers(self, monkeypatch):
+        def handler(request):
+            assert request.headers["Authorization"] == f"Bearer {ACCESS_TOKEN}"
+            assert request.headers["X-Userinfo"] == "c3RvcmVk"
+            return _upstream_response()
+
+        session_data = {
+            "access_token": ACCESS_TOKEN,
+            "id_token": ID_TOKEN,
+            api.AUTHORIZATION_HEADER_FIELD: f"Bearer {ACCESS_TOKEN}",
+            api.USERINFO_HEADER_FIELD: "c3RvcmVk",
+            api.USERINFO_EXPIRES_AT_FIELD: ID_TOKEN_DATA["exp"],
+            api.SUBJECT_FIELD: ID_TOKEN_DATA["sub"],
+        }
+        server_session = Mock()
+        server_session.get_async = MagicMock(
+            side_effect=lambda session_id: asyncio.sleep(0, session_data)
+        )
+        monkeypatch.setattr("app.asgi.server_session", server_session)
+
+        asgi_app = _create_app(monkeypatch, handler)
+        cookie = asgi_app.session_interface.codec.dumps("1234")
+        res = _request(
+            asgi_app,
+            "GET",
+            "/test/bla",
+            headers={"Cookie": f"session={cookie}", "Authorization": "Bearer fake"},
+        )
+        assert res.status_code == 200
+        server_session.get_async.assert_called_once_with("1234")
+
+    def test_other_routes_use_flask(self, monkeypatch):
+        def handler(request):
+            raise AssertionError("Should not be proxied")
+
+        asgi_app = _create_app(monkeypatch, handler)
+        res = _request(asgi_app, "GET", "/status")
+        assert res.json() == {"status": "flask"}
+        res = _request(asgi_app, "OPTIONS", "/test/bla")
+        assert res.status_code == 200
+
+    def test_proxy_reloaded_route(self, monkeypatch):
+        urls = []
+
+        def handler(request):
+            urls.append(str(request.url))
+            return _upstream_response()
+
+        asgi_app = _create_app(monkeypatch, handler)
+        old_route = next(iter(asgi_app.clients))
+        old_client = asgi_app.clients[old_route]
+
+        # Reload the routes with a new upstream for /test
+        new_route = ProxyRoute("test", "/test", "http://127.0.0.1:9998")
+        monkeypatch.setattr("app.asgi.proxy_router", ProxyRouter([new_route]))
+        monkeypatch.setattr(
+            asgi_app,
+            "get_client",
+            lambda route: asgi_app.clients.setdefault(
+                route, httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            ),
+        )
+
+        res = _request(asgi_app, "GET", "/test/bla")
+        assert res.status_code == 200
+        assert urls == ["http://127.0.0.1:9998/bla?"]
+        # The client of the previous route is closed once unused
+        assert list(asgi_app.clients) == [new_route]
+        assert old_client.is_closed
+
+    def test_proxy_metrics(self, monkeypatch):
+        def handler(request):
+            return _upstream_response(status=502)
+
+        def values(metric):
+            return {tuple(labels): value for labels, value in metric.snapshot()}
+
+        requests_before = values(metrics.proxy_requests).get(("test", "GET", "5xx"), 0)
+        in_flight_before = values(metrics.proxy_requests_in_flight).get(("test",), 0)
+        asgi_app = _create_app(monkeypatch, handler)
+        res = _request(asgi_app, "GET", "/test/bla")
+        assert res.status_code == 502
+
+        assert values(metrics.proxy_requests)[("test", "GET", "5xx")] == (
+            requests_before + 1
+        )
+        assert values(metrics.proxy_requests_in_flight)[("test",)] == in_flight_before
+        upstream_phase = values(metrics.proxy_phase_duration)[("test", "upstream")]
+        assert sum(upstream_phase[:-1]) >= 1
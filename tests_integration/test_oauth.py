@@ -32,6 +32,22 @@ class TestOAuth:
         json_response = response.json
         assert json_response["status"] == "running"
 
+    def test_metrics_disabled_by_default(self, app):
+        assert "metrics" not in app.view_functions
+
+    def test_method_not_allowed(self, client):
+        # Not taken by the catch-all rule of the proxied routes
+        for method, path in [
+            ("POST", "/login"),
+            ("PUT", "/me"),
+            ("DELETE", "/logout"),
+            ("POST", "/callback"),
+            ("GET", "/delete"),
+        ]:
+            response = client.open(path, method=method)
+            assert response.status_code == 405
+        assert set(response.headers["Allow"].split(", ")) == {"OPTIONS", "POST"}
+
     def test_cookie_and_session(self, app, client, monkeypatch):
         @app.route("/test-session-cookie", methods=["OPTIONS", "POST"])
         def test_session_cookie():
@@ -151,6 +167,72 @@ class TestOAuth:
         assert response.status_code == 302
         assert response.location == settings.REDIRECT_LOGIN_URL
 
+    def test_logout_destroys_session(self, app, client, monkeypatch):
+        base_client = MockClient()
+        mock_oauth_client = Mock(wraps=base_client)
+        mock_oauth_client.authorize_access_token = MagicMock(
+            return_value=get_mock_tokens()
+        )
+        monkeypatch.setattr(
+            "app.api.get_client", MagicMock(return_value=mock_oauth_client)
+        )
+
+        response = client.get("/callback")
+        assert response.status_code == 302
+        with client.session_transaction() as client_session:
+            session_id = client_session[settings.SESSION_ID]
+        assert server_session.get(session_id)
+
+        response = client.get("/logout")
+        assert response.status_code == 302
+        assert server_session.get(session_id) is None
+        with client.session_transaction() as client_session:
+            assert settings.SESSION_ID not in client_session
+
+    def test_requires_auth_refreshes_token(self, app, client, monkeypatch):
+        @app.route("/test-authenticated", methods=["OPTIONS", "GET"])
+        @requires_auth
+        def test_authenticated():
+            return jsonify({}), 200
+
+        mock_tokens = get_mock_tokens()
+        mock_tokens.update(
+            {
+                "expires_at": math.floor(time.time()) + 10,
+                "expires_in": 10,
+                "refresh_token": "refresh-1",
+            }
+        )
+        refreshed_tokens = get_mock_tokens()
+        refreshed_tokens["refresh_token"] = "refresh-2"
+
+        base_client = MockClient()
+        mock_oauth_client = Mock(wraps=base_client)
+        mock_oauth_client.authorize_access_token = MagicMock(return_value=mock_tokens)
+        mock_oauth_client.refresh_access_token = MagicMock(
+            return_value=refreshed_tokens
+        )
+        for module in ["app.api", "app.oauth.decorators", "app.oauth.refresh"]:
+            monkeypatch.setattr(
+                f"{module}.get_client", MagicMock(return_value=mock_oauth_client)
+            )
+
+        # Login, create a session whose access token expires within the window
+        response = client.get("/callback")
+        assert response.status_code == 302
+
+        response = client.get("/test-authenticated")
+        assert response.status_code == 200
+        response = client.get("/test-authenticated")
+        assert response.status_code == 200
+
+        mock_oauth_client.refresh_access_token.assert_called_once_with("refresh-1")
+        with client.session_transaction() as client_session:
+            session_id = client_session[settings.SESSION_ID]
+        session_data = server_session.get(session_id)
+        assert session_data["refresh_token"] == "refresh-2"
+        assert session_data["expires_at"] == refreshed_tokens["expires_at"]
+
     def test_mock_oauth(self, monkeypatch):
         monkeypatch.setattr("app.settings.MOCK_OAUTH", True)
         app = create_app()